@@ -0,0 +1,219 @@
+"""
+Admission control in front of generation scheduling.
+
+Every generation request is checked before a status message is sent or a job
+is queued: against a global ceiling on generations running or waiting for a
+slot, against the wait estimated from the queue depth and the recent
+generation latency, and against token buckets of the user and of the group
+chat. Requests that fail a check are refused right away with the time after
+which a retry should succeed, instead of sitting in the queue until they time
+out. Bucket levels are kept in wall-clock time and saved to disk, so a
+restart does not hand every user a fresh burst.
+"""
+import asyncio
+import json
+import logging
+import math
+import os
+import time
+from config import (
+    ADMISSION_MAX_PENDING, ADMISSION_MAX_WAIT, ADMISSION_USER_PER_MINUTE, ADMISSION_USER_BURST,
+    ADMISSION_CHAT_PER_MINUTE, ADMISSION_CHAT_BURST, ADMISSION_STATE_PATH, ADMISSION_SAVE_INTERVAL,
+    PRIORITY_USER_IDS
+)
+from fal_client_wrapper import quality_router
+from job_scheduler import generation_scheduler
+from metrics import Counter
+from telegram_sender import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+admission_total = Counter(
+    "chilloutai_admission_total",
+    "Generation requests by admission outcome",
+    ["outcome"]
+)
+
+# Suggested retry delay (seconds) while there are no latency samples yet
+DEFAULT_RETRY_AFTER = 10
+
+class AdmissionController:
+    """
+    Admits or refuses generation requests
+
+    Args:
+        path (str): File the bucket levels are saved to
+        max_pending (int): Generations running or queued above which requests
+            are refused, 0 for no limit
+        max_wait (float): Estimated wait (seconds) above which requests are
+            refused, 0 for no limit
+        user_rate (float): Requests per minute refilled into a user's bucket
+        user_burst (int): Capacity of a user's bucket
+        chat_rate (float): Requests per minute refilled into a group's bucket
+        chat_burst (int): Capacity of a group's bucket
+        exempt (set): User ids not subject to the buckets
+    """
+
+    def __init__(self, path, max_pending, max_wait, user_rate, user_burst, chat_rate, chat_burst,
+                 exempt=frozenset(), save_interval=10.0):
+        self.path = path
+        self.max_pending = max_pending
+        self.max_wait = max_wait
+        self.exempt = exempt
+        self.save_interval = save_interval
+        # name -> (buckets by id, tokens per second, capacity)
+        self.tables = {
+            "users": ({}, user_rate / 60, user_burst),
+            "chats": ({}, chat_rate / 60, chat_burst),
+        }
+        self._save_task = None
+
+    def set_path(self, path):
+        """Save to another file, e.g. one per webhook worker"""
+        self.path = path
+
+    def _bucket(self, table, key, now):
+        buckets, rate, capacity = self.tables[table]
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(rate, capacity)
+            # Wall-clock time, so that saved levels stay meaningful after a restart
+            bucket.updated = now
+            buckets[key] = bucket
+        return bucket
+
+    def estimated_wait(self):
+        """
+        Estimate how long a new generation would wait for a slot
+
+        Returns:
+            float: Seconds, or None before enough generations have finished
+                to know their latency
+        """
+        latency = quality_router.latency.percentile("generate", 0.5)
+        if latency is None:
+            return None
+        slots = generation_scheduler.max_inflight
+        ahead = generation_scheduler.inflight + generation_scheduler.queue_depth - slots + 1
+        if ahead <= 0:
+            return 0.0
+        return math.ceil(ahead / slots) * latency
+
+    def _overload_retry_after(self, pending):
+        """Seconds until enough generations have finished to get below the ceiling"""
+        latency = quality_router.latency.percentile("generate", 0.5)
+        if latency is None:
+            return DEFAULT_RETRY_AFTER
+        excess = pending - self.max_pending + 1
+        return math.ceil(excess / generation_scheduler.max_inflight) * latency
+
+    def check(self, user_id, chat_id, cost=1, now=None):
+        """
+        Admit a generation request, taking tokens from the user's and the
+        group's buckets, or refuse it
+
+        Args:
+            user_id (int): Telegram user id
+            chat_id (int): Telegram chat id; private chats only use the
+                user's bucket
+            cost (int): Generations the request runs, e.g. 2 for a preview
+                followed by the full render
+
+        Returns:
+            tuple: None if the request is admitted, otherwise the reason
+                ("overloaded", "wait", "user_quota" or "chat_quota") and
+                the seconds after which a retry should be admitted
+        """
+        now = time.time() if now is None else now
+        pending = generation_scheduler.inflight + generation_scheduler.queue_depth
+        if self.max_pending and pending >= self.max_pending:
+            return self._refuse("overloaded", self._overload_retry_after(pending))
+        wait = self.estimated_wait() if self.max_wait else None
+        if wait is not None and wait > self.max_wait:
+            return self._refuse("wait", wait - self.max_wait)
+
+        if user_id in self.exempt:
+            admission_total.inc(outcome="admitted")
+            return None
+        buckets = []
+        if self.tables["users"][1]:
+            buckets.append(("user_quota", self._bucket("users", user_id, now)))
+        if chat_id != user_id and self.tables["chats"][1]:
+            buckets.append(("chat_quota", self._bucket("chats", chat_id, now)))
+        for reason, bucket in buckets:
+            # A request costing more than the burst would never be admitted
+            delay = bucket.delay(now, min(cost, bucket.capacity))
+            if delay > 0:
+                return self._refuse(reason, delay)
+        for _, bucket in buckets:
+            bucket.take(now, cost)
+        admission_total.inc(outcome="admitted")
+        return None
+
+    def _refuse(self, reason, retry_after):
+        admission_total.inc(outcome=reason)
+        return reason, max(1, math.ceil(retry_after))
+
+    def load(self):
+        """Restore the bucket levels saved by a previous run"""
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.error("Error loading quota state, starting with full buckets: %s", e)
+            return
+        now = time.time()
+        for table in self.tables:
+            for key, (tokens, updated) in state.get(table, {}).items():
+                bucket = self._bucket(table, int(key), now)
+                bucket.tokens = min(bucket.capacity, tokens)
+                bucket.updated = min(updated, now)
+        logger.info("Restored %s quota buckets", sum(len(state.get(table, {})) for table in self.tables))
+
+    def save(self):
+        """Write the buckets that are not full, dropping the others from memory"""
+        now = time.time()
+        state = {}
+        for table, (buckets, _, _) in self.tables.items():
+            for key in [key for key, bucket in buckets.items() if bucket.idle(now)]:
+                del buckets[key]
+            state[table] = {key: (bucket.tokens, bucket.updated) for key, bucket in buckets.items()}
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(state, f, separators=(",", ":"))
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.error("Error saving quota state: %s", e)
+
+    def start(self):
+        """Restore the saved levels and start saving periodically; must be called from the event loop"""
+        self.load()
+        if self._save_task is None:
+            self._save_task = asyncio.get_running_loop().create_task(self._save_loop())
+
+    async def _save_loop(self):
+        while True:
+            await asyncio.sleep(self.save_interval)
+            self.save()
+
+    async def close(self):
+        """Stop the periodic save and save one last time"""
+        if self._save_task is not None:
+            self._save_task.cancel()
+            try:
+                await self._save_task
+            except asyncio.CancelledError:
+                pass
+            self._save_task = None
+        self.save()
+
+# Create a global instance
+admission = AdmissionController(
+    ADMISSION_STATE_PATH, ADMISSION_MAX_PENDING, ADMISSION_MAX_WAIT,
+    ADMISSION_USER_PER_MINUTE, ADMISSION_USER_BURST,
+    ADMISSION_CHAT_PER_MINUTE, ADMISSION_CHAT_BURST,
+    exempt=PRIORITY_USER_IDS, save_interval=ADMISSION_SAVE_INTERVAL
+)
@@ -0,0 +1,74 @@
+"""
+Micro-benchmark for UserStateManager.
+
+Measures the cost of one simulated update (get session, set state, reset
+state) as the number of live sessions grows. With the activity-ordered
+session table the per-update cost stays flat; the previous implementation,
+which scanned every session on each access, is included for comparison.
+
+Usage:
+    python benchmarks/bench_user_state.py [--updates 20000] [--sizes 1000,10000,100000]
+"""
+import argparse
+import logging
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "benchmark")
+os.environ.setdefault("FAL_KEY", "benchmark")
+
+from user_state import UserSession, UserState, UserStateManager
+
+class ScanningStateManager(UserStateManager):
+    """The previous behaviour: a full scan of all sessions on every access"""
+
+    def _cleanup_expired_sessions(self, now=None):
+        now = datetime.now().timestamp()
+        expired_users = [
+            user_id for user_id, session in self.user_sessions.items()
+            if now - session.last_activity > self._timeout_seconds
+        ]
+        for user_id in expired_users:
+            del self.user_sessions[user_id]
+
+def run(manager_class, sessions, updates):
+    manager = manager_class(timedelta(minutes=30), max_sessions=sessions * 2)
+    # Fill the table directly so setup does not pay the scanning cost
+    for user_id in range(sessions):
+        manager.user_sessions[user_id] = UserSession()
+
+    user_ids = [random.randrange(sessions) for _ in range(updates)]
+    start = time.perf_counter()
+    for user_id in user_ids:
+        manager.get_user_session(user_id)
+        manager.set_user_state(user_id, UserState.WAITING_FOR_IMAGE)
+        manager.reset_user_state(user_id)
+    elapsed = time.perf_counter() - start
+    return elapsed / updates * 1e6
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--updates", type=int, default=20000)
+    parser.add_argument("--sizes", default="1000,10000,100000")
+    parser.add_argument("--skip-scanning", action="store_true", help="Only benchmark the current implementation")
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    sizes = [int(size) for size in args.sizes.split(",")]
+
+    print(f"{'sessions':>10} {'indexed us/update':>18} {'scanning us/update':>19}")
+    for size in sizes:
+        indexed = run(UserStateManager, size, args.updates)
+        if args.skip_scanning:
+            scanning = "-"
+        else:
+            # The scanning version is slow, keep its run short
+            scanning = f"{run(ScanningStateManager, size, max(100, args.updates // (size // 100 or 1))):.1f}"
+        print(f"{size:>10} {indexed:>18.2f} {scanning:>19}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""
+Check that queued generation jobs survive a graceful shutdown.
+
+Runs the real Application with FAL_SUBMIT_MODE=queue against the local fake
+Telegram and fal servers, sends a prompt whose generation takes longer than
+the test, waits until the job is journaled and then stops the bot the way a
+SIGTERM does (Application.stop and post_shutdown). The job must still be
+pending in the journal, so the next start resumes it.
+
+Exits with status 1 if the check fails.
+
+Usage:
+    python benchmarks/check_job_journal.py
+"""
+import asyncio
+import logging
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from fake_servers import FakeFal, FakeTelegram
+from http_server import start_http_server
+from load_test import TOKEN, _message
+
+async def run():
+    telegram = FakeTelegram()
+    telegram_server = await start_http_server(telegram.handle, "127.0.0.1", 0)
+    telegram_url = f"http://127.0.0.1:{telegram_server.sockets[0].getsockname()[1]}"
+    fal_server = await start_http_server(lambda request: fal.handle(request), "127.0.0.1", 0)
+    fal_url = f"http://127.0.0.1:{fal_server.sockets[0].getsockname()[1]}"
+    # The generation outlasts the test
+    fal = FakeFal(fal_url, queue_ms=10, inference_ms=600000, jitter=0.01)
+
+    workdir = tempfile.mkdtemp(prefix="bot-journal-")
+    journal_path = os.path.join(workdir, "jobs.journal")
+    os.environ.update({
+        "TELEGRAM_BOT_TOKEN": TOKEN,
+        "FAL_KEY": "benchmark",
+        "TELEGRAM_BASE_URL": f"{telegram_url}/bot",
+        "TELEGRAM_BASE_FILE_URL": f"{telegram_url}/file/bot",
+        "METRICS_PORT": "0",
+        "FAL_SUBMIT_MODE": "queue",
+        "JOB_JOURNAL_PATH": journal_path,
+        "WARMUP_MODELS": "",
+    })
+    os.chdir(workdir)
+
+    import fal_client.client
+    fal_client.client.QUEUE_URL_FORMAT = f"{fal_url}/queue/"
+    fal_client.client.RUN_URL_FORMAT = f"{fal_url}/run/"
+    fal_client.client.CDN_URL = f"{fal_url}/cdn"
+
+    import main
+    from job_journal import JobJournal, job_journal
+    logging.getLogger().setLevel(logging.WARNING)
+
+    application = main.build_application()
+    async with application:
+        await main.post_init(application)
+        await application.start()
+        await application.updater.start_polling(poll_interval=0, timeout=5)
+
+        telegram.push_update({"message": _message(1000, 1, text="a lighthouse at dusk")})
+        deadline = time.monotonic() + 10
+        while not job_journal.pending() and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        submitted = job_journal.pending()
+
+        await application.updater.stop()
+        await application.stop()
+        await main.post_shutdown(application)
+
+    telegram_server.close()
+    fal_server.close()
+    # Read the file afresh, as the next start would
+    pending = JobJournal(journal_path).pending()
+    ok = len(submitted) == 1 and [record["key"] for record in pending] == [submitted[0]["key"]]
+    print(f"{'ok  ' if ok else 'FAIL'} queued job still journaled after shutdown "
+          f"(submitted {len(submitted)}, pending after shutdown {len(pending)})")
+    return ok
+
+def main():
+    sys.exit(0 if asyncio.run(run()) else 1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""
+Checks of the persistent session stores against a local Redis stand-in.
+
+Runs without a Redis server, using FakeRedis from fake_servers.py:
+
+    round trip     save, load and delete sessions through RedisSessionStore
+                   and SQLiteSessionStore
+    write-behind   state changes reach the store through the background
+                   flush, and a fresh UserStateManager loads them back
+    event loop     loading sessions from a slow server (--latency-ms) does
+                   not stall the event loop
+    parallel loads those loads run side by side on the load workers instead
+                   of one after another
+
+Exits with status 1 if a check fails.
+
+Usage:
+    python benchmarks/check_session_store.py [--latency-ms 100] [--users 20]
+"""
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import tempfile
+import time
+from datetime import timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "benchmark")
+os.environ.setdefault("FAL_KEY", "benchmark")
+
+from fake_servers import FakeRedis
+from session_store import RedisSessionStore, SQLiteSessionStore
+from user_state import UserState, UserStateManager
+
+def check(name, ok, detail=""):
+    print(f"{'ok  ' if ok else 'FAIL'} {name}{f' ({detail})' if detail else ''}")
+    return ok
+
+def round_trip(store):
+    rows = {
+        1: {"state": "WAITING_FOR_IMAGE", "last_activity": time.time(), "additional_params": {"seed": 7}},
+        2: {"state": "IDLE", "last_activity": time.time()},
+    }
+    store.save_many(rows)
+    loaded = {user_id: store.load(user_id) for user_id in rows}
+    store.delete_many([1])
+    return loaded == rows and store.load(1) is None and store.load(2) == rows[2] and store.load(3) is None
+
+async def write_behind(url):
+    manager = UserStateManager(timedelta(minutes=30), store=RedisSessionStore(url, ttl=60), flush_interval=0.05)
+    manager.start_write_behind()
+    manager.set_user_state(1, UserState.WAITING_FOR_CONTROLNET_PROMPT, controlnet_type="canny", image_url="u")
+    manager.set_user_state(2, UserState.WAITING_FOR_IMAGE)
+    await asyncio.sleep(0.3)
+    manager.reset_user_state(2)
+    await manager.close()
+
+    restarted = UserStateManager(timedelta(minutes=30), store=RedisSessionStore(url, ttl=60))
+    await restarted.load_user_session(1)
+    await restarted.load_user_session(2)
+    first = restarted.get_user_session(1)
+    second = restarted.get_user_session(2)
+    await restarted.close()
+    return (
+        first.state == UserState.WAITING_FOR_CONTROLNET_PROMPT and first.controlnet_type == "canny"
+        and first.image_url == "u" and second.state == UserState.IDLE
+    )
+
+async def loop_lag_while_loading(url, users):
+    """Largest delay of a 10 ms ticker while sessions load from the server"""
+    manager = UserStateManager(timedelta(minutes=30), store=RedisSessionStore(url, ttl=60))
+    worst = 0.0
+    loading = True
+
+    async def ticker():
+        nonlocal worst
+        while loading:
+            started = time.perf_counter()
+            await asyncio.sleep(0.01)
+            worst = max(worst, time.perf_counter() - started - 0.01)
+
+    tick = asyncio.create_task(ticker())
+    started = time.perf_counter()
+    await asyncio.gather(*(manager.load_user_session(user_id) for user_id in range(100, 100 + users)))
+    elapsed = time.perf_counter() - started
+    loading = False
+    await tick
+    await manager.close()
+    return worst, elapsed
+
+async def run(args):
+    redis = await FakeRedis().start()
+    url = f"redis://127.0.0.1:{redis.port}/1"
+    results = []
+    try:
+        store = RedisSessionStore(url, ttl=60)
+        results.append(check("redis round trip", await asyncio.to_thread(round_trip, store)))
+        store.close()
+        with tempfile.TemporaryDirectory() as directory:
+            store = SQLiteSessionStore(os.path.join(directory, "sessions.db"))
+            results.append(check("sqlite round trip", round_trip(store)))
+            store.close()
+        results.append(check("redis write-behind and reload", await write_behind(url)))
+
+        redis.latency_ms = args.latency_ms
+        worst, elapsed = await loop_lag_while_loading(url, args.users)
+        results.append(check(
+            "event loop keeps running during loads", worst < args.latency_ms / 2000,
+            f"{args.users} loads at {args.latency_ms:.0f} ms took {elapsed:.2f}s, worst loop lag {worst * 1000:.1f} ms"
+        ))
+        serial = args.users * args.latency_ms / 1000
+        results.append(check(
+            "sessions load in parallel", elapsed < serial / 2,
+            f"{elapsed:.2f}s against {serial:.2f}s one at a time"
+        ))
+    finally:
+        await redis.stop()
+    return all(results)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--latency-ms", type=float, default=100, help="delay of every Redis reply")
+    parser.add_argument("--users", type=int, default=20, help="sessions loaded in the event loop check")
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    sys.exit(0 if asyncio.run(run(args)) else 1)
+
+if __name__ == "__main__":
+    main()
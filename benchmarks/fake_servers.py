@@ -0,0 +1,356 @@
+"""
+Local stand-ins for the Telegram Bot API and fal.ai used by the load test.
+
+FakeTelegram serves the Bot API methods the bot uses (getUpdates with long
+polling, sendMessage, editMessageText, deleteMessage, sendPhoto,
+sendMediaGroup, getFile and file downloads) and lets the load driver inject
+updates and wait for the bot's outgoing requests. FakeFal serves the fal
+queue API (submit, status, result) and the CDN upload with configurable
+latency and failure rates. Both run on the bot's own http_server.
+FakeRedis speaks enough of the Redis protocol (RESP2) for the session store.
+"""
+import asyncio
+import base64
+import itertools
+import json
+import math
+import random
+import time
+import uuid
+from urllib.parse import parse_qs
+
+from http_server import HttpResponse
+
+# A small grayscale JPEG with two shapes; the load driver makes it unique per
+# user by appending bytes after the end-of-image marker, which decoders ignore
+SAMPLE_JPEG = base64.b64decode(
+    "/9j/4AAQSkZJRgABAQAAAQABAAD/2wBDAA0JCgsKCA0LCgsODg0PEyAVExISEyccHhcgLikxMC4pLSwz"
+    "Oko+MzZGNywtQFdBRkxOUlNSMj5aYVpQYEpRUk//wAALCAAwAEABAREA/8QAHwAAAQUBAQEBAQEAAAAA"
+    "AAAAAAECAwQFBgcICQoL/8QAtRAAAgEDAwIEAwUFBAQAAAF9AQIDAAQRBRIhMUEGE1FhByJxFDKBkaEI"
+    "I0KxwRVS0fAkM2JyggkKFhcYGRolJicoKSo0NTY3ODk6Q0RFRkdISUpTVFVWV1hZWmNkZWZnaGlqc3R1"
+    "dnd4eXqDhIWGh4iJipKTlJWWl5iZmqKjpKWmp6ipqrKztLW2t7i5usLDxMXGx8jJytLT1NXW19jZ2uHi"
+    "4+Tl5ufo6erx8vP09fb3+Pn6/9oACAEBAAA/APTqKKKKq6lqFppVhJfX8vlW8WN77S2MkAcAE9SKwv8A"
+    "hYPhT/oK/wDkvL/8TWxo+s6frdq11pdx58KOY2bYy4YAHGGAPQir9YfiXxEmiRxxxxLNcyglVLYCD1I6"
+    "9e3fB54rzu+1S/1Ek3t3LKCQdpOFBAxkKOB+VMs7+7sJN9ncywkkE7GwGx0yOh/Gu88LeJzqkgsrxFW5"
+    "VMiQEAS468djjnj0PSj4k/8AIial/wBsv/RqV09cx4H/AOZh/wCw3c/+y109eP6venUdVubsliJXJXcA"
+    "CF6KDj0AFU6Kkgmkt5454W2yRsHQ4zgg5Fd54/nS6+HN5cxhgkyQuobqAZEPNdZXMeB/+Zh/7Ddz/wCy"
+    "109eOahaPYahPaPuJhcrkrt3Dsce4wfxqtRTkR5JFjjVndiAqqMkk9gK7zx3b/ZPhtdW2/f5MUEe7GM4"
+    "kQZxXXVzHgf/AJmH/sN3P/stdPXMeLPDT6oVu7ARLcqCJAePNGOOemRjHPr14rz6aGW3laKeJ4pF6o6l"
+    "SPwNNRHkkWONWd2ICqoyST2AruPCfheW3nTUdSjQELuihYEsjZ+8fQgdBz17EVb+JP8AyImpf9sv/RqV"
+    "09cx4H/5mH/sN3P/ALLXT0VFcW1vdRiO6gimQHIWRAwB9cGm21na2m77LbQwb8bvLjC5x0zip6oa3pVv"
+    "rekz6bdvKkM23c0RAYYYMMZBHUelY/8Awhv/AFM/iT/wP/8Asa1NA0O30G1mgt7i5n8+dp5JLhwzs7AA"
+    "nIA9K//Z"
+)
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+
+def _json_response(result, ok=True, status=200):
+    return HttpResponse(status, json.dumps({"ok": ok, "result": result}), "application/json")
+
+def _parse_form(body):
+    params = {}
+    for name, values in parse_qs(body.decode("utf-8"), keep_blank_values=True).items():
+        value = values[0]
+        try:
+            params[name] = json.loads(value)
+        except ValueError:
+            params[name] = value
+    return params
+
+class FakeTelegram:
+    """An in-process Bot API server recording everything the bot sends"""
+
+    def __init__(self):
+        self.files = {}
+        self.requests = 0
+        self._updates = []
+        self._new_updates = asyncio.Event()
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._waiters = {}
+
+    # -- Driver side -----------------------------------------------------
+
+    def add_file(self, file_id, data):
+        self.files[file_id] = data
+
+    def push_update(self, update):
+        update["update_id"] = next(self._update_ids)
+        self._updates.append(update)
+        self._new_updates.set()
+
+    def expect(self, chat_id, predicate):
+        """
+        Register interest in an outgoing request to a chat
+
+        Call before pushing the update that triggers it.
+
+        Returns:
+            asyncio.Future: Resolves to (method, params) of the first match
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(chat_id, []).append((predicate, future))
+        return future
+
+    def _record(self, method, params):
+        chat_id = params.get("chat_id")
+        waiters = self._waiters.get(chat_id)
+        if not waiters:
+            return
+        for waiter in list(waiters):
+            predicate, future = waiter
+            if future.done():
+                waiters.remove(waiter)
+            elif predicate(method, params):
+                future.set_result((method, params))
+                waiters.remove(waiter)
+
+    # -- Bot API side ----------------------------------------------------
+
+    def _message(self, chat_id, **fields):
+        message = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "group"},
+            "from": BOT_USER,
+        }
+        message.update(fields)
+        return message
+
+    def _photo(self):
+        file_id = f"sent-{uuid.uuid4().hex}"
+        return [{"file_id": file_id, "file_unique_id": file_id, "width": 1024, "height": 768}]
+
+    async def handle(self, request):
+        self.requests += 1
+        parts = request.path.split("/")
+        if len(parts) >= 4 and parts[1] == "file":
+            data = self.files.get(parts[-1].rsplit(".", 1)[0])
+            if data is None:
+                return HttpResponse(404, "Not found")
+            return HttpResponse(200, data, "image/jpeg")
+        if len(parts) != 3 or not parts[1].startswith("bot"):
+            return HttpResponse(404, "Not found")
+
+        method = parts[2]
+        params = _parse_form(request.body) if request.body else {}
+        self._record(method, params)
+        chat_id = params.get("chat_id")
+
+        if method == "getUpdates":
+            return _json_response(await self._get_updates(params))
+        if method == "getMe":
+            return _json_response(BOT_USER)
+        if method == "sendMessage":
+            return _json_response(self._message(chat_id, text=params.get("text", "")))
+        if method == "editMessageText":
+            return _json_response(
+                self._message(chat_id, text=params.get("text", ""), message_id=params.get("message_id"))
+            )
+        if method == "sendPhoto":
+            return _json_response(self._message(chat_id, photo=self._photo()))
+        if method == "sendMediaGroup":
+            return _json_response([self._message(chat_id, photo=self._photo()) for _ in params.get("media", [])])
+        if method == "getFile":
+            file_id = params["file_id"]
+            data = self.files.get(file_id, SAMPLE_JPEG)
+            return _json_response({
+                "file_id": file_id,
+                "file_unique_id": file_id,
+                "file_size": len(data),
+                "file_path": f"photos/{file_id}.jpg",
+            })
+        # deleteMessage, answerCallbackQuery, deleteWebhook, ...
+        return _json_response(True)
+
+    async def _get_updates(self, params):
+        offset = int(params.get("offset") or 0)
+        self._updates = [update for update in self._updates if update["update_id"] >= offset]
+        if not self._updates:
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), float(params.get("timeout") or 0))
+            except asyncio.TimeoutError:
+                pass
+        limit = int(params.get("limit") or 100)
+        return self._updates[:limit]
+
+class FakeFal:
+    """
+    An in-process fal queue and CDN
+
+    Each submitted request waits in the queue for an exponentially
+    distributed time (mean ``queue_ms``) and then runs for a log-normally
+    distributed time (median ``inference_ms``, shape ``jitter``).
+    A ``failure_rate`` share of submissions is rejected with a 503.
+    """
+
+    def __init__(self, base_url, queue_ms=200, inference_ms=2000, jitter=0.4, failure_rate=0.0):
+        self.base_url = base_url
+        self.queue_ms = queue_ms
+        self.inference_ms = inference_ms
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.submitted = 0
+        self.failed = 0
+        self.uploads = 0
+        self._requests = {}
+
+    def _sample(self):
+        queue = random.expovariate(1000 / self.queue_ms) if self.queue_ms > 0 else 0.0
+        inference = random.lognormvariate(math.log(self.inference_ms / 1000), self.jitter)
+        return queue, inference
+
+    async def handle(self, request):
+        path = request.path
+        if path.startswith("/cdn/files/upload"):
+            self.uploads += 1
+            return HttpResponse(
+                200,
+                json.dumps({"access_url": f"{self.base_url}/cdn/files/{uuid.uuid4().hex}.jpg"}),
+                "application/json"
+            )
+        if not path.startswith("/queue/"):
+            return HttpResponse(404, "Not found")
+
+        if "/requests/" not in path:
+            return self._submit(path[len("/queue/"):], request)
+        app, _, rest = path[len("/queue/"):].partition("/requests/")
+        request_id, _, action = rest.partition("/")
+        entry = self._requests.get(request_id)
+        if entry is None:
+            return HttpResponse(404, json.dumps({"detail": "Request not found"}), "application/json")
+        if action == "status":
+            return HttpResponse(200, json.dumps(self._status(entry)), "application/json")
+        if action == "cancel":
+            return HttpResponse(200, json.dumps({"status": "CANCELLATION_REQUESTED"}), "application/json")
+        return HttpResponse(200, json.dumps(entry["result"]), "application/json")
+
+    def _submit(self, app, request):
+        self.submitted += 1
+        if random.random() < self.failure_rate:
+            self.failed += 1
+            return HttpResponse(503, json.dumps({"detail": "Service temporarily unavailable"}), "application/json")
+        arguments = json.loads(request.body or b"{}")
+        queue, inference = self._sample()
+        request_id = uuid.uuid4().hex
+        now = time.monotonic()
+        self._requests[request_id] = {
+            "started_at": now + queue,
+            "completed_at": now + queue + inference,
+            "result": {
+                "images": [
+                    {"url": f"{self.base_url}/cdn/files/{uuid.uuid4().hex}.jpg", "content_type": "image/jpeg"}
+                    for _ in range(int(arguments.get("num_images", 1)))
+                ],
+                "seed": arguments.get("seed", random.randrange(2 ** 31)),
+                "prompt": arguments.get("prompt", ""),
+            },
+        }
+        base = f"{self.base_url}/queue/{app}/requests/{request_id}"
+        return HttpResponse(200, json.dumps({
+            "request_id": request_id,
+            "response_url": base,
+            "status_url": f"{base}/status",
+            "cancel_url": f"{base}/cancel",
+        }), "application/json")
+
+    def _status(self, entry):
+        now = time.monotonic()
+        if now < entry["started_at"]:
+            # A rough position: the remaining wait in units of the mean wait
+            position = int((entry["started_at"] - now) * 1000 / self.queue_ms)
+            return {"status": "IN_QUEUE", "queue_position": position}
+        if now < entry["completed_at"]:
+            progress = (now - entry["started_at"]) / (entry["completed_at"] - entry["started_at"])
+            return {"status": "IN_PROGRESS", "logs": [{"message": f"Inference {progress:.0%}"}]}
+        return {"status": "COMPLETED", "logs": [], "metrics": {"inference_time": entry["completed_at"] - entry["started_at"]}}
+
+class FakeRedis:
+    """
+    An in-process server for the commands the Redis session store sends
+
+    Supports PING, AUTH, SELECT, GET, SET with EX, DEL and FLUSHDB on one
+    keyspace. Every command is answered after ``latency_ms``, which stands in
+    for a slow or distant server.
+    """
+
+    def __init__(self, latency_ms=0.0):
+        self.latency_ms = latency_ms
+        self.commands = 0
+        self._data = {}
+        self._server = None
+        self._connections = set()
+        self.port = None
+
+    async def start(self, host="127.0.0.1", port=0):
+        self._server = await asyncio.start_server(self._serve, host, port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            # Closing the sockets ends the connection handlers
+            for writer in list(self._connections):
+                writer.close()
+            while self._connections:
+                await asyncio.sleep(0)
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _serve(self, reader, writer):
+        self._connections.add(writer)
+        try:
+            while True:
+                command = await self._read_command(reader)
+                if command is None:
+                    break
+                self.commands += 1
+                if self.latency_ms:
+                    await asyncio.sleep(self.latency_ms / 1000)
+                writer.write(self._execute(command))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self._connections.discard(writer)
+            writer.close()
+
+    async def _read_command(self, reader):
+        line = await reader.readline()
+        if not line:
+            return None
+        if not line.startswith(b"*"):
+            # Inline command
+            return line.split()
+        args = []
+        for _ in range(int(line[1:-2])):
+            length = int((await reader.readline())[1:-2])
+            args.append((await reader.readexactly(length + 2))[:-2])
+        return args
+
+    def _execute(self, command):
+        name = command[0].decode("utf-8").upper()
+        args = command[1:]
+        now = time.monotonic()
+        if name in ("PING", "AUTH", "SELECT"):
+            return b"+PONG\r\n" if name == "PING" else b"+OK\r\n"
+        if name == "GET":
+            entry = self._data.get(args[0])
+            if entry is None or (entry[1] is not None and entry[1] <= now):
+                self._data.pop(args[0], None)
+                return b"$-1\r\n"
+            return b"$%d\r\n%s\r\n" % (len(entry[0]), entry[0])
+        if name == "SET":
+            expires = None
+            if len(args) >= 4 and args[2].upper() == b"EX":
+                expires = now + int(args[3])
+            self._data[args[0]] = (args[1], expires)
+            return b"+OK\r\n"
+        if name == "DEL":
+            return b":%d\r\n" % sum(self._data.pop(key, None) is not None for key in args)
+        if name == "FLUSHDB":
+            self._data.clear()
+            return b"+OK\r\n"
+        return b"-ERR unknown command '%s'\r\n" % command[0]
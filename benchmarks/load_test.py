@@ -0,0 +1,287 @@
+"""
+End-to-end load test of the bot against local fake Telegram and fal servers.
+
+Runs the real Application (handlers, update processor, scheduler, sender,
+fal wrapper) in polling mode, with the Bot API and fal.ai replaced by the
+servers in fake_servers.py, and drives it with many simulated users. Each
+user repeats one flow:
+
+    text        send a prompt, wait for the image
+    controlnet  /controlnet, upload a photo, pick canny, send a prompt
+    ipadapter   /ipadapter, upload a photo, send a prompt
+    mixed       a random one of the above per job
+
+The latency of a job runs from sending the prompt to receiving the image.
+The report gives p50/p95/p99 per flow, jobs/s, failures and the bot's own
+per-stage timings.
+
+Usage:
+    python benchmarks/load_test.py [--scenario mixed] [--users 100] [--jobs 3]
+        [--fal-queue-ms 200] [--fal-inference-ms 1000] [--fal-jitter 0.4]
+        [--fal-failure-rate 0] [--telegram-limits] [--json report.json]
+
+Set FAL_SUBMIT_MODE=queue to exercise the queue poller instead of subscribe.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from fake_servers import FakeFal, FakeTelegram, SAMPLE_JPEG
+from http_server import start_http_server
+
+TOKEN = "123456:benchmark"
+FLOWS = ("text", "controlnet", "ipadapter")
+
+def _is_result(method, params):
+    """The end of a job: its images, or an error edit"""
+    if method == "sendMediaGroup":
+        return True
+    if method == "sendPhoto":
+        # Not a control map preview or a quick preview of the final image
+        return not str(params.get("caption", "")).startswith(("🔍", "👀"))
+    text = str(params.get("text", ""))
+    if method == "sendMessage":
+        # Refused by admission control
+        return text.startswith("⏳")
+    return method == "editMessageText" and text.startswith(("Sorry", "⚠️"))
+
+def _user(user_id):
+    return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"}
+
+def _message(user_id, message_id, **fields):
+    message = {
+        "message_id": message_id,
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"},
+        "from": _user(user_id),
+    }
+    message.update(fields)
+    return message
+
+def _command(user_id, message_id, command):
+    return {"message": _message(
+        user_id, message_id, text=command,
+        entities=[{"type": "bot_command", "offset": 0, "length": len(command)}]
+    )}
+
+class SimulatedUser:
+    def __init__(self, user_id, telegram, timeout):
+        self.user_id = user_id
+        self.telegram = telegram
+        self.timeout = timeout
+        self.message_ids = iter(range(1, 1 << 30))
+        self.file_id = f"photo-{user_id}"
+        telegram.add_file(self.file_id, SAMPLE_JPEG + user_id.to_bytes(8, "big"))
+
+    async def _send(self, update, predicate):
+        """Push an update and wait for the bot's matching request"""
+        expected = self.telegram.expect(self.user_id, predicate)
+        self.telegram.push_update(update)
+        return await asyncio.wait_for(expected, self.timeout)
+
+    async def _send_photo(self, predicate):
+        photo = [{
+            "file_id": self.file_id,
+            "file_unique_id": self.file_id,
+            "width": 64,
+            "height": 48,
+            "file_size": len(SAMPLE_JPEG) + 8,
+        }]
+        return await self._send(
+            {"message": _message(self.user_id, next(self.message_ids), photo=photo)},
+            predicate
+        )
+
+    async def _prompt(self, prompt):
+        """Send a prompt; returns (latency, succeeded)"""
+        started = time.perf_counter()
+        method, _ = await self._send(
+            {"message": _message(self.user_id, next(self.message_ids), text=prompt)},
+            _is_result
+        )
+        return time.perf_counter() - started, method not in ("editMessageText", "sendMessage")
+
+    async def text(self):
+        return await self._prompt(f"a lighthouse at dusk, user {self.user_id}")
+
+    async def controlnet(self):
+        await self._send(
+            _command(self.user_id, next(self.message_ids), "/controlnet"),
+            lambda method, params: method == "sendMessage"
+        )
+        _, params = await self._send_photo(
+            lambda method, params: method == "editMessageText" and "reply_markup" in params
+        )
+        callback = {"callback_query": {
+            "id": f"cb-{self.user_id}-{next(self.message_ids)}",
+            "from": _user(self.user_id),
+            "chat_instance": str(self.user_id),
+            "data": "controlnet_canny",
+            "message": _message(self.user_id, params["message_id"], text=params["text"]),
+        }}
+        await self._send(callback, lambda method, params: method == "editMessageText")
+        return await self._prompt("a watercolor city street --steps 20")
+
+    async def ipadapter(self):
+        await self._send(
+            _command(self.user_id, next(self.message_ids), "/ipadapter"),
+            lambda method, params: method == "sendMessage"
+        )
+        await self._send_photo(
+            lambda method, params: method == "editMessageText" and "uploaded" in str(params.get("text", ""))
+        )
+        return await self._prompt("the same scene in winter")
+
+    async def run(self, scenario, jobs, results):
+        for _ in range(jobs):
+            flow = random.choice(FLOWS) if scenario == "mixed" else scenario
+            try:
+                latency, succeeded = await getattr(self, flow)()
+            except asyncio.TimeoutError:
+                results.append((flow, None, False))
+                continue
+            results.append((flow, latency, succeeded))
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return float("nan")
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+async def run_load_test(args):
+    telegram = FakeTelegram()
+    telegram_server = await start_http_server(telegram.handle, "127.0.0.1", 0)
+    telegram_url = f"http://127.0.0.1:{telegram_server.sockets[0].getsockname()[1]}"
+
+    fal_server = await start_http_server(lambda request: fal.handle(request), "127.0.0.1", 0)
+    fal_url = f"http://127.0.0.1:{fal_server.sockets[0].getsockname()[1]}"
+    fal = FakeFal(fal_url, args.fal_queue_ms, args.fal_inference_ms, args.fal_jitter, args.fal_failure_rate)
+
+    # Configure the bot before its modules read the environment
+    workdir = tempfile.mkdtemp(prefix="bot-bench-")
+    os.environ.update({
+        "TELEGRAM_BOT_TOKEN": TOKEN,
+        "FAL_KEY": "benchmark",
+        "TELEGRAM_BASE_URL": f"{telegram_url}/bot",
+        "TELEGRAM_BASE_FILE_URL": f"{telegram_url}/file/bot",
+        "METRICS_PORT": "0",
+        "JOB_JOURNAL_PATH": os.path.join(workdir, "jobs.journal"),
+    })
+    if not args.telegram_limits:
+        os.environ.update({"TELEGRAM_GLOBAL_RATE": "100000", "TELEGRAM_CHAT_RATE": "1000"})
+    if not args.admission:
+        os.environ.update({
+            "ADMISSION_MAX_PENDING": "0", "ADMISSION_MAX_WAIT": "0",
+            "ADMISSION_USER_PER_MINUTE": "0", "ADMISSION_CHAT_PER_MINUTE": "0",
+        })
+    os.chdir(workdir)
+
+    import fal_client.client
+    fal_client.client.QUEUE_URL_FORMAT = f"{fal_url}/queue/"
+    fal_client.client.RUN_URL_FORMAT = f"{fal_url}/run/"
+    fal_client.client.CDN_URL = f"{fal_url}/cdn"
+
+    import main
+    from metrics import stage_seconds
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+
+    application = main.build_application()
+    results = []
+    async with application:
+        await main.post_init(application)
+        await application.start()
+        await application.updater.start_polling(poll_interval=0, timeout=5)
+
+        users = [SimulatedUser(1000 + index, telegram, args.timeout) for index in range(args.users)]
+        started = time.perf_counter()
+        await asyncio.gather(*(user.run(args.scenario, args.jobs, results) for user in users))
+        elapsed = time.perf_counter() - started
+
+        await application.updater.stop()
+        await application.stop()
+        await main.post_shutdown(application)
+
+    telegram_server.close()
+    fal_server.close()
+    return build_report(args, results, elapsed, telegram, fal, stage_seconds.snapshot())
+
+def build_report(args, results, elapsed, telegram, fal, stages):
+    report = {
+        "scenario": args.scenario,
+        "users": args.users,
+        "jobs": len(results),
+        "seconds": round(elapsed, 3),
+        "jobs_per_second": round(sum(1 for _, _, ok in results if ok) / elapsed, 2),
+        "fal_submitted": fal.submitted,
+        "fal_rejected": fal.failed,
+        "telegram_requests": telegram.requests,
+        "flows": {},
+        "stages": {
+            labels[0]: {"count": count, "mean_ms": round(total / count * 1000, 1)}
+            for labels, (count, total) in stages.items() if count
+        },
+    }
+    for flow in FLOWS:
+        latencies = sorted(latency for name, latency, ok in results if name == flow and ok)
+        failures = sum(1 for name, _, ok in results if name == flow and not ok)
+        if not latencies and not failures:
+            continue
+        report["flows"][flow] = {
+            "completed": len(latencies),
+            "failed": failures,
+            "p50_ms": round(percentile(latencies, 0.50) * 1000, 1),
+            "p95_ms": round(percentile(latencies, 0.95) * 1000, 1),
+            "p99_ms": round(percentile(latencies, 0.99) * 1000, 1),
+        }
+    return report
+
+def print_report(report):
+    print(f"{report['scenario']}: {report['jobs']} jobs from {report['users']} users "
+          f"in {report['seconds']}s = {report['jobs_per_second']} jobs/s")
+    print(f"fal submissions: {report['fal_submitted']} ({report['fal_rejected']} rejected), "
+          f"Telegram requests: {report['telegram_requests']}")
+    print(f"{'flow':<12}{'done':>8}{'failed':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for flow, stats in report["flows"].items():
+        print(f"{flow:<12}{stats['completed']:>8}{stats['failed']:>8}"
+              f"{stats['p50_ms']:>10}{stats['p95_ms']:>10}{stats['p99_ms']:>10}")
+    print(f"{'stage':<16}{'count':>8}{'mean ms':>10}")
+    for stage, stats in report["stages"].items():
+        print(f"{stage:<16}{stats['count']:>8}{stats['mean_ms']:>10}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--scenario", choices=FLOWS + ("mixed",), default="mixed")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--jobs", type=int, default=3, help="jobs per user")
+    parser.add_argument("--fal-queue-ms", type=float, default=200)
+    parser.add_argument("--fal-inference-ms", type=float, default=1000)
+    parser.add_argument("--fal-jitter", type=float, default=0.4)
+    parser.add_argument("--fal-failure-rate", type=float, default=0.0)
+    parser.add_argument("--telegram-limits", action="store_true",
+                        help="keep the production Telegram rate limits")
+    parser.add_argument("--admission", action="store_true",
+                        help="keep the admission limits; refused jobs count as failed")
+    parser.add_argument("--timeout", type=float, default=120, help="seconds before a job counts as lost")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--verbose", action="store_true", help="keep the bot's info logs")
+    parser.add_argument("--json", help="also write the report to this file")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    report = asyncio.run(run_load_test(args))
+    print_report(report)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -1,52 +1,78 @@
 import os
+import asyncio
+import hashlib
 import logging
-import re
+import mimetypes
+import random
 import uuid
-from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
+from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton, InputMediaPhoto
 from telegram.ext import ContextTypes
 from config import (
     HELP_MESSAGE, MAX_PROMPT_LENGTH, TEMP_DIRECTORY, 
-    CONTROLNET_MODELS, CANCEL_MESSAGE
+    CONTROLNET_MODELS, CANCEL_MESSAGE, PRIORITY_USER_IDS, IMAGE_SPOOL_THRESHOLD,
+    DEFAULT_PARAMS, PREVIEW_MODE, PREVIEW_STEPS, PREVIEW_SCALE, PREVIEW_FINALIZE_TTL
 )
 from fal_client_wrapper import (
-    generate_image, upload_image, 
-    generate_with_controlnet, generate_with_ip_adapter
+    generate_image, upload_image, upload_image_bytes,
+    generate_with_controlnet, generate_with_ip_adapter, wait_for_queued_result,
+    upstream_unavailable
 )
+from resilience import UpstreamUnavailableError
+from admission import admission
+from prompt_params import (
+    ParameterError, parse_additional_parameters, CONTROLNET_PARAMETERS, IP_ADAPTER_PARAMETERS,
+    TEXT_PARAMETERS, IMAGE_SIZE_DIMENSIONS
+)
+from cache import LRUCache, result_cache, upload_cache
+from job_journal import job_journal
+from progress import StatusMessage
+from image_preprocess import select_photo_size, prepare_image
+from control_maps import control_map_store
+from metrics import track_stage
+from telegram_sender import (
+    SendPriority, reply_text, edit_text, edit_message_text, edit_reply_markup, delete_message,
+    send_photo, send_media_group
+)
+from job_scheduler import Priority, generation_scheduler
 from user_state import UserState, state_manager
 
 logger = logging.getLogger(__name__)
 
+# Telegram accepts at most this many photos in one album
+MEDIA_GROUP_LIMIT = 10
+
+async def load_session(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Runs before the other handlers: loads the user's session from the session store"""
+    if update.effective_user is not None:
+        await state_manager.load_user_session(update.effective_user.id)
+
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handler for /start command"""
     user = update.effective_user
-    logger.info(f"User {user.id} started the bot")
+    logger.info("User %s started the bot", user.id)
     
     # Reset user state
     state_manager.reset_user_state(user.id)
     
     welcome_message = f"Hello {user.first_name}! I'm an AI Image Generation Bot. I can create images from text or transform your images.\n\nUse /help to learn more."
-    await update.message.reply_text(welcome_message)
+    await reply_text(update.message, welcome_message)
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handler for /help command"""
-    await update.message.reply_text(HELP_MESSAGE, parse_mode="Markdown")
+    await reply_text(update.message, HELP_MESSAGE, parse_mode="Markdown")
 
 async def cancel_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handler to cancel the current operation"""
     user = update.effective_user
-    logger.info(f"User {user.id} cancelled current operation")
+    logger.info("User %s cancelled current operation", user.id)
     
-    session = state_manager.reset_user_state(user.id)
+    # Resetting the state also removes any temporary files
+    state_manager.reset_user_state(user.id)
     
-    # Clean up any temporary files
-    if session.image_path and os.path.exists(session.image_path):
-        try:
-            os.remove(session.image_path)
-            logger.info(f"Removed temporary file: {session.image_path}")
-        except Exception as e:
-            logger.error(f"Failed to remove temporary file {session.image_path}: {str(e)}")
+    # Drop any generations still waiting in the queue
+    generation_scheduler.cancel_pending(user.id)
     
-    await update.message.reply_text(CANCEL_MESSAGE)
+    await reply_text(update.message, CANCEL_MESSAGE)
 
 async def generate_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handler for /generate command"""
@@ -60,23 +86,29 @@ async def generate_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text_after_command = full_text.split('/generate', 1)[1].strip()
     
     if not text_after_command:
-        await update.message.reply_text("Please provide a prompt after /generate. For example: /generate a sunset over mountains")
+        await reply_text(update.message, "Please provide a prompt after /generate. For example: /generate a sunset over mountains")
         return
     
     # Parse any additional parameters
-    prompt, params = parse_additional_parameters(text_after_command)
+    try:
+        prompt, params = parse_additional_parameters(text_after_command, extra=TEXT_PARAMETERS)
+    except ParameterError as e:
+        await reply_text(update.message, str(e))
+        return
     
     await process_prompt(update, prompt, params)
 
 async def controlnet_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handler for /controlnet command - starts the ControlNet image-to-image flow"""
     user = update.effective_user
-    logger.info(f"User {user.id} started ControlNet flow")
+    logger.info("User %s started ControlNet flow", user.id)
     
-    # Set user state to wait for image upload
-    state_manager.set_user_state(user.id, UserState.WAITING_FOR_IMAGE)
+    # Set user state to wait for image upload; an unfinished IP-Adapter flow
+    # may have left its flag behind
+    state_manager.set_user_state(user.id, UserState.WAITING_FOR_IMAGE, is_ip_adapter=False)
     
-    await update.message.reply_text(
+    await reply_text(
+        update.message,
         "Please upload an image to use with ControlNet. "
         "This image will be used as a reference for generating a new image. "
         "After uploading, you'll select a ControlNet mode and provide a prompt.\n\n"
@@ -86,13 +118,14 @@ async def controlnet_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
 async def ipadapter_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handler for /ipadapter command - starts the IP-Adapter image-to-image flow"""
     user = update.effective_user
-    logger.info(f"User {user.id} started IP-Adapter flow")
+    logger.info("User %s started IP-Adapter flow", user.id)
     
     # Set user state to wait for image upload
     state_manager.set_user_state(user.id, UserState.WAITING_FOR_IMAGE, 
                                 is_ip_adapter=True)
     
-    await update.message.reply_text(
+    await reply_text(
+        update.message,
         "Please upload an image to use with IP-Adapter. "
         "IP-Adapter will use the style and content of your image to influence the generation. "
         "After uploading, you'll provide a prompt.\n\n"
@@ -118,61 +151,55 @@ async def text_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await handle_ipadapter_prompt(update, text)
     else:
         # Treat as a normal text-to-image prompt
-        prompt, params = parse_additional_parameters(text)
+        try:
+            prompt, params = parse_additional_parameters(text, extra=TEXT_PARAMETERS)
+        except ParameterError as e:
+            await reply_text(update.message, str(e))
+            return
         await process_prompt(update, prompt, params)
 
 async def photo_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handler for photos"""
     user = update.effective_user
-    logger.info(f"User {user.id} sent a photo")
+    logger.info("User %s sent a photo", user.id)
     
     # Get current user state
     session = state_manager.get_user_session(user.id)
     
     # Check if we're expecting an image
     if session.state != UserState.WAITING_FOR_IMAGE:
-        await update.message.reply_text(
+        await reply_text(
+            update.message,
             "I noticed you sent an image, but I wasn't expecting one. "
             "If you want to use image-to-image generation, use /controlnet or /ipadapter first."
         )
         return
     
-    # Get the photo with the highest resolution
-    photo = update.message.photo[-1]
-    file_id = photo.file_id
+    # The models resize the image anyway, so the smallest adequate size will do
+    photo = select_photo_size(update.message.photo)
     
     # Send a temporary message to indicate processing
-    message = await update.message.reply_text("📥 Downloading your image...")
+    message = await reply_text(update.message, "📥 Downloading your image...")
     
     try:
-        # Download the file
-        file = await context.bot.get_file(file_id)
-        file_extension = os.path.splitext(file.file_path)[1] or ".jpg"
-        temp_file_path = os.path.join(TEMP_DIRECTORY, f"{uuid.uuid4()}{file_extension}")
-        await file.download_to_drive(temp_file_path)
-        
-        # Update message
-        await message.edit_text("🚀 Uploading to server...")
-        
-        # Upload the image to fal.ai
-        image_url = await upload_image(temp_file_path)
+        image_url = await _ingest_photo(context, photo, message, keep_source=not session.is_ip_adapter)
         
-        # Store the image URL and path in user session
-        if hasattr(session, 'is_ip_adapter') and session.is_ip_adapter:
+        # Store the image URL in user session
+        if session.is_ip_adapter:
             # For IP-Adapter flow
             state_manager.set_user_state(user.id, UserState.WAITING_FOR_IPADAPTER_PROMPT, 
-                                       image_url=image_url, 
-                                       image_path=temp_file_path)
+                                       image_url=image_url)
             
-            await message.edit_text(
+            await edit_text(
+                message,
                 "✅ Image uploaded successfully!\n\n"
-                "Now, please provide a prompt to guide the generation using the style and content of your image."
+                "Now, please provide a prompt to guide the generation using the style and content of your image.",
+                priority=SendPriority.REPLY
             )
         else:
             # For ControlNet flow
             state_manager.set_user_state(user.id, UserState.WAITING_FOR_CONTROLNET_TYPE, 
-                                       image_url=image_url, 
-                                       image_path=temp_file_path)
+                                       image_url=image_url)
             
             # Create keyboard for ControlNet types
             keyboard = [
@@ -187,71 +214,166 @@ async def photo_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 [InlineKeyboardButton("Cancel", callback_data="controlnet_cancel")]
             ]
             
-            await message.edit_text(
+            await edit_text(
+                message,
                 "✅ Image uploaded successfully!\n\n"
                 "Now, please select a ControlNet type:",
+                priority=SendPriority.REPLY,
                 reply_markup=InlineKeyboardMarkup(keyboard)
             )
             
     except Exception as e:
-        logger.error(f"Error processing image from user {user.id}: {str(e)}")
-        await message.edit_text(f"Sorry, there was an error processing your image: {str(e)}")
+        logger.error("Error processing image from user %s: %s", user.id, e)
+        await edit_text(
+            message,
+            f"Sorry, there was an error processing your image: {str(e)}",
+            SendPriority.REPLY
+        )
         
         # Reset user state
         state_manager.reset_user_state(user.id)
 
+async def _ingest_photo(context: ContextTypes.DEFAULT_TYPE, photo, message, keep_source=False):
+    """
+    Get a fal storage URL for a Telegram photo
+    
+    Photos are downloaded into memory and uploaded straight from the buffer;
+    only files above IMAGE_SPOOL_THRESHOLD are spooled through TEMP_DIRECTORY,
+    and the spooled file is removed as soon as the upload is done. With
+    ``keep_source`` the uploaded bytes are kept for building control maps.
+    """
+    # A re-forwarded photo needs neither a download nor an upload
+    image_url = upload_cache.get_by_file_id(photo.file_unique_id)
+    if image_url:
+        logger.info("Reusing uploaded image for file %s", photo.file_unique_id)
+        return image_url
+    
+    temp_file_path = None
+    try:
+        with track_stage("download"):
+            # Download the file
+            file = await context.bot.get_file(photo.file_id)
+            file_extension = os.path.splitext(file.file_path)[1] or ".jpg"
+            content_type = mimetypes.types_map.get(file_extension.lower(), "image/jpeg")
+            file_size = file.file_size or photo.file_size or 0
+            
+            if file_size > IMAGE_SPOOL_THRESHOLD:
+                temp_file_path = os.path.join(TEMP_DIRECTORY, f"{uuid.uuid4()}{file_extension}")
+                await file.download_to_drive(temp_file_path)
+                digest = _file_digest(temp_file_path)
+                data = None
+            else:
+                data = bytes(await file.download_as_bytearray())
+                digest = upload_cache.digest(data)
+        
+        # The same picture may already be uploaded under another file
+        image_url = upload_cache.get_by_digest(digest)
+        if image_url:
+            logger.info("Reusing uploaded image with digest %s", digest[:12])
+            upload_cache.link_file_id(photo.file_unique_id, digest)
+            return image_url
+        
+        # Update message
+        await edit_text(message, "🚀 Uploading to server...")
+        
+        # Upload the image to fal.ai
+        if data is not None:
+            with track_stage("preprocess"):
+                data, content_type = await prepare_image(data, content_type, photo.width, photo.height)
+            image_url = await upload_image_bytes(data, content_type)
+            if keep_source:
+                control_map_store.add_source(image_url, data)
+        else:
+            image_url = await upload_image(temp_file_path)
+        upload_cache.put(digest, image_url, photo.file_unique_id)
+        return image_url
+    finally:
+        if temp_file_path and os.path.exists(temp_file_path):
+            os.remove(temp_file_path)
+
+def _file_digest(path):
+    """SHA-256 of a file, read in chunks"""
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
 async def handle_controlnet_prompt(update: Update, prompt):
     """Process ControlNet prompt and generate image"""
     user = update.effective_user
     session = state_manager.get_user_session(user.id)
     
     if len(prompt) > MAX_PROMPT_LENGTH:
-        await update.message.reply_text(f"Your prompt is too long. Please limit it to {MAX_PROMPT_LENGTH} characters.")
+        await reply_text(update.message, f"Your prompt is too long. Please limit it to {MAX_PROMPT_LENGTH} characters.")
         return
     
-    # Send a temporary message to indicate processing
-    message = await update.message.reply_text("🎨 Generating your image with ControlNet, please wait...")
-    
+    # Validate the parameters before anything is sent; the user may fix the
+    # prompt and send it again
     try:
-        # Extract any additional parameters
-        parsed_prompt, params = parse_additional_parameters(prompt)
-        
-        # Generate the image with ControlNet
-        result = await generate_with_controlnet(
-            parsed_prompt, 
-            session.image_url, 
-            session.controlnet_type,
-            **params
+        parsed_prompt, params = parse_additional_parameters(prompt, extra=CONTROLNET_PARAMETERS)
+    except ParameterError as e:
+        await reply_text(update.message, str(e))
+        return
+    
+    # Refused requests keep the session, so the prompt can be sent again later
+    if not await _admit(update):
+        return
+    
+    # Capture the session data the job needs, then free the user for a new flow
+    image_url = session.image_url
+    controlnet_type = session.controlnet_type
+    state_manager.reset_user_state(user.id)
+    
+    # Send a temporary message to indicate processing
+    status_text = "🎨 Generating your image with ControlNet, please wait..."
+    message = await reply_text(update.message, status_text)
+    status = StatusMessage(message, status_text)
+    
+    async def run():
+        caption = (
+            f"🖼️ Generated with ControlNet ({controlnet_type}) from your image and prompt:\n\n"
+            f"{parsed_prompt[:100]}{'...' if len(parsed_prompt) > 100 else ''}"
         )
-        
-        if not result or not result.get("images") or len(result["images"]) == 0:
-            await message.edit_text("Sorry, I couldn't generate an image. Please try again with a different prompt or image.")
-            return
-        
-        # Get the first image URL
-        image_url = result["images"][0]["url"]
-        
-        # Send the image
-        await update.message.reply_photo(
-            photo=image_url,
-            caption=(
-                f"🖼️ Generated with ControlNet ({session.controlnet_type}) from your image and prompt:\n\n"
-                f"{parsed_prompt[:100]}{'...' if len(parsed_prompt) > 100 else ''}"
+        on_enqueue, journal_done = _journal_delivery(update, message, caption)
+        try:
+            # Usually built while the user was typing the prompt
+            control_image_url = await control_map_store.resolve(image_url, controlnet_type)
+            
+            # Generate the image with ControlNet
+            result = await generate_with_controlnet(
+                parsed_prompt, 
+                control_image_url, 
+                controlnet_type,
+                on_enqueue=on_enqueue,
+                on_progress=status.on_progress,
+                **params
             )
-        )
-        
-        # Delete the temporary message
-        await message.delete()
-        
-        # Reset user state
-        state_manager.reset_user_state(user.id)
-        
-    except Exception as e:
-        logger.error(f"Error in ControlNet image generation: {str(e)}")
-        await message.edit_text(f"Sorry, an error occurred while generating the image: {str(e)}")
-        
-        # Reset user state
-        state_manager.reset_user_state(user.id)
+            
+            if not result or not result.get("images") or len(result["images"]) == 0:
+                await status.finish("Sorry, I couldn't generate an image. Please try again with a different prompt or image.")
+                return
+            
+            # Send all generated images
+            await deliver_images(
+                update.get_bot(),
+                update.effective_chat.id,
+                result,
+                caption=_with_quality_note(caption, result),
+                reply_to_message_id=_reply_target(update)
+            )
+            
+            # Delete the temporary message
+            await status.finish()
+            await delete_message(message.get_bot(), message.chat_id, message.message_id)
+            
+        except Exception as e:
+            logger.error("Error in ControlNet image generation: %s", e)
+            await status.finish(_generation_error_text(e))
+        finally:
+            journal_done()
+    
+    await _schedule_generation(update, status, run)
 
 async def handle_ipadapter_prompt(update: Update, prompt):
     """Process IP-Adapter prompt and generate image"""
@@ -259,76 +381,93 @@ async def handle_ipadapter_prompt(update: Update, prompt):
     session = state_manager.get_user_session(user.id)
     
     if len(prompt) > MAX_PROMPT_LENGTH:
-        await update.message.reply_text(f"Your prompt is too long. Please limit it to {MAX_PROMPT_LENGTH} characters.")
+        await reply_text(update.message, f"Your prompt is too long. Please limit it to {MAX_PROMPT_LENGTH} characters.")
         return
     
-    # Send a temporary message to indicate processing
-    message = await update.message.reply_text("🎨 Generating your image with IP-Adapter, please wait...")
-    
+    # Validate the parameters before anything is sent; the user may fix the
+    # prompt and send it again
     try:
-        # Extract any additional parameters
-        parsed_prompt, params = parse_additional_parameters(prompt)
-        
-        # Generate the image with IP-Adapter
-        result = await generate_with_ip_adapter(
-            parsed_prompt, 
-            session.image_url,
-            **params
+        parsed_prompt, params = parse_additional_parameters(prompt, extra=IP_ADAPTER_PARAMETERS)
+    except ParameterError as e:
+        await reply_text(update.message, str(e))
+        return
+    
+    # Refused requests keep the session, so the prompt can be sent again later
+    if not await _admit(update):
+        return
+    
+    # Capture the session data the job needs, then free the user for a new flow
+    image_url = session.image_url
+    state_manager.reset_user_state(user.id)
+    
+    # Send a temporary message to indicate processing
+    status_text = "🎨 Generating your image with IP-Adapter, please wait..."
+    message = await reply_text(update.message, status_text)
+    status = StatusMessage(message, status_text)
+    
+    async def run():
+        caption = (
+            f"🖼️ Generated with IP-Adapter from your image and prompt:\n\n"
+            f"{parsed_prompt[:100]}{'...' if len(parsed_prompt) > 100 else ''}"
         )
-        
-        if not result or not result.get("images") or len(result["images"]) == 0:
-            await message.edit_text("Sorry, I couldn't generate an image. Please try again with a different prompt or image.")
-            return
-        
-        # Get the first image URL
-        image_url = result["images"][0]["url"]
-        
-        # Send the image
-        await update.message.reply_photo(
-            photo=image_url,
-            caption=(
-                f"🖼️ Generated with IP-Adapter from your image and prompt:\n\n"
-                f"{parsed_prompt[:100]}{'...' if len(parsed_prompt) > 100 else ''}"
+        on_enqueue, journal_done = _journal_delivery(update, message, caption)
+        try:
+            # Generate the image with IP-Adapter
+            result = await generate_with_ip_adapter(
+                parsed_prompt, 
+                image_url,
+                on_enqueue=on_enqueue,
+                on_progress=status.on_progress,
+                **params
             )
-        )
-        
-        # Delete the temporary message
-        await message.delete()
-        
-        # Reset user state
-        state_manager.reset_user_state(user.id)
-        
-    except Exception as e:
-        logger.error(f"Error in IP-Adapter image generation: {str(e)}")
-        await message.edit_text(f"Sorry, an error occurred while generating the image: {str(e)}")
-        
-        # Reset user state
-        state_manager.reset_user_state(user.id)
+            
+            if not result or not result.get("images") or len(result["images"]) == 0:
+                await status.finish("Sorry, I couldn't generate an image. Please try again with a different prompt or image.")
+                return
+            
+            # Send all generated images
+            await deliver_images(
+                update.get_bot(),
+                update.effective_chat.id,
+                result,
+                caption=_with_quality_note(caption, result),
+                reply_to_message_id=_reply_target(update)
+            )
+            
+            # Delete the temporary message
+            await status.finish()
+            await delete_message(message.get_bot(), message.chat_id, message.message_id)
+            
+        except Exception as e:
+            logger.error("Error in IP-Adapter image generation: %s", e)
+            await status.finish(_generation_error_text(e))
+        finally:
+            journal_done()
+    
+    await _schedule_generation(update, status, run)
 
 async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle button callbacks"""
     query = update.callback_query
-    await query.answer()
+    data = query.data
     
+    # Render the full-quality version of a preview; answers the query itself
+    if data.startswith("finalize_"):
+        await finalize_preview(update, data[len("finalize_"):])
+        return
+    
+    await query.answer()
     user = query.from_user
-    data = query.data
     
     # Handle ControlNet type selection
     if data.startswith("controlnet_"):
         controlnet_type = data.split("controlnet_")[1]
         
         if controlnet_type == "cancel":
-            # Cancel operation
-            session = state_manager.reset_user_state(user.id)
-            
-            # Clean up temporary file
-            if session.image_path and os.path.exists(session.image_path):
-                try:
-                    os.remove(session.image_path)
-                except Exception:
-                    pass
+            # Cancel operation; resetting the state also removes any temporary files
+            state_manager.reset_user_state(user.id)
             
-            await query.edit_message_text(CANCEL_MESSAGE)
+            await edit_text(query.message, CANCEL_MESSAGE, SendPriority.REPLY)
             return
         
         # Set the ControlNet type and wait for prompt
@@ -343,102 +482,395 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "line": "Line Art"
         }.get(controlnet_type, controlnet_type)
         
-        await query.edit_message_text(
+        await edit_text(
+            query.message,
             f"You've selected {controlnet_name} ControlNet.\n\n"
             "Now, please provide a prompt to guide the image generation. "
             "This prompt will be used along with your image's structural information to create a new image.\n\n"
             "You can add parameters to your prompt using this syntax:\n"
-            "--steps 30 --guidance 7.5"
+            "--steps 30 --guidance 7.5",
+            priority=SendPriority.REPLY
         )
+        
+        # Build the control map while the user types, and show it
+        session = state_manager.get_user_session(user.id)
+        if control_map_store.supports(controlnet_type) and session.image_url:
+            task = asyncio.create_task(
+                _preview_control_map(query.get_bot(), query.message.chat_id, session.image_url, controlnet_type)
+            )
+            _previews.add(task)
+            task.add_done_callback(_previews.discard)
+
+_previews = set()
+
+async def _preview_control_map(bot, chat_id, image_url, controlnet_type):
+    """Send the control map the generation will use"""
+    try:
+        control_image_url = await control_map_store.get(image_url, controlnet_type)
+        await send_photo(bot, chat_id, photo=control_image_url, caption="🔍 Control map preview")
+    except Exception as e:
+        # The generation falls back to the photo itself
+        logger.error("Error previewing %s control map: %s", controlnet_type, e)
 
-async def process_prompt(update: Update, prompt, params=None):
-    """Process the prompt and generate an image"""
+async def process_prompt(update: Update, prompt, params=None, preview=None, admitted=False):
+    """
+    Process the prompt and generate an image
+    
+    Args:
+        update (Update): The update with the prompt, or the tap on a preview's
+            finalize button
+        prompt (str): The prompt without parameters
+        params (dict): Validated API parameters, plus an optional "preview" mode
+        preview (str): Preview mode overriding the prompt's and PREVIEW_MODE
+        admitted (bool): Whether the request already passed admission control
+    """
     user = update.effective_user
-    logger.info(f"User {user.id} requested image generation with prompt: {prompt[:100]}")
+    logger.info("User %s requested image generation with prompt: %s", user.id, prompt[:100])
     
     if len(prompt) > MAX_PROMPT_LENGTH:
-        await update.message.reply_text(f"Your prompt is too long. Please limit it to {MAX_PROMPT_LENGTH} characters.")
+        await reply_text(update.effective_message, f"Your prompt is too long. Please limit it to {MAX_PROMPT_LENGTH} characters.")
+        return
+    
+    # Use any provided parameters
+    params = dict(params or {})
+    preview = preview or params.pop("preview", PREVIEW_MODE)
+    # An automatic preview is followed by the full render
+    if not admitted and not await _admit(update, cost=2 if preview == "auto" else 1):
         return
+    if preview != "off":
+        # The preview and the final render share the seed
+        params.setdefault("seed", random.randrange(2 ** 32))
     
     # Send a temporary message to indicate processing
-    message = await update.message.reply_text("🎨 Generating your image, please wait...")
+    status_text = "⚡ Rendering a quick preview..." if preview != "off" else "🎨 Generating your image, please wait..."
+    message = await reply_text(update.effective_message, status_text)
+    status = StatusMessage(message, status_text)
+    
+    async def run():
+        caption = f"🖼️ Generated from your prompt:\n\n{prompt[:100]}{'...' if len(prompt) > 100 else ''}"
+        on_enqueue, journal_done = _journal_delivery(update, message, caption)
+        try:
+            if preview != "off":
+                delivered = await _send_preview(update, status, prompt, params, finalize_button=preview == "button")
+                if not delivered:
+                    # The status message already says what went wrong
+                    return
+                if preview == "button":
+                    await status.finish()
+                    await delete_message(message.get_bot(), message.chat_id, message.message_id)
+                    return
+                status.status_text = "🎨 Rendering the full-quality image..."
+                status.show(status.status_text)
+            
+            # Generate the image
+            result = await generate_image(
+                prompt,
+                on_enqueue=on_enqueue,
+                on_progress=status.on_progress,
+                **params
+            )
+            
+            if not result or not result.get("images") or len(result["images"]) == 0:
+                await status.finish("Sorry, I couldn't generate an image. Please try again with a different prompt.")
+                return
+                
+            # Send all generated images
+            await deliver_images(
+                update.get_bot(),
+                update.effective_chat.id,
+                result,
+                caption=_with_quality_note(caption, result),
+                reply_to_message_id=_reply_target(update)
+            )
+            
+            # Delete the temporary message
+            await status.finish()
+            await delete_message(message.get_bot(), message.chat_id, message.message_id)
+            
+        except Exception as e:
+            logger.error("Error in image generation: %s", e)
+            await status.finish(_generation_error_text(e))
+        finally:
+            journal_done()
     
+    await _schedule_generation(update, status, run)
+
+def _with_quality_note(caption, result):
+    """Tell the user when their image was rendered at a cheaper quality tier because of load"""
+    tier = result.get("quality_tier")
+    if not tier:
+        return caption
+    return f"{caption}\n\n⚡ Rendered at {tier} quality because the bot is busy right now."
+
+async def deliver_images(bot, chat_id, result, caption, reply_to_message_id=None, reply_markup=None):
+    """
+    Send every generated image to a chat
+    
+    A single image goes out as a photo; batches are sent as albums of at most
+    MEDIA_GROUP_LIMIT photos, with the caption on the first one. Images of
+    cached results are sent by their Telegram file_id, and the file_ids of
+    freshly sent photos are remembered for repeats of seeded requests.
+    Albums cannot carry the inline keyboard of ``reply_markup``.
+    
+    Returns:
+        list: The sent messages, one per image
+    """
+    images = result["images"]
+    photos = [image.get("file_id") or image["url"] for image in images]
+    
+    sent = []
+    with track_stage("send"):
+        for start in range(0, len(photos), MEDIA_GROUP_LIMIT):
+            chunk = photos[start:start + MEDIA_GROUP_LIMIT]
+            chunk_caption = caption if start == 0 else None
+            if len(chunk) == 1:
+                # Albums need at least two items
+                sent.append(await send_photo(
+                    bot,
+                    chat_id,
+                    photo=chunk[0],
+                    caption=chunk_caption,
+                    reply_to_message_id=reply_to_message_id,
+                    reply_markup=reply_markup
+                ))
+            else:
+                media = [
+                    InputMediaPhoto(media=photo, caption=chunk_caption if index == 0 else None)
+                    for index, photo in enumerate(chunk)
+                ]
+                sent.extend(await send_media_group(
+                    bot,
+                    chat_id,
+                    media=media,
+                    reply_to_message_id=reply_to_message_id
+                ))
+    
+    # Remember the file_ids so repeats of a seeded request skip the re-fetch
+    if result.get("cache_key") and not all(image.get("file_id") for image in images):
+        file_ids = [message.photo[-1].file_id if message.photo else None for message in sent]
+        result_cache.remember_file_ids(result["cache_key"], file_ids)
+    return sent
+
+def _reply_target(update: Update):
+    """Quote the user's message in groups, like Message.reply_* does"""
+    if update.effective_chat.type == "private":
+        return None
+    return update.effective_message.message_id
+
+# Full renders waiting for a tap on their preview's finalize button
+_pending_finals = LRUCache(10000, PREVIEW_FINALIZE_TTL)
+
+def _preview_size(image_size):
+    """A smaller image_size with the aspect ratio of the final one"""
+    width, height = IMAGE_SIZE_DIMENSIONS.get(image_size, IMAGE_SIZE_DIMENSIONS["landscape_4_3"])
+    return {
+        "width": max(256, round(width * PREVIEW_SCALE / 64) * 64),
+        "height": max(256, round(height * PREVIEW_SCALE / 64) * 64),
+    }
+
+async def _send_preview(update: Update, status, prompt, params, finalize_button):
+    """
+    Render and send a cheap single-image preview of a prompt
+    
+    Returns:
+        bool: Whether a preview was delivered
+    """
+    preview_params = dict(params)
+    preview_params["num_images"] = 1
+    preview_params["num_inference_steps"] = min(PREVIEW_STEPS, params.get("num_inference_steps", PREVIEW_STEPS))
+    preview_params["image_size"] = _preview_size(params.get("image_size", DEFAULT_PARAMS["image_size"]))
+    result = await generate_image(prompt, on_progress=status.on_progress, **preview_params)
+    if not result or not result.get("images"):
+        await status.finish("Sorry, I couldn't generate an image. Please try again with a different prompt.")
+        return False
+    
+    caption = f"👀 Preview of your prompt:\n\n{prompt[:100]}{'...' if len(prompt) > 100 else ''}"
+    reply_markup = None
+    if finalize_button:
+        token = uuid.uuid4().hex[:16]
+        _pending_finals.set(token, (update.effective_user.id, prompt, params))
+        reply_markup = InlineKeyboardMarkup([[InlineKeyboardButton("✨ Finalize", callback_data=f"finalize_{token}")]])
+        caption += "\n\nTap Finalize for the full-quality image."
+    await deliver_images(
+        update.get_bot(),
+        update.effective_chat.id,
+        result,
+        caption=caption,
+        reply_to_message_id=_reply_target(update),
+        reply_markup=reply_markup
+    )
+    return True
+
+async def finalize_preview(update: Update, token):
+    """Render the full-quality image of a preview whose finalize button was tapped"""
+    query = update.callback_query
+    pending = _pending_finals.get(token)
+    if pending is not None and query.from_user.id != pending[0]:
+        # Only the author of the prompt may spend a full render on it
+        await query.answer("Only the author of the prompt can finalize this preview.", show_alert=True)
+        return
+    await query.answer()
+    if pending is None:
+        await reply_text(query.message, "This preview was already finalized or has expired. Please send the prompt again.")
+        return
+    _, prompt, params = pending
+    # A refused tap leaves the button in place for a later retry
+    if not await _admit(update):
+        return
+    _pending_finals.pop(token)
+    
+    # Drop the button so the render cannot be started twice
+    await edit_reply_markup(query.message)
+    await process_prompt(update, prompt, params, preview="off", admitted=True)
+
+def _journal_delivery(update: Update, message, caption):
+    """
+    Build the callbacks that journal a job queued on fal with what is needed to deliver it
+
+    Returns:
+        tuple: ``on_enqueue`` for the generate functions, and ``done`` to call
+            once the job has been delivered or has failed
+    """
+    keys = []
+    
+    def withdraw(key):
+        if key in keys:
+            keys.remove(key)
+            job_journal.done(key)
+    
+    def on_enqueue(request_id, model):
+        # Several chats may wait on one shared request, each has its own entry
+        key = f"{request_id}:{update.effective_chat.id}:{message.message_id}"
+        keys.append(key)
+        job_journal.submitted(
+            request_id,
+            model,
+            key=key,
+            chat_id=update.effective_chat.id,
+            status_message_id=message.message_id,
+            reply_to_message_id=_reply_target(update),
+            caption=caption
+        )
+        # Failed retries and losing hedges are not resumed
+        return lambda: withdraw(key)
+    
+    def done():
+        for key in keys:
+            job_journal.done(key)
+    
+    return on_enqueue, done
+
+# Strong references to the tasks delivering resumed jobs
+_resumed_jobs = set()
+
+async def resume_journaled_jobs(bot):
+    """Deliver the results of queued jobs that were still pending when the bot last stopped"""
+    pending = job_journal.compact()
+    if pending:
+        logger.info("Resuming %s queued generation jobs", len(pending))
+    for record in pending:
+        task = asyncio.create_task(_resume_job(bot, record))
+        _resumed_jobs.add(task)
+        task.add_done_callback(_resumed_jobs.discard)
+
+async def _resume_job(bot, record):
+    chat_id = record["chat_id"]
+    status_message_id = record["status_message_id"]
     try:
-        # Use any provided parameters
-        params = params or {}
+        result = await wait_for_queued_result(record["model"], record["request_id"])
         
-        # Generate the image
-        result = await generate_image(prompt, **params)
-        
-        if not result or not result.get("images") or len(result["images"]) == 0:
-            await message.edit_text("Sorry, I couldn't generate an image. Please try again with a different prompt.")
+        if not result or not result.get("images"):
+            await edit_message_text(
+                bot,
+                chat_id,
+                status_message_id,
+                "Sorry, I couldn't generate an image. Please try again with a different prompt.",
+                SendPriority.REPLY
+            )
             return
-            
-        # Get the first image URL
-        image_url = result["images"][0]["url"]
         
-        # Send the image
-        await update.message.reply_photo(
-            photo=image_url,
-            caption=f"🖼️ Generated from your prompt:\n\n{prompt[:100]}{'...' if len(prompt) > 100 else ''}"
+        await deliver_images(
+            bot,
+            chat_id,
+            result,
+            caption=record.get("caption"),
+            reply_to_message_id=record.get("reply_to_message_id")
         )
-        
-        # Delete the temporary message
-        await message.delete()
+        await delete_message(bot, chat_id, status_message_id)
         
     except Exception as e:
-        logger.error(f"Error in image generation: {str(e)}")
-        await message.edit_text(f"Sorry, an error occurred while generating the image: {str(e)}")
-
-def parse_additional_parameters(text):
-    """Extract additional parameters from the prompt text"""
-    # Regular expression to match parameters in format --param value
-    param_pattern = r'--([a-zA-Z_]+)\s+([^\s-][^\s]*)'
-    
-    # Find all parameter matches
-    params = re.findall(param_pattern, text)
-    
-    # If parameters found, remove them from the prompt
-    if params:
-        for name, value in params:
-            text = re.sub(f'--{name}\\s+{re.escape(value)}\\s*', '', text)
-    
-    # Clean up the prompt
-    prompt = text.strip()
-    
-    # Convert parameters to appropriate types
-    param_dict = {}
-    for name, value in params:
-        # Try to convert to appropriate type
-        if value.lower() == 'true':
-            param_dict[name] = True
-        elif value.lower() == 'false':
-            param_dict[name] = False
-        else:
-            try:
-                # Try to convert to int
-                param_dict[name] = int(value)
-            except ValueError:
-                try:
-                    # Try to convert to float
-                    param_dict[name] = float(value)
-                except ValueError:
-                    # Keep as string
-                    param_dict[name] = value
-    
-    # Handle specific parameters and map them to the API parameters
-    api_param_map = {
-        'steps': 'num_inference_steps',
-        'guidance': 'guidance_scale',
-        'images': 'num_images',
-    }
+        logger.error("Error resuming queued request %s: %s", record["request_id"], e)
+        try:
+            await edit_message_text(
+                bot,
+                chat_id,
+                status_message_id,
+                _generation_error_text(e),
+                SendPriority.REPLY
+            )
+        except Exception as edit_error:
+            logger.error("Failed to report error for request %s: %s", record["request_id"], edit_error)
+    finally:
+        job_journal.done(record.get("key", record["request_id"]))
+
+def _generation_error_text(error):
+    """User-facing text for a failed generation"""
+    if isinstance(error, UpstreamUnavailableError):
+        return f"⚠️ {str(error)}"
+    if isinstance(error, asyncio.TimeoutError):
+        return "Sorry, generating the image took too long. Please try again later."
+    return f"Sorry, an error occurred while generating the image: {str(error)}"
+
+async def _admit(update: Update, cost=1):
+    """
+    Run a generation request through admission control
+
+    Requests are refused before they take a token while the circuit breaker
+    of the upstream is open.
+
+    Args:
+        update (Update): The update with the request
+        cost (int): Generations the request runs
+
+    Returns:
+        bool: Whether the request may go ahead; if not, the user has been
+            told why or when to retry
+    """
+    unavailable = upstream_unavailable()
+    if unavailable:
+        await reply_text(update.effective_message, _generation_error_text(unavailable))
+        return False
+    user = update.effective_user
+    refused = admission.check(user.id, update.effective_chat.id, cost)
+    if refused is None:
+        return True
+    reason, retry_after = refused
+    logger.info("Refused generation for user %s (%s), retry in %ss", user.id, reason, retry_after)
+    if reason in ("user_quota", "chat_quota"):
+        text = f"⏳ You are sending requests too quickly. Please try again in {retry_after} s."
+    else:
+        text = f"⏳ The bot is busy right now. Please try again in {retry_after} s."
+    await reply_text(update.effective_message, text)
+    return False
+
+async def _schedule_generation(update: Update, status, run):
+    """Queue a generation job for the user and keep its status message showing the queue position"""
+    # Don't queue behind a failing upstream, tell the user right away
+    unavailable = upstream_unavailable()
+    if unavailable:
+        await status.finish(_generation_error_text(unavailable))
+        return
+    
+    user = update.effective_user
+    priority = Priority.HIGH if user.id in PRIORITY_USER_IDS else Priority.NORMAL
     
-    # Map parameters to API parameters
-    final_params = {}
-    for param, value in param_dict.items():
-        if param in api_param_map:
-            final_params[api_param_map[param]] = value
+    async def report_position(position):
+        if position is None:
+            await status.finish("Cancelled.")
+        elif position > 0:
+            status.show(f"⏳ You are #{position} in queue, please wait...")
         else:
-            final_params[param] = value
+            # The job has started, restore the original status text
+            status.show(status.status_text)
     
-    return prompt, final_params
+    generation_scheduler.submit(user.id, run, priority=priority, on_position=report_position)
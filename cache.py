@@ -0,0 +1,255 @@
+import copy
+import hashlib
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from config import (
+    RESULT_CACHE_SIZE, RESULT_CACHE_TTL, RESULT_CACHE_DIR,
+    UPLOAD_CACHE_SIZE, FAL_UPLOAD_URL_TTL
+)
+
+logger = logging.getLogger(__name__)
+
+class LRUCache:
+    """In-memory LRU cache with an optional per-entry time to live"""
+
+    def __init__(self, max_entries, ttl=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # key -> (expires_at, value), least recently used first
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at is not None and expires_at <= time.time():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl=None):
+        ttl = ttl if ttl is not None else self.ttl
+        expires_at = time.time() + ttl if ttl is not None else None
+        self._entries[key] = (expires_at, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def pop(self, key):
+        entry = self._entries.pop(key, None)
+        return entry[1] if entry else None
+
+class DiskCache:
+    """JSON-file cache tier: one file per key, expired by modification time"""
+
+    # Expired files are swept after this many writes
+    SWEEP_INTERVAL = 100
+
+    def __init__(self, directory, ttl):
+        self.directory = directory
+        self.ttl = ttl
+        self._writes = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            if time.time() - os.path.getmtime(path) > self.ttl:
+                os.remove(path)
+                return None
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning("Discarding unreadable cache entry %s: %s", path, e)
+            self._remove(path)
+            return None
+
+    def set(self, key, value):
+        path = self._path(key)
+        tmp_path = f"{path}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(value, f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning("Failed to write cache entry %s: %s", path, e)
+            self._remove(tmp_path)
+            return
+
+        self._writes += 1
+        if self._writes % self.SWEEP_INTERVAL == 0:
+            self.sweep()
+
+    def sweep(self):
+        """Delete every expired entry"""
+        cutoff = time.time() - self.ttl
+        removed = 0
+        for entry in os.scandir(self.directory):
+            try:
+                if entry.is_file() and entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+                    removed += 1
+            except OSError:
+                pass
+        if removed:
+            logger.info("Removed %s expired entries from %s", removed, self.directory)
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def _normalize(value):
+    """Normalize argument values so equivalent requests hash identically"""
+    if isinstance(value, str):
+        return " ".join(value.split())
+    if isinstance(value, dict):
+        return {key: _normalize(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_normalize(item) for item in value]
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+def request_key(model, arguments):
+    """
+    Canonical hash of a generation request
+
+    Args:
+        model (str): The model the request goes to
+        arguments (dict): The fully merged arguments, including prompt, seed
+            and any control or reference image URL
+
+    Returns:
+        str: Hex digest identifying the request
+    """
+    canonical = json.dumps(
+        {"model": model, "arguments": _normalize(arguments)},
+        sort_keys=True,
+        separators=(",", ":"),
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+def is_deterministic(arguments):
+    """Only requests with an explicit seed produce repeatable results"""
+    return arguments.get("seed") is not None
+
+class ResultCache:
+    """
+    Cache of generation results for seeded requests
+
+    Entries hold the fal result and, once the first delivery has happened,
+    the Telegram file_ids of the sent photos so repeats can be answered
+    without a GPU run or a re-fetch of the image.
+    """
+
+    def __init__(self, max_entries, ttl, directory=None):
+        self.memory = LRUCache(max_entries, ttl)
+        self.disk = DiskCache(directory, ttl) if directory else None
+
+    def get(self, key):
+        """
+        Look up a cached result
+
+        Returns:
+            dict: A copy of the cached result, with a "file_id" on every image
+                that was already delivered, or None on a miss
+        """
+        entry = self.memory.get(key)
+        if entry is None and self.disk is not None:
+            entry = self.disk.get(key)
+            if entry is not None:
+                self.memory.set(key, entry)
+        if entry is None:
+            return None
+
+        result = copy.deepcopy(entry["result"])
+        for image, file_id in zip(result.get("images", []), entry.get("file_ids", [])):
+            if file_id:
+                image["file_id"] = file_id
+        return result
+
+    def put(self, key, result):
+        """Store a fresh generation result"""
+        entry = {"result": copy.deepcopy(result), "file_ids": []}
+        self._store(key, entry)
+
+    def remember_file_ids(self, key, file_ids):
+        """Attach the Telegram file_ids of the delivered photos to an entry"""
+        entry = self.memory.get(key)
+        if entry is None and self.disk is not None:
+            entry = self.disk.get(key)
+        if entry is None:
+            return
+        entry["file_ids"] = list(file_ids)
+        self._store(key, entry)
+
+    def _store(self, key, entry):
+        self.memory.set(key, entry)
+        if self.disk is not None:
+            self.disk.set(key, entry)
+
+class UploadCache:
+    """
+    Maps reference images to their fal storage URL
+
+    Images are found either by Telegram's file_unique_id, which lets a
+    re-forwarded photo skip both the download and the upload, or by the
+    SHA-256 of their content, which catches the same picture arriving
+    under a different file. Every alias of an upload expires together
+    with the URL itself.
+    """
+
+    def __init__(self, max_entries, ttl):
+        self.ttl = ttl
+        # alias -> (url, expires_at)
+        self.by_file_id = LRUCache(max_entries)
+        self.by_digest = LRUCache(max_entries)
+
+    @staticmethod
+    def digest(data):
+        return hashlib.sha256(data).hexdigest()
+
+    def get_by_file_id(self, file_unique_id):
+        return self._lookup(self.by_file_id, file_unique_id)
+
+    def get_by_digest(self, digest):
+        return self._lookup(self.by_digest, digest)
+
+    def put(self, digest, url, file_unique_id=None):
+        """Record a fresh upload of the content with the given digest"""
+        entry = (url, time.time() + self.ttl)
+        self.by_digest.set(digest, entry, ttl=self.ttl)
+        if file_unique_id:
+            self.by_file_id.set(file_unique_id, entry, ttl=self.ttl)
+
+    def link_file_id(self, file_unique_id, digest):
+        """Point a Telegram file at an existing upload, keeping the upload's expiry"""
+        entry = self.by_digest.get(digest)
+        if entry is not None:
+            self.by_file_id.set(file_unique_id, entry, ttl=entry[1] - time.time())
+
+    @staticmethod
+    def _lookup(cache, key):
+        entry = cache.get(key)
+        return entry[0] if entry else None
+
+# Create global instances
+result_cache = ResultCache(RESULT_CACHE_SIZE, RESULT_CACHE_TTL, RESULT_CACHE_DIR or None)
+upload_cache = UploadCache(UPLOAD_CACHE_SIZE, FAL_UPLOAD_URL_TTL)
@@ -4,18 +4,72 @@ from dotenv import load_dotenv
 # Load environment variables from .env file
 load_dotenv()
 
-# Telegram Bot Token
-TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
-if not TELEGRAM_BOT_TOKEN:
-    raise ValueError("Please set the TELEGRAM_BOT_TOKEN environment variable")
+# Telegram Bot Token (checked when the bot starts, see warmup.py)
+TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN", "")
 
-# fal.ai API Key
-FAL_KEY = os.getenv("FAL_KEY")
-if not FAL_KEY:
-    raise ValueError("Please set the FAL_KEY environment variable")
+# fal.ai API Key (checked when the bot starts)
+FAL_KEY = os.getenv("FAL_KEY", "")
+
+# Bot API endpoints, only needed for a self-hosted Bot API server (or the
+# fake one used by the benchmarks); empty uses api.telegram.org
+TELEGRAM_BASE_URL = os.getenv("TELEGRAM_BASE_URL", "")
+TELEGRAM_BASE_FILE_URL = os.getenv("TELEGRAM_BASE_FILE_URL", "")
 
 # Set fal.ai key as environment variable for the fal-client
-os.environ["FAL_KEY"] = FAL_KEY
+if FAL_KEY:
+    os.environ["FAL_KEY"] = FAL_KEY
+
+# fal.ai client backend: "async" uses one pooled httpx client on the event loop,
+# "thread" runs the blocking client on dedicated upload/generation thread pools
+FAL_BACKEND = os.getenv("FAL_BACKEND", "async").lower()
+FAL_HTTP_TIMEOUT = float(os.getenv("FAL_HTTP_TIMEOUT", "120"))
+FAL_MAX_CONNECTIONS = int(os.getenv("FAL_MAX_CONNECTIONS", "100"))
+FAL_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("FAL_MAX_KEEPALIVE_CONNECTIONS", "20"))
+FAL_UPLOAD_WORKERS = int(os.getenv("FAL_UPLOAD_WORKERS", "8"))
+FAL_GENERATE_WORKERS = int(os.getenv("FAL_GENERATE_WORKERS", "64"))
+
+# How generations are run: "subscribe" holds a connection per job until it
+# finishes, "queue" submits to the fal queue and a few pollers collect the
+# results. Queued jobs are journaled to JOB_JOURNAL_PATH and resumed after a
+# restart; the journal is compacted every JOB_JOURNAL_COMPACT_EVERY finished
+# jobs. Poll intervals back off between the min and max (seconds)
+FAL_SUBMIT_MODE = os.getenv("FAL_SUBMIT_MODE", "subscribe").lower()
+JOB_JOURNAL_PATH = os.getenv("JOB_JOURNAL_PATH", "jobs.journal")
+JOB_JOURNAL_COMPACT_EVERY = int(os.getenv("JOB_JOURNAL_COMPACT_EVERY", "1000"))
+FAL_POLLERS = int(os.getenv("FAL_POLLERS", "4"))
+FAL_POLL_MIN_INTERVAL = float(os.getenv("FAL_POLL_MIN_INTERVAL", "0.5"))
+FAL_POLL_MAX_INTERVAL = float(os.getenv("FAL_POLL_MAX_INTERVAL", "5"))
+
+# Generation resilience: overall deadline per request (FAL_MODEL_DEADLINES
+# overrides it per model as "model=seconds,..."), jittered retries of
+# transient failures for seeded requests, optional hedging once a request
+# runs past the model's recent FAL_HEDGE_PERCENTILE latency, and a circuit
+# breaker opening for FAL_BREAKER_COOLDOWN seconds after consecutive failures
+FAL_DEADLINE = float(os.getenv("FAL_DEADLINE", "300"))
+FAL_MODEL_DEADLINES = {
+    model.strip(): float(seconds)
+    for model, _, seconds in (
+        item.rpartition("=") for item in os.getenv("FAL_MODEL_DEADLINES", "").split(",") if item.strip()
+    )
+}
+FAL_MAX_RETRIES = int(os.getenv("FAL_MAX_RETRIES", "2"))
+FAL_RETRY_BASE_DELAY = float(os.getenv("FAL_RETRY_BASE_DELAY", "1"))
+FAL_RETRY_MAX_DELAY = float(os.getenv("FAL_RETRY_MAX_DELAY", "10"))
+FAL_HEDGE = os.getenv("FAL_HEDGE", "false").lower() == "true"
+FAL_HEDGE_PERCENTILE = float(os.getenv("FAL_HEDGE_PERCENTILE", "0.95"))
+FAL_BREAKER_FAILURES = int(os.getenv("FAL_BREAKER_FAILURES", "5"))
+FAL_BREAKER_COOLDOWN = float(os.getenv("FAL_BREAKER_COOLDOWN", "30"))
+
+# Result cache for seeded requests: in-memory LRU plus optional on-disk tier
+# (disabled unless RESULT_CACHE_DIR is set); TTL in seconds
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", "512"))
+RESULT_CACHE_TTL = int(os.getenv("RESULT_CACHE_TTL", str(24 * 3600)))
+RESULT_CACHE_DIR = os.getenv("RESULT_CACHE_DIR", "")
+
+# Upload dedup for reference images; entries expire well within the lifetime
+# of fal storage URLs (seconds)
+UPLOAD_CACHE_SIZE = int(os.getenv("UPLOAD_CACHE_SIZE", "1024"))
+FAL_UPLOAD_URL_TTL = int(os.getenv("FAL_UPLOAD_URL_TTL", str(6 * 3600)))
 
 # Default model
 DEFAULT_MODEL = "fal-ai/stable-diffusion-v35-large"
@@ -49,6 +103,138 @@ IP_ADAPTER_CONFIG = {
 # Maximum prompt length
 MAX_PROMPT_LENGTH = 1000
 
+# Seconds between edits of a job's status message while it shows progress;
+# progress events arriving in between are merged into the next edit
+STATUS_EDIT_INTERVAL = float(os.getenv("STATUS_EDIT_INTERVAL", "3"))
+
+# Outbound Telegram rate limits: requests per second overall (split between
+# webhook workers) and per private chat, and messages per minute per group.
+# A chat may send up to TELEGRAM_CHAT_BURST requests (TELEGRAM_GROUP_BURST in
+# groups) back to back before its rate applies, so a reply and a status edit
+# do not hold up each other
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "30"))
+TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", "1"))
+TELEGRAM_GROUP_RATE = float(os.getenv("TELEGRAM_GROUP_MESSAGES_PER_MINUTE", "20")) / 60
+TELEGRAM_CHAT_BURST = int(os.getenv("TELEGRAM_CHAT_BURST", "3"))
+TELEGRAM_GROUP_BURST = int(os.getenv("TELEGRAM_GROUP_BURST", "3"))
+
+# Logging: records are queued and written by a background thread, so the event
+# loop never waits on log output; above LOG_QUEUE_SIZE waiting records new ones
+# are dropped. LOG_FORMAT is "text" or "json" (one object per line with the
+# user and job ids). Only LOG_SAMPLE_RATE of the INFO records of the
+# LOG_SAMPLED_LOGGERS (comma-separated) are kept; warnings and errors always are
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").lower()
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+LOG_SAMPLED_LOGGERS = {
+    name.strip() for name in os.getenv("LOG_SAMPLED_LOGGERS", "user_state,httpx").split(",") if name.strip()
+}
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "0.1"))
+
+# Prometheus metrics and health checks (/metrics, /healthz, /readyz). The
+# endpoints are unauthenticated, so they are off unless METRICS_PORT is set
+# (e.g. 9090) and only listen on localhost unless METRICS_LISTEN is widened
+# (e.g. 0.0.0.0 for a scraper on another host). Webhook workers listen on
+# METRICS_PORT + their worker id
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+
+# How updates are received: "polling" (default) or "webhook". In webhook mode
+# a built-in HTTP receiver shards updates by user id over WEBHOOK_WORKERS
+# worker processes; TLS is expected to be terminated by a reverse proxy
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", str(os.cpu_count() or 1)))
+
+# Update dispatching: handlers from different users run concurrently up to
+# MAX_CONCURRENT_UPDATES, while each user's updates are processed in order
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", "64"))
+MAX_PENDING_UPDATES = int(os.getenv("MAX_PENDING_UPDATES", "1024"))
+
+# User sessions expire after SESSION_TIMEOUT_MINUTES of inactivity; above
+# MAX_USER_SESSIONS the least recently active sessions are evicted
+SESSION_TIMEOUT_MINUTES = float(os.getenv("SESSION_TIMEOUT_MINUTES", "30"))
+MAX_USER_SESSIONS = int(os.getenv("MAX_USER_SESSIONS", "100000"))
+
+# Session persistence: "memory" (default), "sqlite" or "redis"; changes are
+# written behind in batches every SESSION_FLUSH_INTERVAL seconds, and up to
+# SESSION_LOAD_WORKERS sessions are loaded at once
+SESSION_STORE = os.getenv("SESSION_STORE", "memory").lower()
+SESSION_STORE_PATH = os.getenv("SESSION_STORE_PATH", "sessions.db")
+SESSION_STORE_URL = os.getenv("SESSION_STORE_URL", "redis://localhost:6379/0")
+SESSION_FLUSH_INTERVAL = float(os.getenv("SESSION_FLUSH_INTERVAL", "1.0"))
+SESSION_FLUSH_BATCH = int(os.getenv("SESSION_FLUSH_BATCH", "500"))
+SESSION_LOAD_WORKERS = int(os.getenv("SESSION_LOAD_WORKERS", "8"))
+
+# Generation scheduling: global cap on in-flight fal requests, per-user budget,
+# and users (comma-separated ids) whose jobs go to the high priority tier
+MAX_INFLIGHT_GENERATIONS = int(os.getenv("MAX_INFLIGHT_GENERATIONS", "16"))
+MAX_GENERATIONS_PER_USER = int(os.getenv("MAX_GENERATIONS_PER_USER", "1"))
+PRIORITY_USER_IDS = {
+    int(user_id) for user_id in os.getenv("PRIORITY_USER_IDS", "").split(",") if user_id.strip()
+}
+
+# Admission control: requests are refused with a "retry in N s" reply once
+# ADMISSION_MAX_PENDING generations are running or queued, or when the
+# estimated wait for a slot exceeds ADMISSION_MAX_WAIT seconds (0 disables
+# either check). Users and group chats get token buckets of the given burst
+# refilling at the given requests per minute (0 disables them; priority users
+# are exempt). Bucket levels are saved to ADMISSION_STATE_PATH every
+# ADMISSION_SAVE_INTERVAL seconds and survive restarts
+ADMISSION_MAX_PENDING = int(os.getenv("ADMISSION_MAX_PENDING", str(8 * MAX_INFLIGHT_GENERATIONS)))
+ADMISSION_MAX_WAIT = float(os.getenv("ADMISSION_MAX_WAIT", "120"))
+ADMISSION_USER_PER_MINUTE = float(os.getenv("ADMISSION_USER_PER_MINUTE", "6"))
+ADMISSION_USER_BURST = int(os.getenv("ADMISSION_USER_BURST", "4"))
+ADMISSION_CHAT_PER_MINUTE = float(os.getenv("ADMISSION_CHAT_PER_MINUTE", "20"))
+ADMISSION_CHAT_BURST = int(os.getenv("ADMISSION_CHAT_BURST", "10"))
+ADMISSION_STATE_PATH = os.getenv("ADMISSION_STATE_PATH", "quotas.json")
+ADMISSION_SAVE_INTERVAL = float(os.getenv("ADMISSION_SAVE_INTERVAL", "10"))
+
+# Load-adaptive quality: once pending generations (running plus queued) or the
+# recent p95 generation latency (seconds) reach a tier's threshold, requests
+# without an explicit --steps run with QUALITY_REDUCED_STEPS, or on
+# QUALITY_TURBO_MODEL (text-to-image only; empty disables that tier). A tier
+# is held for QUALITY_MIN_DWELL seconds and left once the load falls below
+# QUALITY_EXIT_RATIO of its thresholds. Seeded requests are never rerouted, and
+# captions say when a cheaper tier was used. Opt-in with QUALITY_ROUTING=true
+QUALITY_ROUTING = os.getenv("QUALITY_ROUTING", "false").lower() == "true"
+QUALITY_REDUCED_STEPS = int(os.getenv("QUALITY_REDUCED_STEPS", "16"))
+QUALITY_REDUCED_PENDING = int(os.getenv("QUALITY_REDUCED_PENDING", str(MAX_INFLIGHT_GENERATIONS)))
+QUALITY_REDUCED_P95 = float(os.getenv("QUALITY_REDUCED_P95", "60"))
+QUALITY_TURBO_MODEL = os.getenv("QUALITY_TURBO_MODEL", "")
+QUALITY_TURBO_STEPS = int(os.getenv("QUALITY_TURBO_STEPS", "4"))
+QUALITY_TURBO_PENDING = int(os.getenv("QUALITY_TURBO_PENDING", str(2 * MAX_INFLIGHT_GENERATIONS)))
+QUALITY_TURBO_P95 = float(os.getenv("QUALITY_TURBO_P95", "120"))
+QUALITY_EXIT_RATIO = float(os.getenv("QUALITY_EXIT_RATIO", "0.7"))
+QUALITY_MIN_DWELL = float(os.getenv("QUALITY_MIN_DWELL", "30"))
+
+# Preview-then-final text-to-image: "off", "auto" (a quick preview, then the
+# full render with the same seed) or "button" (a quick preview with a button
+# that starts the full render); users can pick per prompt with --preview.
+# Previews run PREVIEW_STEPS steps at PREVIEW_SCALE of the final size, and
+# their buttons stay usable for PREVIEW_FINALIZE_TTL seconds
+PREVIEW_MODE = os.getenv("PREVIEW_MODE", "off").lower()
+PREVIEW_STEPS = int(os.getenv("PREVIEW_STEPS", "8"))
+PREVIEW_SCALE = float(os.getenv("PREVIEW_SCALE", "0.5"))
+PREVIEW_FINALIZE_TTL = int(os.getenv("PREVIEW_FINALIZE_TTL", "3600"))
+
+# Startup warm-up: before the bot reports ready it opens its connections to
+# fal.ai and starts the image workers, giving each step WARMUP_TIMEOUT
+# seconds. WARMUP_MODELS (comma-separated) also get a one-step generation in
+# the background. Keep-warm repeats this after KEEP_WARM_INTERVAL seconds
+# without generations during KEEP_WARM_PEAK_HOURS ("start-end" local hours,
+# end exclusive) and after KEEP_WARM_OFFPEAK_INTERVAL seconds outside them;
+# 0 disables it
+WARMUP_TIMEOUT = float(os.getenv("WARMUP_TIMEOUT", "10"))
+WARMUP_MODELS = [model.strip() for model in os.getenv("WARMUP_MODELS", "").split(",") if model.strip()]
+KEEP_WARM_INTERVAL = float(os.getenv("KEEP_WARM_INTERVAL", "0"))
+KEEP_WARM_OFFPEAK_INTERVAL = float(os.getenv("KEEP_WARM_OFFPEAK_INTERVAL", "0"))
+KEEP_WARM_PEAK_HOURS = tuple(int(hour) for hour in os.getenv("KEEP_WARM_PEAK_HOURS", "8-23").split("-"))
+
 # Help message
 HELP_MESSAGE = """
 *AI Image Generation Bot*
@@ -79,11 +265,29 @@ After sending /controlnet and uploading an image, you can choose from these mode
 *Advanced Usage:*
 You can set parameters like this:
 /generate a beach at sunset --steps 30 --guidance 7.5
+/generate a cat in the rain --negative "blurry, dark" --seed 42
+/generate a castle at dawn --preview button (quick preview first, full render on tap)
 """
 
 # Cancel message
 CANCEL_MESSAGE = "Operation cancelled. What would you like to do next?"
 
-# Temporary file storage
+# Temporary file storage, only used for photos larger than IMAGE_SPOOL_THRESHOLD
+# bytes; smaller photos go from Telegram to fal.ai in memory
 TEMP_DIRECTORY = "temp_images"
+IMAGE_SPOOL_THRESHOLD = int(os.getenv("IMAGE_SPOOL_THRESHOLD", str(8 * 1024 * 1024)))
+
+# Control and reference images are fetched at the smallest Telegram size whose
+# long side covers IMAGE_TARGET_SIZE pixels and downscaled to it before upload,
+# in IMAGE_WORKERS processes (needs Pillow; 0 uploads photos at full size)
+IMAGE_TARGET_SIZE = int(os.getenv("IMAGE_TARGET_SIZE", "1024"))
+IMAGE_JPEG_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", "90"))
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", "2"))
+
+# ControlNet modes whose control maps are computed locally (needs NumPy and
+# Pillow) and uploaded once per image; other modes send the photo as is
+CONTROL_MAP_MODES = {
+    mode.strip() for mode in os.getenv("CONTROL_MAP_MODES", "canny,line").split(",") if mode.strip()
+}
+CONTROL_MAP_CACHE_SIZE = int(os.getenv("CONTROL_MAP_CACHE_SIZE", "256"))
 os.makedirs(TEMP_DIRECTORY, exist_ok=True)
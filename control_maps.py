@@ -0,0 +1,223 @@
+"""
+Local ControlNet preprocessors and a cache of uploaded control maps.
+
+Canny edges and line art are computed with NumPy in the image process pool
+instead of by fal.ai on every generation. A map is built once per uploaded
+image and mode, uploaded once, and then reused by every prompt the user runs
+against that image. Uploads of the same picture share one URL (see
+cache.UploadCache), so the map cache is keyed by the source URL. Modes
+without a local preprocessor, or a missing NumPy or Pillow, keep sending the
+photo itself.
+"""
+import asyncio
+import io
+import logging
+import httpx
+from cache import LRUCache
+from config import (
+    CONTROL_MAP_MODES, CONTROL_MAP_CACHE_SIZE, FAL_UPLOAD_URL_TTL, FAL_HTTP_TIMEOUT,
+    IMAGE_TARGET_SIZE
+)
+from fal_client_wrapper import upload_image_bytes
+from image_preprocess import run_in_image_pool
+from metrics import track_stage
+
+try:
+    import numpy as np
+    from numpy.lib.stride_tricks import sliding_window_view
+    from PIL import Image, ImageOps
+except ImportError:
+    np = None
+
+logger = logging.getLogger(__name__)
+
+# Weak edges are grown from strong ones for at most this many pixels
+HYSTERESIS_STEPS = 32
+
+def _blur(image, sigma):
+    """Separable Gaussian blur with edge padding"""
+    radius = max(1, int(3 * sigma))
+    x = np.arange(-radius, radius + 1, dtype=np.float32)
+    kernel = np.exp(-x ** 2 / (2 * sigma ** 2))
+    kernel /= kernel.sum()
+    padded = np.pad(image, radius, mode="edge")
+    rows = sliding_window_view(padded, kernel.size, axis=1) @ kernel
+    return sliding_window_view(rows, kernel.size, axis=0) @ kernel
+
+def _shift(padded, dy, dx):
+    """The neighbour at (dy, dx) of every pixel of an image padded by one"""
+    height, width = padded.shape[0] - 2, padded.shape[1] - 2
+    return padded[1 + dy:1 + dy + height, 1 + dx:1 + dx + width]
+
+def canny(gray, low=100, high=200, sigma=1.4):
+    """
+    Canny edge detection
+
+    Args:
+        gray (numpy.ndarray): Grayscale image, float32 in 0-255
+        low (float): Gradient magnitude kept when connected to a strong edge
+        high (float): Gradient magnitude of a strong edge
+        sigma (float): Blur applied before the gradient
+
+    Returns:
+        numpy.ndarray: uint8 map with white edges on black
+    """
+    padded = np.pad(_blur(gray, sigma), 1, mode="edge")
+    gx = (_shift(padded, -1, 1) + 2 * _shift(padded, 0, 1) + _shift(padded, 1, 1)
+          - _shift(padded, -1, -1) - 2 * _shift(padded, 0, -1) - _shift(padded, 1, -1))
+    gy = (_shift(padded, 1, -1) + 2 * _shift(padded, 1, 0) + _shift(padded, 1, 1)
+          - _shift(padded, -1, -1) - 2 * _shift(padded, -1, 0) - _shift(padded, -1, 1))
+    magnitude = np.hypot(gx, gy)
+
+    # Keep only local maxima across the gradient direction, in four sectors
+    sector = (np.round(np.arctan2(gy, gx) / (np.pi / 4)) % 4).astype(np.int8)
+    padded = np.pad(magnitude, 1)
+    thin = np.zeros(magnitude.shape, dtype=bool)
+    for index, (dy, dx) in enumerate(((0, 1), (1, 1), (1, 0), (1, -1))):
+        peak = (magnitude >= _shift(padded, dy, dx)) & (magnitude >= _shift(padded, -dy, -dx))
+        thin |= (sector == index) & peak
+    magnitude = np.where(thin, magnitude, 0)
+
+    # Hysteresis: grow strong edges into connected weak ones
+    weak = magnitude >= low
+    edges = magnitude >= high
+    for _ in range(HYSTERESIS_STEPS):
+        padded = np.pad(edges, 1)
+        grown = edges.copy()
+        for dy in (-1, 0, 1):
+            for dx in (-1, 0, 1):
+                grown |= _shift(padded, dy, dx)
+        grown &= weak
+        if np.array_equal(grown, edges):
+            break
+        edges = grown
+    return edges.astype(np.uint8) * 255
+
+def lineart(gray, sigma=2.0, gain=4.0):
+    """
+    Line art by colour dodging the image with its blurred negative
+
+    Args:
+        gray (numpy.ndarray): Grayscale image, float32 in 0-255
+        sigma (float): Blur of the negative; larger values give bolder lines
+        gain (float): Contrast applied to the lines
+
+    Returns:
+        numpy.ndarray: uint8 map with white lines on black
+    """
+    negative = _blur(255 - gray, sigma)
+    sketch = np.minimum(255, gray * 255 / np.maximum(255 - negative, 1))
+    return np.clip((255 - sketch) * gain, 0, 255).astype(np.uint8)
+
+PREPROCESSORS = {
+    "canny": canny,
+    "line": lineart,
+}
+
+def render_control_map(data, mode, max_side):
+    """
+    Decode an image, compute its control map and encode it as PNG
+
+    Runs in the image process pool.
+    """
+    with Image.open(io.BytesIO(data)) as image:
+        image = ImageOps.exif_transpose(image).convert("L")
+        image.thumbnail((max_side, max_side), Image.LANCZOS)
+        gray = np.asarray(image, dtype=np.float32)
+    output = io.BytesIO()
+    Image.fromarray(PREPROCESSORS[mode](gray), "L").save(output, "PNG")
+    return output.getvalue()
+
+class ControlMapStore:
+    """
+    Uploaded control maps by source image URL and mode
+
+    Concurrent requests for the same map, such as the preview and a prompt
+    sent right after it, share one build. Source images that are no longer
+    cached are downloaded over one keep-alive client, closed by close().
+    """
+
+    def __init__(self, max_entries, ttl, modes):
+        self.modes = modes
+        self.maps = LRUCache(max_entries, ttl)
+        # Recently ingested source images, to skip downloading them again
+        self.sources = LRUCache(32, ttl)
+        self.stats = {"hits": 0, "builds": 0, "failures": 0}
+        self._building = {}
+        self._http = None
+
+    def supports(self, mode):
+        return np is not None and mode in self.modes and mode in PREPROCESSORS
+
+    def add_source(self, image_url, data):
+        """Keep the bytes of a freshly uploaded image for building its maps"""
+        self.sources.set(image_url, data)
+
+    async def get(self, image_url, mode):
+        """
+        Get the URL of the control map of an image, building it if needed
+
+        Args:
+            image_url (str): fal storage URL of the source image
+            mode (str): A mode with a local preprocessor
+
+        Returns:
+            str: fal storage URL of the control map
+        """
+        key = (image_url, mode)
+        url = self.maps.get(key)
+        if url is not None:
+            self.stats["hits"] += 1
+            return url
+        task = self._building.get(key)
+        if task is None:
+            task = asyncio.create_task(self._build(image_url, mode))
+            self._building[key] = task
+            task.add_done_callback(lambda _: self._building.pop(key, None))
+        # A cancelled waiter must not cancel the build for the others
+        return await asyncio.shield(task)
+
+    async def resolve(self, image_url, mode):
+        """
+        Get the control image to send for a generation
+
+        Returns:
+            str: The control map URL, or the source URL for modes fal.ai
+                preprocesses itself and when the local build fails
+        """
+        if not self.supports(mode):
+            return image_url
+        try:
+            return await self.get(image_url, mode)
+        except Exception as e:
+            logger.error("Error building %s control map, sending the photo instead: %s", mode, e)
+            return image_url
+
+    async def _build(self, image_url, mode):
+        try:
+            data = self.sources.get(image_url)
+            if data is None:
+                if self._http is None:
+                    self._http = httpx.AsyncClient(timeout=FAL_HTTP_TIMEOUT)
+                response = await self._http.get(image_url)
+                response.raise_for_status()
+                data = response.content
+            with track_stage("control_map"):
+                png = await run_in_image_pool(render_control_map, data, mode, IMAGE_TARGET_SIZE or 1024)
+            url = await upload_image_bytes(png, "image/png")
+        except Exception:
+            self.stats["failures"] += 1
+            raise
+        self.stats["builds"] += 1
+        self.maps.set((image_url, mode), url)
+        logger.info("Built %s control map of %s bytes", mode, len(png))
+        return url
+
+    async def close(self):
+        """Close the connections used to download source images"""
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+
+# Create a global instance
+control_map_store = ControlMapStore(CONTROL_MAP_CACHE_SIZE, FAL_UPLOAD_URL_TTL, CONTROL_MAP_MODES)
@@ -1,11 +1,282 @@
 import os
+import copy
 import fal_client
 import asyncio
 import logging
-from config import DEFAULT_MODEL, DEFAULT_PARAMS, CONTROLNET_MODELS, IP_ADAPTER_CONFIG
+import heapq
+import httpx
+import itertools
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from functools import cached_property
+from fal_client.auth import fetch_credentials
+from fal_client.client import USER_AGENT
+from cache import result_cache, request_key, is_deterministic
+from metrics import stage_seconds, track_stage
+from job_scheduler import generation_scheduler
+from quality_routing import QualityRouter, QualityTier
+from resilience import (
+    CircuitBreaker, LatencyTracker, UpstreamUnavailableError, backoff_delay, is_transient
+)
+from config import (
+    DEFAULT_MODEL, DEFAULT_PARAMS, CONTROLNET_MODELS, IP_ADAPTER_CONFIG,
+    FAL_BACKEND, FAL_HTTP_TIMEOUT, FAL_MAX_CONNECTIONS, FAL_MAX_KEEPALIVE_CONNECTIONS,
+    FAL_UPLOAD_WORKERS, FAL_GENERATE_WORKERS, FAL_SUBMIT_MODE, FAL_POLLERS,
+    FAL_POLL_MIN_INTERVAL, FAL_POLL_MAX_INTERVAL, FAL_DEADLINE, FAL_MODEL_DEADLINES,
+    FAL_MAX_RETRIES, FAL_RETRY_BASE_DELAY, FAL_RETRY_MAX_DELAY, FAL_HEDGE,
+    FAL_HEDGE_PERCENTILE, FAL_BREAKER_FAILURES, FAL_BREAKER_COOLDOWN, QUALITY_ROUTING,
+    QUALITY_REDUCED_STEPS, QUALITY_REDUCED_PENDING, QUALITY_REDUCED_P95, QUALITY_TURBO_MODEL,
+    QUALITY_TURBO_STEPS, QUALITY_TURBO_PENDING, QUALITY_TURBO_P95, QUALITY_EXIT_RATIO,
+    QUALITY_MIN_DWELL
+)
 
 logger = logging.getLogger(__name__)
 
+class PooledAsyncClient(fal_client.AsyncClient):
+    """fal_client.AsyncClient with an explicitly sized keep-alive connection pool"""
+
+    @cached_property
+    def _client(self):
+        key = self.key if self.key is not None else fetch_credentials()
+        return httpx.AsyncClient(
+            headers={
+                "Authorization": f"Key {key}",
+                "User-Agent": USER_AGENT,
+            },
+            timeout=self.default_timeout,
+            limits=httpx.Limits(
+                max_connections=FAL_MAX_CONNECTIONS,
+                max_keepalive_connections=FAL_MAX_KEEPALIVE_CONNECTIONS,
+            ),
+        )
+
+# Shared client: every upload and generation reuses the same connection pool
+fal_async_client = PooledAsyncClient(default_timeout=FAL_HTTP_TIMEOUT)
+
+# Dedicated executors for the blocking "thread" backend, created on first use
+_executors = {}
+
+def _get_executor(kind):
+    """Get the dedicated thread pool for uploads or generations"""
+    if kind not in _executors:
+        workers = FAL_UPLOAD_WORKERS if kind == "upload" else FAL_GENERATE_WORKERS
+        _executors[kind] = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"fal-{kind}")
+    return _executors[kind]
+
+class _PolledRequest:
+    """A request in the fal queue whose result is being waited for"""
+
+    def __init__(self, model, request_id, future, interval):
+        self.model = model
+        self.request_id = request_id
+        self.future = future
+        self.interval = interval
+        self.started = False
+        self.failures = 0
+        self.listeners = []
+        self.with_logs = False
+
+class QueuePoller:
+    """
+    Collects the results of requests submitted to the fal queue
+
+    Instead of one polling loop per job, pending requests sit in a heap
+    ordered by their next poll time and a few worker coroutines poll
+    whichever request is due. A request's poll interval grows by half on
+    every poll that finds it still waiting, up to ``max_interval``, and drops
+    back to ``min_interval`` once the job starts running, so long queues cost
+    few status calls while finished jobs are still noticed quickly.
+    """
+
+    # Consecutive failed polls after which a request is given up
+    MAX_FAILURES = 5
+
+    def __init__(self, workers=4, min_interval=0.5, max_interval=5.0):
+        self.workers = workers
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self._requests = {}
+        self._heap = []
+        self._order = itertools.count()
+        self._due = None
+        self._wakeup = None
+        self._tasks = []
+        # Set once close() starts, so waiters can tell a shutdown from other cancellations
+        self.closed = False
+
+    @property
+    def pending(self):
+        """Number of requests being polled"""
+        return len(self._requests)
+
+    def wait(self, model, request_id, on_progress=None, with_logs=False):
+        """
+        Wait for the result of a queued request
+
+        Several callers may wait for the same request; cancelling one of them
+        does not stop the polling.
+
+        Args:
+            model (str): The model the request was submitted to
+            request_id (str): The fal request id
+            on_progress (callable): Called with every polled status while
+                the caller waits
+            with_logs (bool): Whether the statuses should carry the logs
+
+        Returns:
+            asyncio.Future: Resolves to the request's result
+        """
+        self._start()
+        polled = self._requests.get(request_id)
+        if polled is None:
+            future = asyncio.get_running_loop().create_future()
+            polled = _PolledRequest(model, request_id, future, self.min_interval)
+            self._requests[request_id] = polled
+            self._schedule(polled, self.min_interval)
+        waiter = asyncio.shield(polled.future)
+        polled.with_logs = polled.with_logs or with_logs
+        if on_progress is not None:
+            polled.listeners.append(on_progress)
+            waiter.add_done_callback(lambda _: polled.listeners.remove(on_progress))
+        return waiter
+
+    def _start(self):
+        if self._tasks:
+            return
+        loop = asyncio.get_running_loop()
+        self._due = asyncio.Queue()
+        self._wakeup = asyncio.Event()
+        self._tasks = [loop.create_task(self._dispatch())]
+        self._tasks += [loop.create_task(self._work()) for _ in range(self.workers)]
+
+    def _schedule(self, polled, delay):
+        due = asyncio.get_running_loop().time() + delay
+        heapq.heappush(self._heap, (due, next(self._order), polled))
+        self._wakeup.set()
+
+    async def _dispatch(self):
+        """Hand requests to the workers as their poll time comes up"""
+        loop = asyncio.get_running_loop()
+        while True:
+            self._wakeup.clear()
+            now = loop.time()
+            while self._heap and self._heap[0][0] <= now:
+                self._due.put_nowait(heapq.heappop(self._heap)[2])
+            timeout = self._heap[0][0] - now if self._heap else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _work(self):
+        while True:
+            polled = await self._due.get()
+            try:
+                await self._poll(polled)
+            except Exception as e:
+                polled.failures += 1
+                if polled.failures >= self.MAX_FAILURES:
+                    logger.error("Giving up on queued request %s: %s", polled.request_id, e)
+                    self._finish(polled, error=e)
+                else:
+                    logger.warning("Failed to poll queued request %s: %s", polled.request_id, e)
+                    self._backoff(polled)
+
+    async def _poll(self, polled):
+        # Logs are only fetched when somebody shows them
+        status = await fal_async_client.status(
+            polled.model, polled.request_id, with_logs=polled.with_logs
+        )
+        polled.failures = 0
+        _notify_progress(polled.listeners, status)
+        if isinstance(status, fal_client.Completed):
+            result = await fal_async_client.result(polled.model, polled.request_id)
+            self._finish(polled, result=result)
+        elif isinstance(status, fal_client.InProgress) and not polled.started:
+            # Running jobs finish soon, poll them at the fastest rate again
+            polled.started = True
+            polled.interval = self.min_interval
+            self._schedule(polled, polled.interval)
+        else:
+            self._backoff(polled)
+
+    def _backoff(self, polled):
+        polled.interval = min(self.max_interval, polled.interval * 1.5)
+        self._schedule(polled, polled.interval)
+
+    def _finish(self, polled, result=None, error=None):
+        self._requests.pop(polled.request_id, None)
+        if error is not None:
+            polled.future.set_exception(error)
+        else:
+            polled.future.set_result(result)
+        # Nobody may be waiting any more; don't warn about an unretrieved error
+        polled.future.exception()
+
+    async def close(self):
+        self.closed = True
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        for polled in self._requests.values():
+            polled.future.cancel()
+        self._requests.clear()
+        self._heap.clear()
+
+def _notify_progress(listeners, status):
+    for listener in list(listeners):
+        try:
+            listener(status)
+        except Exception as e:
+            logger.warning("Progress callback failed: %s", e)
+
+# Create a global instance
+fal_queue_poller = QueuePoller(FAL_POLLERS, FAL_POLL_MIN_INTERVAL, FAL_POLL_MAX_INTERVAL)
+
+async def close_fal_client():
+    """Close the pooled HTTP connections and shut down the thread backends"""
+    await fal_queue_poller.close()
+    if "_client" in fal_async_client.__dict__:
+        await fal_async_client._client.aclose()
+        del fal_async_client.__dict__["_client"]
+    for executor in _executors.values():
+        executor.shutdown(wait=False)
+    _executors.clear()
+
+async def warm_fal_client():
+    """
+    Open the pooled connections to the fal queue and CDN, and start the
+    threads of the "thread" backend
+
+    Returns:
+        bool: False if fal.ai rejected FAL_KEY
+    """
+    if FAL_BACKEND == "thread":
+        loop = asyncio.get_running_loop()
+        for kind, workers in (("upload", FAL_UPLOAD_WORKERS), ("generate", FAL_GENERATE_WORKERS)):
+            executor = _get_executor(kind)
+            await asyncio.gather(*(loop.run_in_executor(executor, time.sleep, 0) for _ in range(workers)))
+
+    # The status of a request that does not exist: 404 with a valid key
+    response = await fal_async_client._client.get(
+        f"{fal_client.client.QUEUE_URL_FORMAT}{DEFAULT_MODEL}/requests/{uuid.UUID(int=0)}/status"
+    )
+    if response.status_code in (401, 403):
+        return False
+    # Any answer will do, the connection is what matters
+    await fal_async_client._client.get(fal_client.client.CDN_URL)
+    return True
+
+async def warm_model(model):
+    """Run a minimal generation so that the model's runners are up"""
+    handle = await fal_async_client.submit(
+        model,
+        arguments={"prompt": "warm-up", "num_inference_steps": 1, "image_size": "square", "num_images": 1}
+    )
+    await handle.get()
+
 async def upload_image(file_path):
     """
     Upload an image to fal.ai and get the URL
@@ -17,32 +288,77 @@ async def upload_image(file_path):
         str: URL of the uploaded image
     """
     try:
-        logger.info(f"Uploading image: {file_path}")
+        logger.info("Uploading image: %s", file_path)
         
-        # Use asyncio to run the synchronous fal_client.upload_file in a separate thread
-        loop = asyncio.get_event_loop()
-        url = await loop.run_in_executor(
-            None,
-            lambda: fal_client.upload_file(file_path)
-        )
+        with track_stage("upload"):
+            if FAL_BACKEND == "thread":
+                # Run the synchronous fal_client.upload_file on the dedicated upload pool
+                loop = asyncio.get_running_loop()
+                url = await loop.run_in_executor(
+                    _get_executor("upload"),
+                    lambda: fal_client.upload_file(file_path)
+                )
+            else:
+                url = await fal_async_client.upload_file(file_path)
+        
+        logger.info("Image uploaded successfully: %s", url)
+        return url
+    except Exception as e:
+        logger.error("Error uploading image: %s", e)
+        raise
+
+async def upload_image_bytes(data, content_type="image/jpeg"):
+    """
+    Upload in-memory image data to fal.ai and get the URL
+    
+    Args:
+        data (bytes): Encoded image data
+        content_type (str): MIME type of the data
+    
+    Returns:
+        str: URL of the uploaded image
+    """
+    try:
+        logger.info("Uploading %s bytes of %s", len(data), content_type)
+        
+        with track_stage("upload"):
+            if FAL_BACKEND == "thread":
+                # Run the synchronous fal_client.upload on the dedicated upload pool
+                loop = asyncio.get_running_loop()
+                url = await loop.run_in_executor(
+                    _get_executor("upload"),
+                    lambda: fal_client.upload(data, content_type)
+                )
+            else:
+                url = await fal_async_client.upload(data, content_type)
         
-        logger.info(f"Image uploaded successfully: {url}")
+        logger.info("Image uploaded successfully: %s", url)
         return url
     except Exception as e:
-        logger.error(f"Error uploading image: {str(e)}")
+        logger.error("Error uploading image: %s", e)
         raise
 
-async def generate_image(prompt, model=DEFAULT_MODEL, **kwargs):
+async def generate_image(prompt, model=DEFAULT_MODEL, on_enqueue=None, on_progress=None, **kwargs):
     """
     Generate an image using fal.ai API
     
     Args:
         prompt (str): The text prompt to generate the image from
         model (str): The model to use for generation
+        on_enqueue (callable): Called with the request id and model when the
+            job is accepted by the fal queue (FAL_SUBMIT_MODE=queue only);
+            may return a callable that is called if that submission is
+            abandoned, e.g. a failed attempt that is retried or a losing hedge
+        on_progress (callable): Called on the event loop with every fal queue
+            status (Queued with its position, InProgress with the logs so far,
+            Completed) while the job runs
         **kwargs: Additional parameters to pass to the model
     
     Returns:
-        dict: The API response containing the image URL
+        dict: The API response containing the image URL. Results of seeded
+            requests carry a "cache_key", and cached images may carry the
+            Telegram "file_id" of an earlier delivery. Requests routed to a
+            cheaper tier under load carry its name as "quality_tier".
     """
     try:
         # Combine default params with any custom params
@@ -50,25 +366,375 @@ async def generate_image(prompt, model=DEFAULT_MODEL, **kwargs):
         arguments.update(kwargs)
         arguments["prompt"] = prompt
         
-        logger.info(f"Generating image with prompt: {prompt[:100]}...")
+        # Under load, requests that left the step count and the seed to the bot get
+        # cheaper settings; seeded ones (the user's own and the final render of a
+        # preview, which shares its seed) must come out as asked
+        quality_tier = None
+        if QUALITY_ROUTING and model == DEFAULT_MODEL and "num_inference_steps" not in kwargs and "seed" not in kwargs:
+            model, quality_tier = _route_quality(arguments)
+        
+        # Seeded requests are repeatable, so serve them from the cache when possible
+        # and retry them on transient failures
+        idempotent = is_deterministic(arguments)
+        cache_key = request_key(model, arguments) if idempotent else None
+        if cache_key:
+            cached = result_cache.get(cache_key)
+            if cached is not None:
+                logger.info("Serving cached result for prompt: %s...", prompt[:100])
+                cached["cache_key"] = cache_key
+                return cached
         
-        # Use asyncio to run the synchronous fal_client.subscribe in a separate thread
-        loop = asyncio.get_event_loop()
-        result = await loop.run_in_executor(
-            None,
-            lambda: fal_client.subscribe(
-                model,
-                arguments=arguments,
-                with_logs=True
+        async def call_upstream(on_progress, on_enqueue):
+            logger.info("Generating image with prompt: %s...", prompt[:100])
+            started = time.monotonic()
+            result = await _resilient_call(model, arguments, on_enqueue, on_progress, idempotent)
+            seconds = time.monotonic() - started
+            if quality_router.last_recorded is None:
+                logger.info("First generation since startup took %.2fs", seconds)
+            quality_router.record(seconds)
+            logger.info("Image generated successfully")
+            if quality_tier and result:
+                result["quality_tier"] = quality_tier
+            if cache_key and result and result.get("images"):
+                result_cache.put(cache_key, result)
+                result["cache_key"] = cache_key
+            return result
+        
+        # Identical seeded requests already in flight share one upstream call
+        if cache_key:
+            return await _single_flight(cache_key, call_upstream, on_progress, on_enqueue)
+        return await call_upstream(on_progress, on_enqueue)
+    except Exception as e:
+        logger.error("Error generating image: %s", e)
+        raise
+
+async def _subscribe(model, arguments, on_enqueue=None, on_progress=None):
+    """Run one generation on the configured backend and wait for its result"""
+    with track_stage("generate"):
+        on_status = _timed_progress(on_progress)
+        if FAL_SUBMIT_MODE == "queue":
+            # Submit and let the shared pollers pick up the result
+            handle = await fal_async_client.submit(model, arguments=arguments)
+            logger.info("Queued request %s on %s", handle.request_id, model)
+            withdraw = on_enqueue(handle.request_id, model) if on_enqueue else None
+            try:
+                return await fal_queue_poller.wait(
+                    model, handle.request_id, on_status, with_logs=on_progress is not None
+                )
+            except Exception:
+                # A failed attempt must not be resumed after a restart
+                if withdraw:
+                    withdraw()
+                raise
+            except asyncio.CancelledError:
+                # Neither must a losing hedge or an attempt past its deadline, but a
+                # request cancelled by the shutdown is resumed after the restart
+                if withdraw and not fal_queue_poller.closed:
+                    withdraw()
+                raise
+        if FAL_BACKEND == "thread":
+            # Run the synchronous fal_client.subscribe on the dedicated generation pool;
+            # its status events are handed back to the event loop
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(
+                _get_executor("generate"),
+                lambda: fal_client.subscribe(
+                    model,
+                    arguments=arguments,
+                    with_logs=True,
+                    on_queue_update=lambda status: loop.call_soon_threadsafe(on_status, status)
+                )
             )
+        return await fal_async_client.subscribe(
+            model,
+            arguments=arguments,
+            with_logs=True,
+            on_queue_update=on_status
         )
-        
-        logger.info("Image generated successfully")
-        return result
+
+def _timed_progress(on_progress):
+    """Wrap a progress callback so the fal queue wait and the inference are timed"""
+    submitted = time.perf_counter()
+    started = None
+    completed = False
+    
+    def on_status(status):
+        nonlocal started, completed
+        now = time.perf_counter()
+        if started is None and not isinstance(status, fal_client.Queued):
+            started = now
+            stage_seconds.observe(now - submitted, stage="fal_queue")
+        if isinstance(status, fal_client.Completed) and not completed:
+            completed = True
+            stage_seconds.observe(now - started, stage="fal_inference")
+        if on_progress:
+            on_progress(status)
+    
+    return on_status
+
+async def wait_for_queued_result(model, request_id):
+    """
+    Wait for the result of a request submitted to the fal queue earlier
+    
+    Args:
+        model (str): The model the request was submitted to
+        request_id (str): The fal request id
+    
+    Returns:
+        dict: The API response containing the image URL
+    """
+    try:
+        logger.info("Resuming queued request %s on %s", request_id, model)
+        return await fal_queue_poller.wait(model, request_id)
     except Exception as e:
-        logger.error(f"Error generating image: {str(e)}")
+        logger.error("Error waiting for queued request %s: %s", request_id, e)
         raise
 
+# Quality tiers from full quality to the cheapest
+_quality_tiers = [
+    QualityTier("full"),
+    QualityTier("reduced", QUALITY_REDUCED_PENDING, QUALITY_REDUCED_P95, steps=QUALITY_REDUCED_STEPS),
+]
+if QUALITY_TURBO_MODEL:
+    _quality_tiers.append(QualityTier(
+        "turbo", QUALITY_TURBO_PENDING, QUALITY_TURBO_P95, steps=QUALITY_TURBO_STEPS, model=QUALITY_TURBO_MODEL
+    ))
+quality_router = QualityRouter(_quality_tiers, QUALITY_EXIT_RATIO, QUALITY_MIN_DWELL)
+
+def _route_quality(arguments):
+    """
+    Apply the quality tier for the current load to a request's arguments
+    
+    Returns:
+        tuple: The model to run the request on, and the name of the tier or
+            None at full quality
+    """
+    pending = generation_scheduler.inflight + generation_scheduler.queue_depth
+    image_to_image = "controlnet" in arguments or "ip_adapter" in arguments
+    tier = quality_router.route(pending, image_to_image)
+    if tier.steps is not None:
+        arguments["num_inference_steps"] = tier.steps
+    return tier.model or DEFAULT_MODEL, tier.name if tier is not quality_router.tiers[0] else None
+
+# Recent latencies and circuit breakers of each model
+latency_tracker = LatencyTracker()
+_breakers = {}
+
+# Counters describing how often the resilience policies kicked in
+resilience_stats = {
+    "retries": 0,
+    "hedges": 0,
+    "hedge_wins": 0,
+    "timeouts": 0,
+    "rejected": 0,
+}
+
+def circuit_breaker(model):
+    """Get the circuit breaker of a model"""
+    breaker = _breakers.get(model)
+    if breaker is None:
+        breaker = _breakers[model] = CircuitBreaker(FAL_BREAKER_FAILURES, FAL_BREAKER_COOLDOWN)
+    return breaker
+
+def upstream_unavailable(model=DEFAULT_MODEL):
+    """
+    Check whether a model's circuit breaker is rejecting calls
+    
+    Returns:
+        UpstreamUnavailableError: The error a call would fail with, or None
+    """
+    retry_in = circuit_breaker(model).retry_in()
+    return UpstreamUnavailableError(model, retry_in) if retry_in else None
+
+def circuit_breakers():
+    """
+    Get the circuit breakers of the models used so far
+    
+    Returns:
+        dict: Model -> CircuitBreaker
+    """
+    return dict(_breakers)
+
+async def _resilient_call(model, arguments, on_enqueue, on_progress, idempotent):
+    """
+    Run a generation under its model's deadline, circuit breaker, retry and hedging policies
+    
+    Only seeded requests are retried: the retry then returns the same image
+    the failed attempt would have. Every attempt counts against one overall
+    deadline.
+    """
+    breaker = circuit_breaker(model)
+    loop = asyncio.get_running_loop()
+    give_up_at = loop.time() + FAL_MODEL_DEADLINES.get(model, FAL_DEADLINE)
+    attempt = 0
+    while True:
+        try:
+            trial = breaker.before_call(model)
+        except Exception:
+            resilience_stats["rejected"] += 1
+            raise
+        started = loop.time()
+        try:
+            result = await asyncio.wait_for(
+                _hedged_call(model, arguments, on_enqueue, on_progress),
+                give_up_at - started
+            )
+        except asyncio.CancelledError:
+            breaker.record_neutral(trial)
+            raise
+        except Exception as e:
+            transient = is_transient(e)
+            if transient:
+                breaker.record_failure(model)
+            else:
+                breaker.record_neutral(trial)
+            if isinstance(e, asyncio.TimeoutError):
+                resilience_stats["timeouts"] += 1
+            remaining = give_up_at - loop.time()
+            if not (idempotent and transient) or attempt >= FAL_MAX_RETRIES or remaining <= 0:
+                raise
+            delay = backoff_delay(attempt, FAL_RETRY_BASE_DELAY, FAL_RETRY_MAX_DELAY)
+            if delay >= remaining:
+                raise
+            logger.warning("Retrying request on %s in %.1fs after: %s", model, delay, str(e) or type(e).__name__)
+            resilience_stats["retries"] += 1
+            attempt += 1
+            await asyncio.sleep(delay)
+            continue
+        breaker.record_success(model)
+        latency_tracker.record(model, loop.time() - started)
+        return result
+
+async def _hedged_call(model, arguments, on_enqueue, on_progress):
+    """
+    Run a generation, sending a second copy once the first is slower than usual
+    
+    With FAL_HEDGE enabled and enough latency samples, a hedge request is
+    launched when the first one outlives the model's FAL_HEDGE_PERCENTILE
+    latency. The first successful result wins and the other call is dropped.
+    """
+    threshold = latency_tracker.percentile(model, FAL_HEDGE_PERCENTILE) if FAL_HEDGE else None
+    if threshold is None:
+        return await _subscribe(model, arguments, on_enqueue, on_progress)
+    
+    primary = asyncio.ensure_future(_subscribe(model, arguments, on_enqueue, on_progress))
+    tasks = {primary}
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=threshold)
+        if done:
+            return primary.result()
+        logger.info("Hedging request on %s after %.1fs", model, threshold)
+        resilience_stats["hedges"] += 1
+        # Progress keeps coming from the primary request only
+        hedge = asyncio.ensure_future(_subscribe(model, arguments, on_enqueue))
+        tasks.add(hedge)
+        error = None
+        while tasks:
+            done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if task is hedge:
+                        resilience_stats["hedge_wins"] += 1
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in tasks:
+            task.cancel()
+
+class _Flight:
+    """An upstream call shared by every caller with the same request key"""
+
+    def __init__(self):
+        self.task = None
+        self.waiters = 0
+        self.listeners = []
+        self.enqueue_listeners = []
+        # request_id -> (model, withdraw callbacks) of the live submissions, for late joiners
+        self.enqueued = {}
+
+    def on_progress(self, status):
+        """Pass the upstream call's progress on to every waiter"""
+        _notify_progress(self.listeners, status)
+
+    def on_enqueue(self, request_id, model):
+        """Pass a fal queue submission on to every waiter, returning a callback withdrawing it from them"""
+        withdraws = []
+        self.enqueued[request_id] = (model, withdraws)
+        for listener in list(self.enqueue_listeners):
+            self.join_enqueue(listener, request_id)
+        
+        def withdraw():
+            self.enqueued.pop(request_id, None)
+            for callback in withdraws:
+                callback()
+        
+        return withdraw
+
+    def join_enqueue(self, listener, request_id):
+        """Tell a waiter about a live submission"""
+        model, withdraws = self.enqueued[request_id]
+        callback = listener(request_id, model)
+        if callback:
+            withdraws.append(callback)
+
+# Request key -> in-flight upstream call
+_flights = {}
+
+# Counters describing how often identical requests were coalesced
+coalescing_stats = {
+    "upstream_calls": 0,
+    "coalesced_calls": 0,
+    "abandoned_calls": 0,
+}
+
+async def _single_flight(key, call, on_progress=None, on_enqueue=None):
+    """
+    Run ``call`` once for all concurrent callers using the same key
+    
+    ``call`` gets a progress callback and an enqueue callback that reach
+    every caller's ``on_progress`` and ``on_enqueue``, including callers that
+    join later; those are first told about the submissions made so far, so
+    every caller can journal the request it is waiting for.
+    
+    Each caller waits on the shared task through ``asyncio.shield``, so a
+    caller that gives up (its job is cancelled) does not cancel the call for
+    the others. Only when the last waiter leaves is the upstream call itself
+    cancelled. Every caller gets its own copy of the result.
+    """
+    flight = _flights.get(key)
+    if flight is None:
+        flight = _Flight()
+        flight.task = asyncio.ensure_future(call(flight.on_progress, flight.on_enqueue))
+        _flights[key] = flight
+        flight.task.add_done_callback(lambda _: _flights.pop(key, None) if _flights.get(key) is flight else None)
+        coalescing_stats["upstream_calls"] += 1
+    else:
+        coalescing_stats["coalesced_calls"] += 1
+        logger.info("Joining in-flight request %s (%s already waiting)", key[:12], flight.waiters)
+    
+    flight.waiters += 1
+    if on_progress is not None:
+        flight.listeners.append(on_progress)
+    if on_enqueue is not None:
+        for request_id in list(flight.enqueued):
+            flight.join_enqueue(on_enqueue, request_id)
+        flight.enqueue_listeners.append(on_enqueue)
+    try:
+        result = await asyncio.shield(flight.task)
+    finally:
+        flight.waiters -= 1
+        if on_progress is not None:
+            flight.listeners.remove(on_progress)
+        if on_enqueue is not None:
+            flight.enqueue_listeners.remove(on_enqueue)
+        if flight.waiters == 0 and not flight.task.done():
+            logger.info("All waiters left request %s, cancelling it", key[:12])
+            coalescing_stats["abandoned_calls"] += 1
+            flight.task.cancel()
+            _flights.pop(key, None)
+    return copy.deepcopy(result)
+
 async def generate_with_controlnet(prompt, image_url, controlnet_type="canny", model=DEFAULT_MODEL, **kwargs):
     """
     Generate an image using ControlNet
@@ -106,7 +772,7 @@ async def generate_with_controlnet(prompt, image_url, controlnet_type="canny", m
         # Generate the image
         return await generate_image(prompt, model, **kwargs)
     except Exception as e:
-        logger.error(f"Error generating with controlnet: {str(e)}")
+        logger.error("Error generating with controlnet: %s", e)
         raise
 
 async def generate_with_ip_adapter(prompt, image_url, model=DEFAULT_MODEL, **kwargs):
@@ -137,5 +803,5 @@ async def generate_with_ip_adapter(prompt, image_url, model=DEFAULT_MODEL, **kwa
         # Generate the image
         return await generate_image(prompt, model, **kwargs)
     except Exception as e:
-        logger.error(f"Error generating with IP-Adapter: {str(e)}")
+        logger.error("Error generating with IP-Adapter: %s", e)
         raise
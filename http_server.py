@@ -0,0 +1,173 @@
+import asyncio
+import logging
+from urllib.parse import urlsplit, parse_qs
+
+logger = logging.getLogger(__name__)
+
+# Requests with a larger body, more headers or a larger head are rejected
+MAX_BODY_SIZE = 4 * 1024 * 1024
+MAX_HEADER_COUNT = 100
+MAX_HEADER_SIZE = 16 * 1024
+
+# Seconds a keep-alive connection may wait for its next request, and a
+# started request for the rest of its head and body
+IDLE_TIMEOUT = 75
+READ_TIMEOUT = 30
+
+REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    403: "Forbidden",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    408: "Request Timeout",
+    413: "Payload Too Large",
+    431: "Request Header Fields Too Large",
+    500: "Internal Server Error",
+    503: "Service Unavailable",
+}
+
+class HttpRequest:
+    def __init__(self, method, target, headers, body):
+        parts = urlsplit(target)
+        self.method = method
+        self.path = parts.path
+        self.query = parse_qs(parts.query)
+        self.headers = headers
+        self.body = body
+
+class _BadRequest(Exception):
+    """A request that cannot be read; answered with ``status`` before closing the connection"""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+class HttpResponse:
+    def __init__(self, status=200, body=b"", content_type="text/plain; charset=utf-8"):
+        self.status = status
+        self.body = body.encode("utf-8") if isinstance(body, str) else body
+        self.content_type = content_type
+
+async def start_http_server(handler, host, port):
+    """
+    Start a minimal HTTP/1.1 server
+
+    Only what the bot's endpoints need is supported: Content-Length bodies
+    and keep-alive connections, no chunked requests and no TLS (terminate TLS
+    in a reverse proxy). Idle and slow connections are closed after
+    IDLE_TIMEOUT and READ_TIMEOUT, and requests with too many or too large
+    headers or invalid framing get an error response.
+
+    Args:
+        handler (callable): Coroutine function taking an HttpRequest and
+            returning an HttpResponse
+        host (str): Interface to listen on
+        port (int): Port to listen on
+
+    Returns:
+        asyncio.Server: The running server
+    """
+    async def on_connection(reader, writer):
+        try:
+            while await _serve_request(reader, writer, handler):
+                pass
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            pass
+        except Exception as e:
+            logger.error("HTTP connection error: %s", e)
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(on_connection, host, port)
+    logger.info("HTTP server listening on %s:%s", host, port)
+    return server
+
+async def _serve_request(reader, writer, handler):
+    """Serve one request; returns whether the connection should stay open"""
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), IDLE_TIMEOUT)
+    except asyncio.TimeoutError:
+        return False
+    except ValueError:
+        # Longer than the stream's line limit
+        await _write_response(writer, HttpResponse(400, "Request line too long"), False)
+        return False
+    if not request_line:
+        return False
+    try:
+        request, version = await asyncio.wait_for(_read_request(reader, request_line), READ_TIMEOUT)
+    except asyncio.TimeoutError:
+        await _write_response(writer, HttpResponse(408, "Request timeout"), False)
+        return False
+    except _BadRequest as e:
+        await _write_response(writer, HttpResponse(e.status, str(e)), False)
+        return False
+    connection = request.headers.get("connection", "").lower()
+    keep_alive = connection != "close" if version == "HTTP/1.1" else connection == "keep-alive"
+
+    try:
+        response = await handler(request)
+    except Exception as e:
+        logger.error("Error handling %s %s: %s", request.method, request.path, e)
+        response = HttpResponse(500, "Internal error")
+
+    await _write_response(writer, response, keep_alive)
+    return keep_alive
+
+async def _read_request(reader, request_line):
+    """
+    Read the headers and body of a request after its request line
+
+    Returns:
+        tuple: The HttpRequest and its HTTP version
+
+    Raises:
+        _BadRequest: The request is malformed or over the limits
+    """
+    try:
+        method, target, version = request_line.decode("latin-1").split()
+    except ValueError:
+        raise _BadRequest(400, "Malformed request line")
+
+    headers = {}
+    size = len(request_line)
+    while True:
+        try:
+            line = await reader.readline()
+        except ValueError:
+            raise _BadRequest(431, "Header line too long")
+        if not line:
+            raise asyncio.IncompleteReadError(b"", None)
+        if line in (b"\r\n", b"\n"):
+            break
+        size += len(line)
+        if len(headers) >= MAX_HEADER_COUNT or size > MAX_HEADER_SIZE:
+            raise _BadRequest(431, "Too many or too large headers")
+        name, separator, value = line.decode("latin-1").partition(":")
+        if not separator or not name.strip():
+            raise _BadRequest(400, "Malformed header")
+        headers[name.strip().lower()] = value.strip()
+
+    if "transfer-encoding" in headers:
+        raise _BadRequest(400, "Chunked requests are not supported")
+    length = headers.get("content-length") or "0"
+    if not (length.isascii() and length.isdigit()):
+        raise _BadRequest(400, "Invalid Content-Length")
+    length = int(length)
+    if length > MAX_BODY_SIZE:
+        raise _BadRequest(413, "Body too large")
+    body = await reader.readexactly(length) if length else b""
+    return HttpRequest(method, target, headers, body), version
+
+async def _write_response(writer, response, keep_alive):
+    reason = REASONS.get(response.status, "Unknown")
+    head = (
+        f"HTTP/1.1 {response.status} {reason}\r\n"
+        f"Content-Type: {response.content_type}\r\n"
+        f"Content-Length: {len(response.body)}\r\n"
+        f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n"
+        "\r\n"
+    )
+    writer.write(head.encode("latin-1") + response.body)
+    await writer.drain()
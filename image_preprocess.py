@@ -0,0 +1,110 @@
+"""
+Preparation of control and reference images before they are uploaded.
+
+ControlNet and IP-Adapter resize their input to the generation resolution on
+the fal side anyway, so the bot fetches the smallest Telegram size that still
+covers IMAGE_TARGET_SIZE and downscales anything larger before the upload.
+Decoding and encoding run in a process pool to keep them off the event loop.
+Without Pillow installed images are uploaded as downloaded.
+"""
+import asyncio
+import io
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from config import IMAGE_TARGET_SIZE, IMAGE_JPEG_QUALITY, IMAGE_WORKERS
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+# Created on first use; each webhook worker process gets its own
+_pool = None
+
+async def run_in_image_pool(func, *args):
+    """Run a picklable function in the image process pool"""
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=IMAGE_WORKERS)
+    return await asyncio.get_running_loop().run_in_executor(_pool, func, *args)
+
+def _ready():
+    return True
+
+async def warm_image_pool():
+    """Start the image worker processes ahead of the first photo"""
+    if Image is None:
+        return
+    await asyncio.gather(*(run_in_image_pool(_ready) for _ in range(IMAGE_WORKERS)))
+
+def select_photo_size(sizes, target=IMAGE_TARGET_SIZE):
+    """
+    Pick the smallest Telegram PhotoSize whose long side covers the target
+
+    Args:
+        sizes (list): The PhotoSize objects of a message, smallest first
+        target (int): The wanted long side in pixels, 0 for the full size
+
+    Returns:
+        PhotoSize: The smallest adequate size, or the largest one if none is
+            big enough
+    """
+    if not target:
+        return sizes[-1]
+    for size in sorted(sizes, key=lambda size: size.width * size.height):
+        if max(size.width, size.height) >= target:
+            return size
+    return sizes[-1]
+
+def _downscale(data, max_side, quality):
+    """Fit an encoded image into max_side x max_side and re-encode it as JPEG"""
+    with Image.open(io.BytesIO(data)) as image:
+        if max(image.size) <= max_side:
+            return None
+        image = ImageOps.exif_transpose(image)
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        image.thumbnail((max_side, max_side), Image.LANCZOS)
+        output = io.BytesIO()
+        image.save(output, "JPEG", quality=quality, optimize=True)
+        return output.getvalue()
+
+async def prepare_image(data, content_type, width=None, height=None):
+    """
+    Downscale an image to IMAGE_TARGET_SIZE for upload
+
+    Args:
+        data (bytes): The encoded image
+        content_type (str): Its MIME type
+        width (int): Its width if known, to skip images that already fit
+        height (int): Its height if known
+
+    Returns:
+        tuple: The image data and MIME type to upload, unchanged if the image
+            already fits, Pillow is missing or re-encoding would not help
+    """
+    if Image is None or not IMAGE_TARGET_SIZE:
+        return data, content_type
+    if width and height and max(width, height) <= IMAGE_TARGET_SIZE:
+        return data, content_type
+
+    try:
+        resized = await run_in_image_pool(_downscale, data, IMAGE_TARGET_SIZE, IMAGE_JPEG_QUALITY)
+    except Exception as e:
+        # The original is still a valid upload
+        logger.error("Error downscaling image: %s", e)
+        return data, content_type
+
+    if resized is None or len(resized) >= len(data):
+        return data, content_type
+    logger.info("Downscaled image from %s to %s bytes", len(data), len(resized))
+    return resized, "image/jpeg"
+
+def close_image_pool():
+    """Shut down the image process pool"""
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
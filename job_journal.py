@@ -0,0 +1,115 @@
+import json
+import os
+import time
+from config import JOB_JOURNAL_PATH, JOB_JOURNAL_COMPACT_EVERY
+
+class JobJournal:
+    """
+    Append-only journal of generation jobs submitted to the fal queue
+
+    Every submitted job is written as a "submitted" record holding what is
+    needed to deliver its result later (chat, status message, caption), and
+    a "done" record is appended once it has been delivered or has failed.
+    After a restart the jobs without a "done" record are resumed. Records
+    are keyed by delivery, so several chats waiting on one shared request
+    each get their own. The journal is compacted every ``compact_every``
+    "done" records. ``stop`` ends recording at shutdown, so jobs cancelled
+    while the bot stops stay pending.
+    """
+
+    def __init__(self, path, compact_every=1000):
+        self.path = path
+        self.compact_every = compact_every
+        self._file = None
+        self._done_since_compact = 0
+        self._stopped = False
+
+    def set_path(self, path):
+        """Point the journal at another file, e.g. one per webhook worker"""
+        self.close()
+        self.path = path
+
+    def _append(self, record):
+        if self._stopped:
+            return
+        if self._file is None:
+            self._file = open(self.path, "a", encoding="utf-8")
+        self._file.write(json.dumps(record, separators=(",", ":")) + "\n")
+        # Flushed to the OS right away so a crash of the process keeps the record
+        self._file.flush()
+
+    def submitted(self, request_id, model, key=None, **delivery):
+        """
+        Record a job that was accepted by the fal queue
+
+        Args:
+            request_id (str): The fal request id
+            model (str): The model it was submitted to
+            key (str): Identifies this delivery of the request; defaults to
+                the request id
+            **delivery: What is needed to deliver the result
+        """
+        self._append({"event": "submitted", "key": key or request_id, "request_id": request_id,
+                      "model": model, "time": time.time(), **delivery})
+
+    def done(self, key):
+        """Record that a delivery needs no more work"""
+        self._append({"event": "done", "key": key})
+        self._done_since_compact += 1
+        if self.compact_every and self._done_since_compact >= self.compact_every:
+            self.compact()
+
+    def pending(self):
+        """
+        Replay the journal
+
+        Returns:
+            list: "submitted" records of the jobs that have no "done" record
+        """
+        jobs = {}
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # A torn last line from a crash
+                    continue
+                # Journals written before keys were added use the request id
+                key = record.get("key", record.get("request_id"))
+                if record.get("event") == "submitted":
+                    jobs[key] = record
+                elif record.get("event") == "done":
+                    jobs.pop(key, None)
+        return list(jobs.values())
+
+    def compact(self):
+        """
+        Rewrite the journal with only the pending jobs
+
+        Returns:
+            list: The pending jobs
+        """
+        pending = self.pending()
+        self.close()
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for record in pending:
+                f.write(json.dumps(record, separators=(",", ":")) + "\n")
+        os.replace(tmp_path, self.path)
+        self._done_since_compact = 0
+        return pending
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def stop(self):
+        """Close the journal and ignore further records, e.g. of jobs cancelled by the shutdown"""
+        self._stopped = True
+        self.close()
+
+# Create a global instance
+job_journal = JobJournal(JOB_JOURNAL_PATH, JOB_JOURNAL_COMPACT_EVERY)
@@ -0,0 +1,243 @@
+import asyncio
+import itertools
+import logging
+from collections import OrderedDict, deque
+from enum import IntEnum
+from config import MAX_INFLIGHT_GENERATIONS, MAX_GENERATIONS_PER_USER
+from log_pipeline import bind_log_context
+
+logger = logging.getLogger(__name__)
+
+class Priority(IntEnum):
+    HIGH = 0
+    NORMAL = 1
+    LOW = 2
+
+# Share of dispatch turns each tier gets while several tiers have work queued;
+# lower tiers are slowed down under load but never starved
+PRIORITY_WEIGHTS = {
+    Priority.HIGH: 4,
+    Priority.NORMAL: 2,
+    Priority.LOW: 1,
+}
+
+class GenerationJob:
+    """A queued unit of generation work owned by one user"""
+
+    _ids = itertools.count(1)
+
+    def __init__(self, user_id, run, priority, on_position):
+        self.job_id = next(self._ids)
+        self.user_id = user_id
+        self.run = run
+        self.priority = priority
+        self.on_position = on_position
+        self.position = None
+        self.task = None
+        self.cancelled = False
+
+class GenerationScheduler:
+    """
+    Central scheduler between the bot handlers and fal_client_wrapper.
+
+    Every user has their own FIFO queue inside a priority tier. Tiers are
+    served by smooth weighted round-robin, users within a tier by plain
+    round-robin, so one user submitting many prompts only ever gets their
+    fair share of the upstream capacity. At most ``max_inflight`` jobs run
+    at once, and at most ``max_per_user`` of them belong to the same user.
+    """
+
+    def __init__(self, max_inflight, max_per_user=1):
+        self.max_inflight = max_inflight
+        self.max_per_user = max_per_user
+        # priority -> OrderedDict(user_id -> deque of jobs), in round-robin order
+        self._tiers = {priority: OrderedDict() for priority in Priority}
+        self._tier_credit = {priority: 0 for priority in Priority}
+        self._user_inflight = {}
+        self._inflight = 0
+        self._queued = 0
+        # Strong references to running job and notification tasks
+        self._tasks = set()
+
+    @property
+    def inflight(self):
+        """int: Number of jobs currently running"""
+        return self._inflight
+
+    @property
+    def queue_depth(self):
+        """int: Number of jobs waiting for a slot"""
+        return self._queued
+
+    def submit(self, user_id, run, priority=Priority.NORMAL, on_position=None):
+        """
+        Queue a job and start it as soon as the fairness policy allows
+
+        Args:
+            user_id (int): Owner of the job, used for fairness
+            run (callable): Coroutine function doing the generation and delivery
+            priority (Priority): Priority tier of the job
+            on_position (callable): Optional coroutine function called with the
+                job's queue position whenever it changes, with 0 when it starts
+                and with None if it is cancelled before starting
+
+        Returns:
+            GenerationJob: The queued job
+        """
+        job = GenerationJob(user_id, run, priority, on_position)
+        self._tiers[priority].setdefault(user_id, deque()).append(job)
+        self._queued += 1
+        logger.info("Queued job %s for user %s with priority %s", job.job_id, user_id, priority.name)
+        self._pump()
+        return job
+
+    def cancel_pending(self, user_id):
+        """
+        Drop all of a user's jobs that have not started yet
+
+        Returns:
+            int: Number of jobs removed
+        """
+        removed = 0
+        for users in self._tiers.values():
+            queue = users.pop(user_id, None)
+            if queue:
+                for job in queue:
+                    job.cancelled = True
+                    if job.on_position is not None:
+                        self._notify(job, None)
+                removed += len(queue)
+        if removed:
+            self._queued -= removed
+            logger.info("Cancelled %s queued jobs for user %s", removed, user_id)
+            self._report_positions()
+        return removed
+
+    def _pump(self):
+        """Start queued jobs while there is free capacity"""
+        while self._inflight < self.max_inflight:
+            job = self._next_job()
+            if job is None:
+                break
+            self._start(job)
+        self._report_positions()
+
+    def _next_job(self):
+        """Pop the next dispatchable job according to the fairness policy"""
+        eligible = {
+            priority: user_id
+            for priority, users in self._tiers.items()
+            if (user_id := self._first_ready_user(users)) is not None
+        }
+        if not eligible:
+            return None
+
+        # Smooth weighted round-robin between tiers that have runnable work
+        total = 0
+        for priority in eligible:
+            self._tier_credit[priority] += PRIORITY_WEIGHTS[priority]
+            total += PRIORITY_WEIGHTS[priority]
+        chosen = max(eligible, key=lambda priority: (self._tier_credit[priority], -priority))
+        self._tier_credit[chosen] -= total
+
+        users = self._tiers[chosen]
+        user_id = eligible[chosen]
+        queue = users[user_id]
+        job = queue.popleft()
+        if queue:
+            users.move_to_end(user_id)
+        else:
+            del users[user_id]
+        self._queued -= 1
+        return job
+
+    def _first_ready_user(self, users):
+        """Return the first user in round-robin order below their in-flight budget"""
+        for user_id in users:
+            if self._user_inflight.get(user_id, 0) < self.max_per_user:
+                return user_id
+        return None
+
+    def _start(self, job):
+        self._inflight += 1
+        self._user_inflight[job.user_id] = self._user_inflight.get(job.user_id, 0) + 1
+        job.position = 0
+        if job.on_position is not None:
+            self._notify(job, 0)
+        job.task = self._spawn(self._run(job))
+
+    async def _run(self, job):
+        bind_log_context(user_id=job.user_id, job_id=job.job_id)
+        try:
+            await job.run()
+        except asyncio.CancelledError:
+            logger.info("Job %s for user %s was cancelled", job.job_id, job.user_id)
+            raise
+        except Exception as e:
+            logger.error("Job %s for user %s failed: %s", job.job_id, job.user_id, e)
+        finally:
+            self._inflight -= 1
+            remaining = self._user_inflight[job.user_id] - 1
+            if remaining:
+                self._user_inflight[job.user_id] = remaining
+            else:
+                del self._user_inflight[job.user_id]
+            self._pump()
+
+    def _dispatch_order(self):
+        """
+        Simulate the dispatch policy on a copy of the queues
+
+        Per-user in-flight budgets are ignored, so positions are an estimate.
+        """
+        tiers = {
+            priority: OrderedDict((user_id, deque(queue)) for user_id, queue in users.items())
+            for priority, users in self._tiers.items()
+        }
+        credit = dict(self._tier_credit)
+        while True:
+            eligible = [priority for priority, users in tiers.items() if users]
+            if not eligible:
+                return
+            total = sum(PRIORITY_WEIGHTS[priority] for priority in eligible)
+            for priority in eligible:
+                credit[priority] += PRIORITY_WEIGHTS[priority]
+            chosen = max(eligible, key=lambda priority: (credit[priority], -priority))
+            credit[chosen] -= total
+
+            users = tiers[chosen]
+            user_id, queue = next(iter(users.items()))
+            yield queue.popleft()
+            if queue:
+                users.move_to_end(user_id)
+            else:
+                del users[user_id]
+
+    def _report_positions(self):
+        """Tell every queued job whose position changed where it now stands"""
+        if not self._queued:
+            return
+        for position, job in enumerate(self._dispatch_order(), start=1):
+            if job.position != position:
+                job.position = position
+                if job.on_position is not None:
+                    self._notify(job, position)
+
+    def _notify(self, job, position):
+        async def notify():
+            # The task may be spawned by another job's task, don't log under its ids
+            bind_log_context(user_id=job.user_id, job_id=job.job_id)
+            try:
+                await job.on_position(position)
+            except Exception as e:
+                logger.debug("Could not report position of job %s: %s", job.job_id, e)
+        self._spawn(notify())
+
+    def _spawn(self, coroutine):
+        task = asyncio.create_task(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+# Create a global instance
+generation_scheduler = GenerationScheduler(MAX_INFLIGHT_GENERATIONS, MAX_GENERATIONS_PER_USER)
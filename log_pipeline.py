@@ -0,0 +1,188 @@
+"""
+Non-blocking, structured logging.
+
+Log calls only put the record on a bounded queue; a background thread formats
+and writes it, so the event loop never waits on stdout or the container's log
+driver. Records whose lazy ``%s`` arguments are all immutable primitives are
+queued unformatted, which keeps the cost of a call on the loop to a few
+attribute lookups; any other record is formatted before it is queued, so the
+writer never sees an object that changed after the call. When the writer
+falls behind, records are dropped and counted instead of blocking.
+
+Every record carries the context bound with ``bind_log_context`` in the task
+that logged it: the user id of the update being handled and the id of the
+generation job being run. In JSON mode they are written as fields. INFO
+records of high-frequency loggers, such as session state changes, are
+sampled per message template; warnings and errors are always kept.
+"""
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+from datetime import datetime, timezone
+
+# Record attributes written as JSON fields when present
+CONTEXT_FIELDS = ("user_id", "job_id", "worker_id", "sampled")
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# Types of log arguments that can safely be formatted on the writer thread
+IMMUTABLE_ARG_TYPES = (str, int, float, bool, bytes, type(None))
+
+_context = contextvars.ContextVar("log_context", default={})
+
+def bind_log_context(**fields):
+    """
+    Attach fields to every record logged from the current task and the
+    tasks it creates
+
+    Args:
+        **fields: Context such as user_id or job_id
+    """
+    _context.set({**_context.get(), **fields})
+
+class ContextFilter(logging.Filter):
+    """Copies the bound context onto the record in the thread that logs it"""
+
+    def filter(self, record):
+        for key, value in _context.get().items():
+            if not hasattr(record, key):
+                setattr(record, key, value)
+        return True
+
+class SamplingFilter(logging.Filter):
+    """
+    Keeps one in every ``1 / rate`` INFO and DEBUG records of each message
+    template of the given loggers
+
+    Kept records get a ``sampled`` attribute with the number of records they
+    stand for.
+    """
+
+    def __init__(self, loggers, rate):
+        super().__init__()
+        self.loggers = loggers
+        self.every = max(1, round(1 / rate)) if rate > 0 else 0
+        self._counts = {}
+
+    def filter(self, record):
+        if record.levelno > logging.INFO or record.name.partition(".")[0] not in self.loggers:
+            return True
+        if not self.every:
+            return False
+        key = (record.name, record.msg)
+        count = self._counts.get(key, 0)
+        self._counts[key] = count + 1
+        if count % self.every:
+            return False
+        if self.every > 1:
+            record.sampled = self.every
+        return True
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, with the context fields of the record"""
+
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for field in CONTEXT_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """Queues records, dropping them while the queue is full"""
+
+    def __init__(self, record_queue):
+        super().__init__(record_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Formatting happens on the writer thread, unless the message or an
+        # argument may still change before it gets there
+        args = record.args
+        if not isinstance(record.msg, str) or (args and not (
+            isinstance(args, tuple) and all(type(arg) in IMMUTABLE_ARG_TYPES for arg in args)
+        )):
+            record.msg = record.getMessage()
+            record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+class _Listener(logging.handlers.QueueListener):
+    def enqueue_sentinel(self):
+        # Wait for room: the records before the sentinel are still written
+        self.queue.put(self._sentinel)
+
+class LogPipeline:
+    """The root logger's queue and the thread writing it out"""
+
+    def __init__(self):
+        self.handler = None
+        self._listener = None
+        self._pid = None
+
+    @property
+    def dropped(self):
+        """int: Records dropped because the writer fell behind"""
+        return self.handler.dropped if self.handler is not None else 0
+
+    def start(self, level="INFO", format="text", sampled_loggers=(), sample_rate=1.0, queue_size=10000):
+        """
+        Route the root logger through the queue; repeated calls in the same
+        process are ignored
+
+        Args:
+            level (str): Level of the root logger
+            format (str): "text" or "json"
+            sampled_loggers (set): Top-level logger names whose INFO records
+                are sampled
+            sample_rate (float): Share of those records that are kept
+            queue_size (int): Records that may wait for the writer
+        """
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+
+        output = logging.StreamHandler()
+        output.setFormatter(JsonFormatter() if format == "json" else logging.Formatter(TEXT_FORMAT))
+        record_queue = queue.Queue(queue_size)
+        self.handler = NonBlockingQueueHandler(record_queue)
+        self.handler.addFilter(ContextFilter())
+        if sampled_loggers and sample_rate < 1:
+            self.handler.addFilter(SamplingFilter(sampled_loggers, sample_rate))
+
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        root.addHandler(self.handler)
+        root.setLevel(level)
+
+        self._listener = _Listener(record_queue, output, respect_handler_level=True)
+        self._listener.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        """Write out the queued records and stop the writer thread"""
+        if self._listener is not None:
+            logging.getLogger().removeHandler(self.handler)
+            self._listener.stop()
+            self._listener = None
+
+# Create a global instance
+log_pipeline = LogPipeline()
@@ -1,27 +1,84 @@
 import logging
 import os
+import sys
+from telegram import Update
+from telegram.error import InvalidToken
 from telegram.ext import (
     Application, CommandHandler, MessageHandler, 
-    filters, CallbackQueryHandler
+    filters, CallbackQueryHandler, TypeHandler
+)
+from config import (
+    TELEGRAM_BOT_TOKEN, TELEGRAM_BASE_URL, TELEGRAM_BASE_FILE_URL, MAX_CONCURRENT_UPDATES,
+    MAX_PENDING_UPDATES, BOT_MODE, LOG_LEVEL, LOG_FORMAT, LOG_QUEUE_SIZE, LOG_SAMPLED_LOGGERS,
+    LOG_SAMPLE_RATE
 )
-from config import TELEGRAM_BOT_TOKEN
 from bot_handlers import (
     start_command, help_command, generate_command, text_message,
     controlnet_command, ipadapter_command, cancel_command,
-    photo_message, button_callback
+    photo_message, button_callback, resume_journaled_jobs, load_session
 )
+from admission import admission
+from control_maps import control_map_store
+from fal_client_wrapper import close_fal_client
+from image_preprocess import close_image_pool
+from job_journal import job_journal
+from log_pipeline import log_pipeline
+from telegram_sender import outbound
+from metrics_server import metrics_server
+from update_processor import UserOrderedUpdateProcessor
+from user_state import state_manager
+from warmup import check_settings, warmer
 
-# Set up logging
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
+# Set up logging; records are written by a background thread
+log_pipeline.start(LOG_LEVEL, LOG_FORMAT, LOG_SAMPLED_LOGGERS, LOG_SAMPLE_RATE, LOG_QUEUE_SIZE)
 logger = logging.getLogger(__name__)
 
-def main():
-    """Start the bot."""
-    # Create the Application instance
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+async def post_init(application: Application):
+    """Start background tasks once the event loop is running."""
+    await metrics_server.start()
+    state_manager.start_write_behind()
+    admission.start()
+    await resume_journaled_jobs(application.bot)
+    await warmer.start()
+    metrics_server.ready = True
+
+async def post_shutdown(application: Application):
+    """Release shared resources once the bot has stopped."""
+    metrics_server.ready = False
+    await warmer.close()
+    await state_manager.close()
+    await admission.close()
+    # Deliver what is still queued before the HTTP connections go away
+    await outbound.close()
+    # Jobs still waiting for fal are cancelled next; keep them journaled for the restart
+    job_journal.stop()
+    await control_map_store.close()
+    await close_fal_client()
+    close_image_pool()
+    await metrics_server.stop()
+
+def build_application(with_updater=True):
+    """Create the Application with all handlers registered."""
+    # Updates from different users are handled concurrently, each user's
+    # updates stay in order
+    builder = (
+        Application.builder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .concurrent_updates(UserOrderedUpdateProcessor(MAX_CONCURRENT_UPDATES, MAX_PENDING_UPDATES))
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+    )
+    if TELEGRAM_BASE_URL:
+        builder = builder.base_url(TELEGRAM_BASE_URL)
+    if TELEGRAM_BASE_FILE_URL:
+        builder = builder.base_file_url(TELEGRAM_BASE_FILE_URL)
+    if not with_updater:
+        # Webhook workers receive their updates from the front process
+        builder = builder.updater(None)
+    application = builder.build()
+
+    # Load the user's session before any handler reads it
+    application.add_handler(TypeHandler(Update, load_session), group=-1)
 
     # Add command handlers
     application.add_handler(CommandHandler("start", start_command))
@@ -37,10 +94,32 @@ def main():
     
     # Add callback query handler for inline buttons
     application.add_handler(CallbackQueryHandler(button_callback))
+    return application
+
+def main():
+    """Start the bot."""
+    problems = check_settings()
+    if problems:
+        for problem in problems:
+            logger.error(problem)
+        sys.exit(1)
+
+    try:
+        if BOT_MODE == "webhook":
+            # Imported here so polling deployments never load the webhook front end
+            from webhook import run_webhook
+            logger.info("Starting bot in webhook mode...")
+            run_webhook()
+            return
+
+        application = build_application()
 
-    # Start the Bot
-    logger.info("Starting bot...")
-    application.run_polling()
+        # Start the Bot
+        logger.info("Starting bot...")
+        application.run_polling()
+    except InvalidToken:
+        logger.error("Telegram rejected TELEGRAM_BOT_TOKEN, please check it")
+        sys.exit(1)
 
 if __name__ == '__main__':
     main()
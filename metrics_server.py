@@ -0,0 +1,125 @@
+from config import METRICS_LISTEN, METRICS_PORT, DEFAULT_MODEL
+from control_maps import control_map_store
+from fal_client_wrapper import (
+    fal_queue_poller, coalescing_stats, resilience_stats, circuit_breaker, circuit_breakers,
+    quality_router
+)
+from http_server import HttpResponse, start_http_server
+from job_scheduler import generation_scheduler
+from log_pipeline import log_pipeline
+from metrics import Gauge, render_metrics
+from telegram_sender import outbound
+from user_state import state_manager
+from warmup import warmer
+
+Gauge(
+    "chilloutai_generations_in_flight",
+    "Generation jobs currently running",
+    lambda: generation_scheduler.inflight
+)
+Gauge(
+    "chilloutai_generation_queue_depth",
+    "Generation jobs waiting for a slot",
+    lambda: generation_scheduler.queue_depth
+)
+Gauge(
+    "chilloutai_outbound_queue_depth",
+    "Telegram requests waiting for the rate limiter",
+    lambda: outbound.queue_depth
+)
+Gauge(
+    "chilloutai_sessions",
+    "User sessions held in memory",
+    lambda: len(state_manager.user_sessions)
+)
+Gauge(
+    "chilloutai_fal_queued_requests",
+    "Requests in the fal queue being polled",
+    lambda: fal_queue_poller.pending
+)
+Gauge(
+    "chilloutai_fal_circuit_open",
+    "Whether the circuit breaker of a model rejects calls",
+    lambda: {model: int(breaker.retry_in() is not None) for model, breaker in circuit_breakers().items()},
+    ["model"]
+)
+Gauge(
+    "chilloutai_fal_events_total",
+    "Coalescing and resilience events of fal calls",
+    lambda: {**coalescing_stats, **resilience_stats},
+    ["event"],
+    type="counter"
+)
+Gauge(
+    "chilloutai_quality_tier",
+    "Active quality tier, 0 being full quality",
+    lambda: quality_router.level
+)
+Gauge(
+    "chilloutai_quality_p95_seconds",
+    "Recent p95 generation latency the quality tiers are chosen by",
+    lambda: quality_router.p95() or 0
+)
+Gauge(
+    "chilloutai_control_map_events_total",
+    "Control map cache hits, builds and failed builds",
+    lambda: control_map_store.stats,
+    ["event"],
+    type="counter"
+)
+Gauge(
+    "chilloutai_log_records_dropped_total",
+    "Log records dropped because the log writer fell behind",
+    lambda: log_pipeline.dropped,
+    type="counter"
+)
+Gauge(
+    "chilloutai_warmup_seconds",
+    "Duration of the steps of the last warm-up, and of the startup",
+    lambda: warmer.stats,
+    ["step"]
+)
+
+class MetricsServer:
+    """
+    Serves /metrics, /healthz and /readyz
+
+    /healthz answers as long as the event loop does; /readyz only once the
+    bot has started, and not while it shuts down.
+    """
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.ready = False
+        self._server = None
+
+    async def start(self):
+        if not self.port:
+            return
+        self._server = await start_http_server(self.handle_request, self.host, self.port)
+
+    async def stop(self):
+        self.ready = False
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def handle_request(self, request):
+        if request.method != "GET":
+            return HttpResponse(405, "Method not allowed")
+        if request.path == "/metrics":
+            return HttpResponse(200, render_metrics(), "text/plain; version=0.0.4; charset=utf-8")
+        if request.path == "/healthz":
+            return HttpResponse(200, "ok")
+        if request.path == "/readyz":
+            if not self.ready:
+                return HttpResponse(503, "starting")
+            retry_in = circuit_breaker(DEFAULT_MODEL).retry_in()
+            # Still ready while fal.ai is degraded: users are told, not dropped
+            return HttpResponse(200, f"ready, fal.ai degraded for {retry_in:.0f}s" if retry_in else "ready")
+        return HttpResponse(404, "Not found")
+
+# Create a global instance
+metrics_server = MetricsServer(METRICS_LISTEN, METRICS_PORT)
@@ -0,0 +1,104 @@
+import asyncio
+import logging
+import time
+import fal_client
+from config import STATUS_EDIT_INTERVAL
+from telegram_sender import SendPriority, edit_text
+
+logger = logging.getLogger(__name__)
+
+# Longest log line shown in a status message
+MAX_LOG_LINE = 200
+
+def describe_progress(status, status_text):
+    """
+    Turn a fal queue status event into the text of a status message
+
+    Args:
+        status: fal_client Queued, InProgress or Completed event
+        status_text (str): The job's normal "generating" text
+
+    Returns:
+        str: The text to show, or None to leave the message as it is
+    """
+    if isinstance(status, fal_client.Queued):
+        return f"⏳ Waiting for a free GPU, #{status.position + 1} in line..."
+    if isinstance(status, fal_client.InProgress):
+        messages = [log.get("message") for log in status.logs or [] if log.get("message")]
+        if not messages:
+            return status_text
+        line = messages[-1].strip()
+        if len(line) > MAX_LOG_LINE:
+            line = line[:MAX_LOG_LINE] + "..."
+        return f"{status_text}\n\n{line}"
+    if isinstance(status, fal_client.Completed):
+        return "📤 Done, sending your image..."
+    return None
+
+class StatusMessage:
+    """
+    A job's status message, edited at a bounded rate
+
+    ``show`` only records the text the message should have; a background task
+    applies it at most once per ``min_interval`` seconds, so intermediate
+    states that arrive in between are dropped and bursts of progress events
+    cost a single edit. ``finish`` stops the updates before the final edit or
+    the deletion of the message.
+    """
+
+    def __init__(self, message, status_text, min_interval=STATUS_EDIT_INTERVAL):
+        self.message = message
+        self.status_text = status_text
+        self.min_interval = min_interval
+        self._shown = status_text
+        self._wanted = status_text
+        self._last_edit = time.monotonic()
+        self._task = None
+        self._finished = False
+
+    def show(self, text):
+        """Ask for the message to show ``text`` soon"""
+        if self._finished or text is None:
+            return
+        self._wanted = text
+        if self._task is None and text != self._shown:
+            self._task = asyncio.get_running_loop().create_task(self._apply())
+
+    def on_progress(self, status):
+        """Progress callback for the generate functions"""
+        self.show(describe_progress(status, self.status_text))
+
+    async def _apply(self):
+        try:
+            while self._wanted != self._shown:
+                delay = self._last_edit + self.min_interval - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                text = self._wanted
+                try:
+                    await edit_text(self.message, text)
+                except Exception as e:
+                    # Progress is best effort, the final edit or delivery still follows
+                    logger.warning("Could not update status message: %s", e)
+                self._shown = text
+                self._last_edit = time.monotonic()
+        finally:
+            self._task = None
+
+    async def finish(self, text=None):
+        """
+        Stop progress updates, optionally replacing the message text right away
+
+        Args:
+            text (str): Final text of the message
+        """
+        self._finished = True
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        if text is not None and text != self._shown:
+            await edit_text(self.message, text, SendPriority.REPLY)
+            self._shown = text
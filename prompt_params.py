@@ -0,0 +1,213 @@
+"""
+Parsing and validation of the ``--name value`` parameters in prompts.
+
+The prompt is tokenized in a single pass with one compiled pattern. Values
+may be negative numbers or quoted strings (``--negative_prompt "blurry,
+dark"``). The parameters are then checked against the schema of the target
+model: values are converted to the declared type and clamped to its range,
+and unknown names or invalid choices are rejected here instead of by a fal.ai
+request.
+"""
+import difflib
+import logging
+import re
+from config import DEFAULT_MODEL
+
+logger = logging.getLogger(__name__)
+
+class ParameterError(ValueError):
+    """A prompt parameter the model does not accept; the message is shown to the user"""
+
+# One parameter: "--" (or the em dash some phones substitute) and a name,
+# then a quoted value or any token that is not itself a parameter name
+_PARAMETER = re.compile(
+    r'(?<!\S)(?:--|—)([A-Za-z_]+)\s+'
+    r'(?!--|—)(?:"((?:[^"\\]|\\.)*)"|“([^”]*)”|\'((?:[^\'\\]|\\.)*)\'|(\S+))\s*'
+)
+_ESCAPE = re.compile(r'\\(.)')
+
+# Short names users may type instead of the API names
+PARAMETER_ALIASES = {
+    'steps': 'num_inference_steps',
+    'guidance': 'guidance_scale',
+    'images': 'num_images',
+    'size': 'image_size',
+    'negative': 'negative_prompt',
+}
+
+_TRUE = ('true', 'yes', 'on', '1')
+_FALSE = ('false', 'no', 'off', '0')
+
+class Param:
+    """Type, range and allowed values of one model parameter"""
+
+    __slots__ = ("type", "minimum", "maximum", "choices")
+
+    def __init__(self, type, minimum=None, maximum=None, choices=None):
+        self.type = type
+        self.minimum = minimum
+        self.maximum = maximum
+        self.choices = choices
+
+    def coerce(self, name, value):
+        """
+        Convert a raw value and clamp it to the allowed range
+
+        Args:
+            name (str): The parameter name, for error messages
+            value (str): The value as typed by the user
+
+        Returns:
+            The converted value
+
+        Raises:
+            ParameterError: If the value has the wrong type or is not one of
+                the allowed choices
+        """
+        if self.type is bool:
+            if value.lower() in _TRUE:
+                return True
+            if value.lower() in _FALSE:
+                return False
+            raise ParameterError(f"--{name} must be true or false, not {value!r}.")
+        if self.type is str:
+            if self.choices and value not in self.choices:
+                raise ParameterError(f"--{name} must be one of: {', '.join(self.choices)}.")
+            return value
+
+        try:
+            number = float(value)
+        except ValueError:
+            raise ParameterError(f"--{name} must be a number, not {value!r}.") from None
+        if self.type is int:
+            if not number.is_integer():
+                raise ParameterError(f"--{name} must be a whole number, not {value!r}.")
+            number = int(number)
+        clamped = number
+        if self.minimum is not None:
+            clamped = max(self.minimum, clamped)
+        if self.maximum is not None:
+            clamped = min(self.maximum, clamped)
+        if clamped != number:
+            logger.info("Clamped --%s %s to %s", name, value, clamped)
+        return self.type(clamped)
+
+# Pixel dimensions of the image_size presets
+IMAGE_SIZE_DIMENSIONS = {
+    "square_hd": (1024, 1024),
+    "square": (512, 512),
+    "portrait_4_3": (768, 1024),
+    "portrait_16_9": (576, 1024),
+    "landscape_4_3": (1024, 768),
+    "landscape_16_9": (1024, 576),
+}
+IMAGE_SIZES = tuple(IMAGE_SIZE_DIMENSIONS)
+PREVIEW_MODES = ("off", "auto", "button")
+
+# Parameters of each model, as documented by fal.ai
+MODEL_PARAMETERS = {
+    "fal-ai/stable-diffusion-v35-large": {
+        "negative_prompt": Param(str),
+        "num_inference_steps": Param(int, 1, 50),
+        "guidance_scale": Param(float, 0, 20),
+        "num_images": Param(int, 1, 4),
+        "image_size": Param(str, choices=IMAGE_SIZES),
+        "seed": Param(int, 0, 2 ** 32 - 1),
+        "enable_safety_checker": Param(bool),
+        "output_format": Param(str, choices=("jpeg", "png")),
+    },
+}
+
+# Parameters the ControlNet and IP-Adapter flows accept on top of the model's
+CONTROLNET_PARAMETERS = {
+    "conditioning_scale": Param(float, 0, 2),
+    "start_percentage": Param(float, 0, 1),
+    "end_percentage": Param(float, 0, 1),
+}
+IP_ADAPTER_PARAMETERS = {
+    "ip_adapter_scale": Param(float, 0, 1),
+}
+# Parameters of text-to-image prompts that the bot handles itself
+TEXT_PARAMETERS = {
+    "preview": Param(str, choices=PREVIEW_MODES),
+}
+
+def _guess_type(value):
+    """Type a value for a model without a schema"""
+    if value.lower() == 'true':
+        return True
+    if value.lower() == 'false':
+        return False
+    try:
+        return int(value)
+    except ValueError:
+        pass
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+def tokenize_parameters(text):
+    """
+    Split a prompt into its text and its parameters in one pass
+
+    Args:
+        text (str): The prompt with any --name value parameters
+
+    Returns:
+        tuple: The prompt without the parameters, and a list of (name, value,
+            quoted) in the order they appear
+    """
+    pieces = []
+    params = []
+    position = 0
+    for match in _PARAMETER.finditer(text):
+        pieces.append(text[position:match.start()])
+        position = match.end()
+        name, double, curly, single, bare = match.groups()
+        if bare is not None:
+            params.append((name, bare, False))
+        elif curly is not None:
+            params.append((name, curly, True))
+        else:
+            params.append((name, _ESCAPE.sub(r'\1', double if double is not None else single), True))
+    pieces.append(text[position:])
+    return "".join(pieces).strip(), params
+
+def parse_additional_parameters(text, model=DEFAULT_MODEL, extra=None):
+    """
+    Extract and validate the additional parameters of a prompt
+
+    Args:
+        text (str): The prompt with any --name value parameters
+        model (str): The model the parameters are for
+        extra (dict): Parameters the flow accepts on top of the model's
+
+    Returns:
+        tuple: The prompt, and a dict of API parameters ready for the model
+
+    Raises:
+        ParameterError: If the prompt is empty or a parameter is not
+            accepted by the model
+    """
+    prompt, tokens = tokenize_parameters(text)
+    if not prompt:
+        raise ParameterError("Please provide a prompt, not only parameters.")
+
+    schema = MODEL_PARAMETERS.get(model)
+    if schema is not None and extra:
+        schema = {**schema, **extra}
+
+    params = {}
+    for typed_name, value, quoted in tokens:
+        name = PARAMETER_ALIASES.get(typed_name, typed_name)
+        if schema is None:
+            params[name] = value if quoted else _guess_type(value)
+            continue
+        param = schema.get(name)
+        if param is None:
+            suggestions = difflib.get_close_matches(name, list(schema) + list(PARAMETER_ALIASES), n=1)
+            hint = f" Did you mean --{suggestions[0]}?" if suggestions else ""
+            raise ParameterError(f"Unknown parameter --{typed_name}.{hint}")
+        params[name] = param.coerce(typed_name, value)
+    return prompt, params
@@ -0,0 +1,138 @@
+"""
+Load-adaptive quality tiers for generations.
+
+Under pressure, requests that leave the step count to the bot are routed to
+cheaper settings: fewer inference steps first, then a turbo model. Tiers are
+entered as soon as the load crosses their thresholds, but only left after
+QUALITY_MIN_DWELL seconds and once the load has fallen well below them, so
+the router does not flap while the faster tier itself brings latency down.
+Every decision is counted in the metrics.
+"""
+import logging
+import time
+from metrics import Counter
+from resilience import LatencyTracker
+
+logger = logging.getLogger(__name__)
+
+quality_routed_total = Counter(
+    "chilloutai_quality_routed_total",
+    "Generations by the quality tier they were routed to",
+    ["tier"]
+)
+quality_transitions_total = Counter(
+    "chilloutai_quality_transitions_total",
+    "Changes of the active quality tier",
+    ["from_tier", "to_tier"]
+)
+
+class QualityTier:
+    """
+    One level of the routing policy
+
+    Args:
+        name (str): Label in logs and metrics
+        pending (int): Pending generations at which the tier is entered
+        p95 (float): p95 generation latency (seconds) at which it is entered
+        steps (int): num_inference_steps to use, or None to keep the default
+        model (str): Model to use instead of the default one, or None
+    """
+
+    __slots__ = ("name", "pending", "p95", "steps", "model")
+
+    def __init__(self, name, pending=None, p95=None, steps=None, model=None):
+        self.name = name
+        self.pending = pending
+        self.p95 = p95
+        self.steps = steps
+        self.model = model
+
+    def reached(self, pending, p95, ratio=1.0):
+        """Whether the load is at or above the given share of the thresholds"""
+        if self.pending is not None and pending >= self.pending * ratio:
+            return True
+        return self.p95 is not None and p95 is not None and p95 >= self.p95 * ratio
+
+class QualityRouter:
+    """
+    Picks the quality tier from the current load
+
+    ``tiers`` go from full quality (no thresholds) to the cheapest one.
+    """
+
+    def __init__(self, tiers, exit_ratio=0.7, min_dwell=30.0):
+        self.tiers = tiers
+        self.exit_ratio = exit_ratio
+        self.min_dwell = min_dwell
+        self.level = 0
+        self.changed_at = 0.0
+        # Latency of recent generations at whatever tier they ran
+        self.latency = LatencyTracker(window=50, min_samples=10)
+        # time.monotonic() of the last finished generation, None before the first
+        self.last_recorded = None
+
+    @property
+    def tier(self):
+        return self.tiers[self.level]
+
+    def record(self, seconds):
+        """Record the latency of a finished generation"""
+        self.latency.record("generate", seconds)
+        self.last_recorded = time.monotonic()
+
+    def p95(self):
+        return self.latency.percentile("generate", 0.95)
+
+    def update(self, pending, now=None):
+        """
+        Move to the tier matching the load
+
+        Args:
+            pending (int): Generations running or waiting for a slot
+
+        Returns:
+            QualityTier: The active tier
+        """
+        now = time.monotonic() if now is None else now
+        p95 = self.p95()
+        target = self.level
+        # Climb straight to the highest tier whose thresholds are reached
+        for level in range(len(self.tiers) - 1, self.level, -1):
+            if self.tiers[level].reached(pending, p95):
+                target = level
+                break
+        # Step down one tier at a time, once the load is clearly lower
+        if (target == self.level and self.level > 0 and now - self.changed_at >= self.min_dwell
+                and not self.tier.reached(pending, p95, self.exit_ratio)):
+            target = self.level - 1
+
+        if target != self.level:
+            p95_text = f"{p95:.1f}s" if p95 is not None else "n/a"
+            logger.info(
+                "Quality tier %s -> %s (pending %s, p95 %s)",
+                self.tier.name, self.tiers[target].name, pending, p95_text
+            )
+            quality_transitions_total.inc(from_tier=self.tier.name, to_tier=self.tiers[target].name)
+            self.level = target
+            self.changed_at = now
+        return self.tier
+
+    def route(self, pending, image_to_image=False):
+        """
+        Pick the tier for a request that left the step count to the bot
+
+        Args:
+            pending (int): Generations running or waiting for a slot
+            image_to_image (bool): Whether the request uses ControlNet or
+                IP-Adapter, which model-switching tiers do not support
+
+        Returns:
+            QualityTier: The tier to run the request at
+        """
+        tier = self.update(pending)
+        if image_to_image and tier.model:
+            tier = next(
+                candidate for candidate in reversed(self.tiers[:self.level + 1]) if not candidate.model
+            )
+        quality_routed_total.inc(tier=tier.name)
+        return tier
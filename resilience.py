@@ -0,0 +1,133 @@
+import asyncio
+import logging
+import random
+import time
+from collections import deque
+import httpx
+from fal_client.client import FalClientError
+
+logger = logging.getLogger(__name__)
+
+class UpstreamUnavailableError(Exception):
+    """Raised without calling fal.ai while its circuit breaker is open"""
+
+    def __init__(self, model, retry_in):
+        self.model = model
+        self.retry_in = retry_in
+        super().__init__(
+            f"The image service is having trouble right now. Please try again in {max(1, round(retry_in))} seconds."
+        )
+
+def is_transient(error):
+    """
+    Whether an error from a fal call is worth retrying
+
+    Timeouts, connection problems, 429 and 5xx responses are; rejected
+    arguments and other 4xx responses are not.
+    """
+    if isinstance(error, (asyncio.TimeoutError, httpx.TransportError)):
+        return True
+    cause = error.__cause__ if isinstance(error, FalClientError) else error
+    if isinstance(cause, httpx.HTTPStatusError):
+        status = cause.response.status_code
+        return status == 429 or status >= 500
+    return False
+
+def backoff_delay(attempt, base, cap):
+    """Exponential backoff with full jitter for the given retry attempt (0-based)"""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+class LatencyTracker:
+    """Latencies of recent successful calls, per model"""
+
+    def __init__(self, window=200, min_samples=20):
+        self.window = window
+        self.min_samples = min_samples
+        self._samples = {}
+
+    def record(self, model, seconds):
+        samples = self._samples.get(model)
+        if samples is None:
+            samples = self._samples[model] = deque(maxlen=self.window)
+        samples.append(seconds)
+
+    def percentile(self, model, fraction):
+        """
+        Get a latency percentile of a model
+
+        Returns:
+            float: The latency in seconds, or None without enough samples
+        """
+        samples = self._samples.get(model)
+        if not samples or len(samples) < self.min_samples:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+class CircuitBreaker:
+    """
+    Fails fast while a model keeps failing
+
+    After ``failure_threshold`` consecutive transient failures the breaker
+    opens and calls are rejected for ``cooldown`` seconds. Then a single trial
+    call is let through: its success closes the breaker, its failure opens it
+    for another cooldown.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold=5, cooldown=30.0):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._trial_running = False
+
+    def retry_in(self):
+        """Seconds until calls are let through again, or None if they are now"""
+        if self.state != self.OPEN:
+            return None
+        remaining = self.opened_at + self.cooldown - time.monotonic()
+        return remaining if remaining > 0 else None
+
+    def before_call(self, model):
+        """
+        Raise UpstreamUnavailableError unless a call may go ahead
+
+        Returns:
+            bool: Whether the call is the half-open trial
+        """
+        if self.state == self.CLOSED:
+            return False
+        retry_in = self.opened_at + self.cooldown - time.monotonic()
+        if self.state == self.OPEN and retry_in <= 0:
+            self.state = self.HALF_OPEN
+            logger.info("Circuit for %s half-open, sending a trial request", model)
+        if self.state == self.HALF_OPEN and not self._trial_running:
+            self._trial_running = True
+            return True
+        raise UpstreamUnavailableError(model, max(retry_in, 1.0))
+
+    def record_success(self, model):
+        if self.state != self.CLOSED:
+            logger.info("Circuit for %s closed", model)
+        self.state = self.CLOSED
+        self.failures = 0
+        self._trial_running = False
+
+    def record_failure(self, model):
+        self.failures += 1
+        self._trial_running = False
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                logger.error("Circuit for %s opened after %s failures", model, self.failures)
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+    def record_neutral(self, trial):
+        """A call ended without telling anything about upstream health"""
+        if trial:
+            self._trial_running = False
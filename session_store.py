@@ -0,0 +1,237 @@
+import json
+import logging
+import socket
+import sqlite3
+import threading
+import time
+from urllib.parse import urlparse
+
+logger = logging.getLogger(__name__)
+
+class SessionStoreError(Exception):
+    """Raised when a session store backend fails"""
+
+class SessionStore:
+    """
+    Storage backend interface for UserStateManager
+
+    Sessions are passed around as plain JSON-serializable dicts. Backends are
+    only called from UserStateManager's store thread, never from the event
+    loop, but implementations must still be thread safe.
+    """
+
+    def load(self, user_id):
+        """Return the stored session dict for a user, or None"""
+        raise NotImplementedError
+
+    def save_many(self, sessions):
+        """Store a batch of sessions given as {user_id: session dict}"""
+        raise NotImplementedError
+
+    def delete_many(self, user_ids):
+        """Remove a batch of sessions"""
+        raise NotImplementedError
+
+    def close(self):
+        """Release the backend's resources"""
+
+class SQLiteSessionStore(SessionStore):
+    """Sessions in a local SQLite database, one row per user"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "user_id INTEGER PRIMARY KEY, data TEXT NOT NULL, updated_at REAL NOT NULL)"
+        )
+
+    def load(self, user_id):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT data FROM sessions WHERE user_id = ?", (user_id,)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save_many(self, sessions):
+        now = time.time()
+        rows = [(user_id, json.dumps(data), now) for user_id, data in sessions.items()]
+        with self._lock:
+            with self._conn:
+                self._conn.execute("BEGIN")
+                self._conn.executemany(
+                    "INSERT INTO sessions (user_id, data, updated_at) VALUES (?, ?, ?) "
+                    "ON CONFLICT(user_id) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at",
+                    rows
+                )
+
+    def delete_many(self, user_ids):
+        with self._lock:
+            with self._conn:
+                self._conn.execute("BEGIN")
+                self._conn.executemany(
+                    "DELETE FROM sessions WHERE user_id = ?", [(user_id,) for user_id in user_ids]
+                )
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+class RedisSessionStore(SessionStore):
+    """
+    Sessions in any server speaking the Redis protocol (RESP2)
+
+    Uses a small built-in client so no extra dependency is needed; each
+    thread calling the store gets its own connection, so concurrent loads do
+    not wait for each other, and batches are sent pipelined. Keys expire on
+    the server with the session timeout.
+    """
+
+    def __init__(self, url, ttl, prefix="chilloutai:session:"):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "localhost"
+        self.port = parsed.port or 6379
+        self.password = parsed.password
+        self.db = int(parsed.path.lstrip("/") or 0)
+        self.ttl = max(1, int(ttl))
+        self.prefix = prefix
+        # Every thread's connection, so close() can reach them all
+        self._lock = threading.Lock()
+        self._connections = set()
+        self._local = threading.local()
+
+    def _key(self, user_id):
+        return f"{self.prefix}{user_id}"
+
+    def load(self, user_id):
+        (data,) = self._execute([("GET", self._key(user_id))])
+        return json.loads(data) if data else None
+
+    def save_many(self, sessions):
+        self._execute([
+            ("SET", self._key(user_id), json.dumps(data), "EX", str(self.ttl))
+            for user_id, data in sessions.items()
+        ])
+
+    def delete_many(self, user_ids):
+        if user_ids:
+            self._execute([("DEL", *(self._key(user_id) for user_id in user_ids))])
+
+    def close(self):
+        with self._lock:
+            connections, self._connections = self._connections, set()
+        for connection in connections:
+            self._disconnect(connection)
+
+    def _execute(self, commands):
+        """Send commands pipelined over this thread's connection and return their replies, reconnecting once on failure"""
+        for attempt in range(2):
+            connection = getattr(self._local, "connection", None)
+            try:
+                if connection is None:
+                    connection = self._connect()
+                return self._pipeline(connection, commands)
+            except OSError as e:
+                if connection is not None:
+                    self._disconnect(connection)
+                if attempt:
+                    raise SessionStoreError(f"Redis connection to {self.host}:{self.port} failed: {str(e)}") from e
+
+    def _connect(self):
+        sock = socket.create_connection((self.host, self.port), timeout=5)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        connection = (sock, sock.makefile("rb"))
+        self._local.connection = connection
+        with self._lock:
+            self._connections.add(connection)
+        setup = []
+        if self.password:
+            setup.append(("AUTH", self.password))
+        if self.db:
+            setup.append(("SELECT", str(self.db)))
+        if setup:
+            self._pipeline(connection, setup)
+        return connection
+
+    def _disconnect(self, connection):
+        sock, reader = connection
+        try:
+            reader.close()
+            sock.close()
+        except OSError:
+            pass
+        with self._lock:
+            self._connections.discard(connection)
+        if getattr(self._local, "connection", None) is connection:
+            self._local.connection = None
+
+    def _pipeline(self, connection, commands):
+        sock, reader = connection
+        payload = bytearray()
+        for command in commands:
+            payload += b"*%d\r\n" % len(command)
+            for arg in command:
+                arg = arg.encode("utf-8") if isinstance(arg, str) else arg
+                payload += b"$%d\r\n%s\r\n" % (len(arg), arg)
+        sock.sendall(payload)
+
+        # Read every reply even after an error so the connection stays in sync
+        replies = []
+        error = None
+        for _ in commands:
+            try:
+                replies.append(self._read_reply(reader))
+            except SessionStoreError as e:
+                error = error or e
+                replies.append(None)
+        if error:
+            raise error
+        return replies
+
+    def _read_reply(self, reader):
+        line = reader.readline()
+        if not line:
+            raise ConnectionError("Connection closed by server")
+        kind, body = line[:1], line[1:-2]
+        if kind == b"+":
+            return body.decode("utf-8")
+        if kind == b"-":
+            raise SessionStoreError(body.decode("utf-8"))
+        if kind == b":":
+            return int(body)
+        if kind == b"$":
+            length = int(body)
+            if length < 0:
+                return None
+            data = reader.read(length + 2)
+            return data[:-2].decode("utf-8")
+        if kind == b"*":
+            count = int(body)
+            return None if count < 0 else [self._read_reply(reader) for _ in range(count)]
+        raise SessionStoreError(f"Unexpected reply from server: {line!r}")
+
+def create_session_store(kind, path=None, url=None, ttl=None):
+    """
+    Create the configured session store backend
+
+    Args:
+        kind (str): "memory", "sqlite" or "redis"
+        path (str): Database file for the SQLite backend
+        url (str): redis:// URL for the Redis backend
+        ttl (float): Session lifetime in seconds, used as the Redis key expiry
+
+    Returns:
+        SessionStore: The backend, or None for purely in-memory sessions
+    """
+    if kind == "memory":
+        return None
+    if kind == "sqlite":
+        logger.info("Persisting sessions to SQLite database %s", path)
+        return SQLiteSessionStore(path)
+    if kind == "redis":
+        logger.info("Persisting sessions to Redis at %s", url)
+        return RedisSessionStore(url, ttl)
+    raise ValueError(f"Unknown session store: {kind}")
@@ -0,0 +1,308 @@
+"""
+Rate-limited outbound Telegram requests.
+
+All messages, edits and deletions go through one OutboundSender, which keeps
+the bot within Telegram's flood limits instead of running into 429 errors:
+a global token bucket (about 30 requests per second), a bucket per private
+chat (about one per second) and a bucket per group (about 20 per minute).
+Chat and group buckets hold a few tokens, so short bursts such as a reply
+followed by a status edit go out right away.
+Requests are served by priority, so finished images go out before replies
+and status edits, and within a priority in arrival order. A chat has at most
+one request in flight, which keeps its messages in order.
+
+A request rejected with RetryAfter is put back in its place and its chat
+waits out the ``retry_after`` period, so nothing is lost to rate limiting.
+An edit or deletion of a message replaces any still-pending edit of the same
+message, so status messages never fall behind.
+"""
+import asyncio
+import bisect
+import itertools
+import logging
+import time
+from enum import IntEnum
+from telegram.error import RetryAfter
+from config import (
+    TELEGRAM_GLOBAL_RATE, TELEGRAM_CHAT_RATE, TELEGRAM_GROUP_RATE, TELEGRAM_CHAT_BURST, TELEGRAM_GROUP_BURST
+)
+
+logger = logging.getLogger(__name__)
+
+class SendPriority(IntEnum):
+    DELIVERY = 0
+    REPLY = 1
+    STATUS = 2
+
+class TokenBucket:
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now, cost=1):
+        """Seconds until ``cost`` tokens are available"""
+        self._refill(now)
+        wait = 0.0 if self.tokens >= cost else (cost - self.tokens) / self.rate
+        return max(wait, self.blocked_until - now)
+
+    def take(self, now, cost=1):
+        self._refill(now)
+        self.tokens -= cost
+
+    def idle(self, now):
+        """Whether the bucket is back at full capacity and can be forgotten"""
+        self._refill(now)
+        return self.tokens >= self.capacity and now >= self.blocked_until
+
+class _Request:
+    __slots__ = ("priority", "order", "chat_id", "call", "key", "cost", "future")
+
+    def __init__(self, priority, order, chat_id, call, key, cost, future):
+        self.priority = priority
+        self.order = order
+        self.chat_id = chat_id
+        self.call = call
+        self.key = key
+        self.cost = cost
+        self.future = future
+
+    def __lt__(self, other):
+        return (self.priority, self.order) < (other.priority, other.order)
+
+class OutboundSender:
+    """Sends Telegram API requests within the global and per-chat rate limits"""
+
+    # Per-chat buckets are pruned once there are more than this many
+    MAX_IDLE_BUCKETS = 10000
+
+    def __init__(self, global_rate=30.0, chat_rate=1.0, group_rate=20 / 60, chat_burst=3, group_burst=3):
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.chat_burst = chat_burst
+        self.group_burst = group_burst
+        self._global = TokenBucket(global_rate, capacity=global_rate)
+        self._chats = {}
+        self._busy = set()
+        self._pending = []
+        self._by_key = {}
+        self._order = itertools.count()
+        self._wakeup = None
+        self._task = None
+        self._inflight = set()
+
+    def set_global_rate(self, rate):
+        """Change the global rate, e.g. to split it between worker processes"""
+        self._global = TokenBucket(rate, capacity=rate)
+
+    @property
+    def queue_depth(self):
+        """Number of requests waiting to be sent"""
+        return len(self._pending)
+
+    def send(self, chat_id, call, priority=SendPriority.REPLY, key=None, cost=1):
+        """
+        Queue an API request
+
+        Args:
+            chat_id (int): Chat the request counts against
+            call (callable): Coroutine function making the request
+            priority (SendPriority): Requests of a lower value go first
+            key (hashable): Requests with the same key replace each other
+                while pending, e.g. successive edits of one message
+            cost (int): Number of messages the request sends, e.g. album size
+
+        Returns:
+            asyncio.Future: The request's result; None if it was superseded
+        """
+        if self._task is None:
+            loop = asyncio.get_running_loop()
+            self._wakeup = asyncio.Event()
+            self._task = loop.create_task(self._dispatch())
+        future = asyncio.get_running_loop().create_future()
+        request = _Request(priority, next(self._order), chat_id, call, key, cost, future)
+        if key is not None:
+            previous = self._by_key.pop(key, None)
+            if previous is not None:
+                self._drop(previous)
+            self._by_key[key] = request
+        bisect.insort(self._pending, request)
+        self._wakeup.set()
+        return future
+
+    def _drop(self, request):
+        """Discard a pending request that was superseded"""
+        index = bisect.bisect_left(self._pending, request)
+        if index < len(self._pending) and self._pending[index] is request:
+            del self._pending[index]
+        _resolve(request.future, None)
+
+    def _bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) > self.MAX_IDLE_BUCKETS:
+                now = time.monotonic()
+                for idle_chat in [c for c, b in self._chats.items() if b.idle(now)]:
+                    del self._chats[idle_chat]
+            # Group and channel ids are negative
+            if chat_id < 0:
+                bucket = TokenBucket(self.group_rate, capacity=self.group_burst)
+            else:
+                bucket = TokenBucket(self.chat_rate, capacity=self.chat_burst)
+            self._chats[chat_id] = bucket
+        return bucket
+
+    def _next_request(self, now):
+        """
+        Find the first pending request its chat allows to go out now
+
+        Returns:
+            tuple: (index of the request or None, seconds until one may be ready)
+        """
+        soonest = None
+        for index, request in enumerate(self._pending):
+            if request.chat_id in self._busy:
+                continue
+            delay = self._bucket(request.chat_id).delay(now)
+            if delay <= 0:
+                return index, 0
+            soonest = delay if soonest is None else min(soonest, delay)
+        return None, soonest
+
+    async def _dispatch(self):
+        while True:
+            self._wakeup.clear()
+            now = time.monotonic()
+            index, wait = self._next_request(now) if self._pending else (None, None)
+            if index is not None:
+                wait = self._global.delay(now)
+                if wait <= 0:
+                    request = self._pending.pop(index)
+                    if request.key is not None and self._by_key.get(request.key) is request:
+                        del self._by_key[request.key]
+                    if request.future.done():
+                        # The caller gave up waiting
+                        continue
+                    self._global.take(now, request.cost)
+                    self._bucket(request.chat_id).take(now, request.cost)
+                    self._busy.add(request.chat_id)
+                    task = asyncio.get_running_loop().create_task(self._run(request))
+                    self._inflight.add(task)
+                    task.add_done_callback(self._inflight.discard)
+                    continue
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _run(self, request):
+        try:
+            result = await request.call()
+        except RetryAfter as e:
+            logger.warning("Flood limit hit in chat %s, retrying in %ss", request.chat_id, e.retry_after)
+            self._bucket(request.chat_id).blocked_until = time.monotonic() + e.retry_after
+            if request.key is not None and request.key in self._by_key:
+                # A newer request for the same message is already waiting
+                _resolve(request.future, None)
+            else:
+                if request.key is not None:
+                    self._by_key[request.key] = request
+                bisect.insort(self._pending, request)
+        except Exception as e:
+            if not request.future.done():
+                request.future.set_exception(e)
+        else:
+            _resolve(request.future, result)
+        finally:
+            self._busy.discard(request.chat_id)
+            self._wakeup.set()
+
+    async def close(self, timeout=30.0):
+        """Send what is still pending, up to ``timeout`` seconds, then stop"""
+        if self._task is None:
+            return
+        deadline = time.monotonic() + timeout
+        while (self._pending or self._inflight) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if self._pending:
+            logger.error("Dropping %s unsent Telegram requests at shutdown", len(self._pending))
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        for request in self._pending:
+            request.future.cancel()
+        self._pending.clear()
+        self._by_key.clear()
+
+def _resolve(future, result):
+    if not future.done():
+        future.set_result(result)
+
+# Create a global instance
+outbound = OutboundSender(
+    TELEGRAM_GLOBAL_RATE, TELEGRAM_CHAT_RATE, TELEGRAM_GROUP_RATE, TELEGRAM_CHAT_BURST, TELEGRAM_GROUP_BURST
+)
+
+async def reply_text(message, text, **kwargs):
+    """Reply to a message through the rate limiter"""
+    return await outbound.send(
+        message.chat_id,
+        lambda: message.reply_text(text, **kwargs),
+        SendPriority.REPLY
+    )
+
+async def edit_message_text(bot, chat_id, message_id, text, priority=SendPriority.STATUS, **kwargs):
+    """Edit a message through the rate limiter, replacing pending edits of it"""
+    return await outbound.send(
+        chat_id,
+        lambda: bot.edit_message_text(text, chat_id=chat_id, message_id=message_id, **kwargs),
+        priority,
+        key=(chat_id, message_id)
+    )
+
+async def edit_text(message, text, priority=SendPriority.STATUS, **kwargs):
+    """Edit one of the bot's messages through the rate limiter"""
+    return await edit_message_text(
+        message.get_bot(), message.chat_id, message.message_id, text, priority, **kwargs
+    )
+
+async def edit_reply_markup(message, reply_markup=None, priority=SendPriority.REPLY):
+    """Replace or remove the inline keyboard of one of the bot's messages"""
+    bot, chat_id, message_id = message.get_bot(), message.chat_id, message.message_id
+    return await outbound.send(
+        chat_id,
+        lambda: bot.edit_message_reply_markup(chat_id=chat_id, message_id=message_id, reply_markup=reply_markup),
+        priority,
+        key=(chat_id, message_id)
+    )
+
+async def delete_message(bot, chat_id, message_id):
+    """Delete a message through the rate limiter, dropping pending edits of it"""
+    return await outbound.send(
+        chat_id,
+        lambda: bot.delete_message(chat_id, message_id),
+        SendPriority.STATUS,
+        key=(chat_id, message_id)
+    )
+
+async def send_photo(bot, chat_id, **kwargs):
+    """Deliver a photo ahead of replies and status edits"""
+    return await outbound.send(chat_id, lambda: bot.send_photo(chat_id, **kwargs), SendPriority.DELIVERY)
+
+async def send_media_group(bot, chat_id, **kwargs):
+    """Deliver an album ahead of replies and status edits"""
+    return await outbound.send(
+        chat_id,
+        lambda: bot.send_media_group(chat_id, **kwargs),
+        SendPriority.DELIVERY,
+        cost=len(kwargs.get("media", ()))
+    )
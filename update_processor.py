@@ -0,0 +1,112 @@
+import asyncio
+import logging
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+from log_pipeline import bind_log_context
+
+logger = logging.getLogger(__name__)
+
+# Seconds between checks while waiting for users' updates to finish
+DRAIN_POLL_INTERVAL = 0.05
+
+class UserOrderedUpdateProcessor(BaseUpdateProcessor):
+    """
+    Process updates from different users concurrently while keeping the
+    updates of a single user strictly in arrival order.
+
+    python-telegram-bot acquires its own semaphore before handing an update
+    to ``do_process_update``, so that semaphore only bounds how many updates
+    may be pending at once. The actual concurrency cap is a second semaphore
+    that is acquired *after* the per-user lock, so a user with a backlog of
+    queued messages waits on their own lock without holding a global slot.
+    """
+
+    def __init__(self, max_concurrent_updates, max_pending_updates=None):
+        """
+        Args:
+            max_concurrent_updates (int): Maximum number of handlers running at once
+            max_pending_updates (int): Maximum number of updates accepted for
+                processing, including those waiting behind the same user
+        """
+        if max_concurrent_updates < 1:
+            raise ValueError("max_concurrent_updates must be a positive integer")
+        super().__init__(max(max_pending_updates or 0, max_concurrent_updates))
+        self._active_limit = max_concurrent_updates
+        self._active = asyncio.BoundedSemaphore(max_concurrent_updates)
+        # user_id -> [lock, number of updates holding or waiting for the lock]
+        self._user_locks = {}
+        # Updates handed to the processor so far, and user_id -> number of
+        # them not finished yet, counted before any semaphore is acquired
+        self.accepted = 0
+        self._unfinished = {}
+
+    @property
+    def active_limit(self):
+        """int: The maximum number of handlers running at once."""
+        return self._active_limit
+
+    async def process_update(self, update, coroutine):
+        """Count the update as unfinished until its handler has run."""
+        self.accepted += 1
+        user_id = _ordering_key(update)
+        if user_id is None:
+            await super().process_update(update, coroutine)
+            return
+        self._unfinished[user_id] = self._unfinished.get(user_id, 0) + 1
+        try:
+            await super().process_update(update, coroutine)
+        finally:
+            self._unfinished[user_id] -= 1
+            if self._unfinished[user_id] == 0:
+                del self._unfinished[user_id]
+
+    async def drain(self, accepted, users):
+        """
+        Wait until the handlers of some users' updates have finished
+
+        Args:
+            accepted (int): Wait for this many updates to reach the processor
+                first, so updates still in the update queue are included
+            users (callable): Predicate returning True for the user ids to
+                wait for
+        """
+        while self.accepted < accepted or any(users(user_id) for user_id in self._unfinished):
+            await asyncio.sleep(DRAIN_POLL_INTERVAL)
+
+    async def do_process_update(self, update, coroutine):
+        """Run the handler coroutine once it is this user's turn and a slot is free."""
+        user_id = _ordering_key(update)
+        if user_id is None:
+            async with self._active:
+                await coroutine
+            return
+
+        # Each update is processed in its own task, so this tags its records only
+        bind_log_context(user_id=user_id)
+        entry = self._user_locks.get(user_id)
+        if entry is None:
+            entry = self._user_locks[user_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                async with self._active:
+                    await coroutine
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._user_locks[user_id]
+
+    async def initialize(self):
+        """Nothing to allocate."""
+
+    async def shutdown(self):
+        """Drop the ordering table; in-flight handlers are awaited by the Application."""
+        if self._user_locks:
+            logger.info("Update processor shutting down with %s users pending", len(self._user_locks))
+        self._user_locks.clear()
+
+def _ordering_key(update):
+    """Return the id that orders this update, or None if it has no user."""
+    if isinstance(update, Update) and update.effective_user is not None:
+        return update.effective_user.id
+    return None
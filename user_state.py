@@ -1,6 +1,16 @@
+import os
+import time
+import asyncio
 import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum, auto
-from datetime import datetime, timedelta
+from datetime import timedelta
+from config import (
+    SESSION_TIMEOUT_MINUTES, MAX_USER_SESSIONS, SESSION_STORE, SESSION_STORE_PATH,
+    SESSION_STORE_URL, SESSION_FLUSH_INTERVAL, SESSION_FLUSH_BATCH, SESSION_LOAD_WORKERS
+)
+from session_store import create_session_store
 
 logger = logging.getLogger(__name__)
 
@@ -12,68 +22,325 @@ class UserState(Enum):
     WAITING_FOR_IPADAPTER_PROMPT = auto()
 
 class UserSession:
+    __slots__ = (
+        "state", "image_url", "image_path", "controlnet_type",
+        "is_ip_adapter", "last_activity", "additional_params"
+    )
+
     def __init__(self):
         self.state = UserState.IDLE
         self.image_url = None
         self.image_path = None
         self.controlnet_type = None
-        self.last_activity = datetime.now()
+        self.is_ip_adapter = False
+        self.last_activity = time.time()
         self.additional_params = {}
 
+    def to_dict(self):
+        """Serialize the session for a session store; temp files stay local"""
+        return {
+            "state": self.state.name,
+            "image_url": self.image_url,
+            "controlnet_type": self.controlnet_type,
+            "is_ip_adapter": self.is_ip_adapter,
+            "last_activity": self.last_activity,
+            "additional_params": self.additional_params,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        session = cls()
+        session.state = UserState[data["state"]]
+        session.image_url = data.get("image_url")
+        session.controlnet_type = data.get("controlnet_type")
+        session.is_ip_adapter = data.get("is_ip_adapter", False)
+        session.last_activity = data.get("last_activity", session.last_activity)
+        session.additional_params = data.get("additional_params") or {}
+        return session
+
 class UserStateManager:
-    def __init__(self):
-        self.user_sessions = {}
-        self.session_timeout = timedelta(minutes=30)
-    
+    """
+    In-memory user sessions.
+
+    Sessions live in an OrderedDict kept in last-activity order: touching a
+    session moves it to the end, so expired sessions are always at the front
+    and expiry costs O(1) per removed session instead of a scan of all users.
+    The same order doubles as the LRU order for the ``max_sessions`` cap.
+
+    With a ``store`` the in-memory table acts as a read-through cache: a
+    session missing from memory is loaded from the store by
+    ``load_user_session`` before the user's update is handled, and state
+    changes are written back in batches by a background task. Loads run on a
+    pool of ``load_workers`` threads and writes on one writer thread, so the
+    event loop never waits on the backend and loads do not queue behind
+    flushes or each other.
+    """
+
+    def __init__(self, session_timeout=timedelta(minutes=30), max_sessions=None,
+                 store=None, flush_interval=1.0, flush_batch=500, load_workers=8):
+        self.user_sessions = OrderedDict()
+        self.session_timeout = session_timeout
+        self.max_sessions = max_sessions
+        self.store = store
+        self.flush_interval = flush_interval
+        self.flush_batch = flush_batch
+        self._timeout_seconds = session_timeout.total_seconds()
+        # Write-behind state: sessions changed since the last flush, sessions
+        # to delete, rows of a failed flush waiting to be retried, and the
+        # batches being written right now
+        self._dirty = {}
+        self._deleted = set()
+        self._unwritten = {}
+        self._writing = []
+        self._flush_task = None
+        self._flush_wakeup = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="session-store") if store else None
+        self._load_executor = (
+            ThreadPoolExecutor(max_workers=load_workers, thread_name_prefix="session-load") if store else None
+        )
+
     def get_user_session(self, user_id):
         """Get or create a user session"""
+        now = time.time()
+
         # Clean up expired sessions
-        self._cleanup_expired_sessions()
-        
-        if user_id not in self.user_sessions:
-            self.user_sessions[user_id] = UserSession()
-        
+        self._cleanup_expired_sessions(now)
+
+        session = self.user_sessions.get(user_id)
+        if session is None:
+            session = self._load_session(user_id, now) or UserSession()
+            self.user_sessions[user_id] = session
+            self._enforce_capacity()
+        else:
+            self.user_sessions.move_to_end(user_id)
+
         # Update last activity
-        self.user_sessions[user_id].last_activity = datetime.now()
-        return self.user_sessions[user_id]
-    
+        session.last_activity = now
+        return session
+
     def set_user_state(self, user_id, state, **kwargs):
         """Set the state for a user session"""
         session = self.get_user_session(user_id)
         session.state = state
-        
+
         # Update any additional attributes
         for key, value in kwargs.items():
             setattr(session, key, value)
-        
-        logger.info(f"User {user_id} state changed to {state}")
+
+        self._mark_dirty(user_id, session)
+        logger.info("User %s state changed to %s", user_id, state)
         return session
-    
+
     def reset_user_state(self, user_id):
         """Reset user state to IDLE"""
         session = self.get_user_session(user_id)
         old_state = session.state
-        
+
+        self._remove_temp_image(session)
         session.state = UserState.IDLE
         session.image_url = None
         session.image_path = None
         session.controlnet_type = None
+        session.is_ip_adapter = False
         session.additional_params = {}
-        
-        logger.info(f"User {user_id} state reset from {old_state} to IDLE")
+
+        self._mark_dirty(user_id, session)
+        logger.info("User %s state reset from %s to IDLE", user_id, old_state)
         return session
-    
-    def _cleanup_expired_sessions(self):
-        """Remove expired user sessions"""
-        now = datetime.now()
-        expired_users = [
-            user_id for user_id, session in self.user_sessions.items()
-            if now - session.last_activity > self.session_timeout
-        ]
-        
-        for user_id in expired_users:
-            del self.user_sessions[user_id]
-            logger.info(f"Removed expired session for user {user_id}")
+
+    def _cleanup_expired_sessions(self, now=None):
+        """Remove expired user sessions from the front of the activity order"""
+        cutoff = (now or time.time()) - self._timeout_seconds
+        sessions = self.user_sessions
+        while sessions:
+            user_id, session = next(iter(sessions.items()))
+            if session.last_activity >= cutoff:
+                break
+            sessions.popitem(last=False)
+            self._remove_temp_image(session)
+            if self.store:
+                self._dirty.pop(user_id, None)
+                self._deleted.add(user_id)
+            logger.info("Removed expired session for user %s", user_id)
+
+    def _enforce_capacity(self):
+        """Evict the least recently active sessions above the memory cap"""
+        if not self.max_sessions:
+            return
+        while len(self.user_sessions) > self.max_sessions:
+            user_id, session = self.user_sessions.popitem(last=False)
+            self._remove_temp_image(session)
+            logger.info("Evicted session for user %s to stay under %s sessions", user_id, self.max_sessions)
+
+    def _load_session(self, user_id, now):
+        """Take back an evicted session that is still waiting to be written"""
+        if not self.store:
+            return None
+        if user_id in self._dirty:
+            return self._dirty[user_id]
+        return self._from_row(self._unwritten.get(user_id) or self._written_row(user_id), now)
+
+    def _written_row(self, user_id):
+        """The row of a user in a batch being written, or None"""
+        for rows in reversed(self._writing):
+            if user_id in rows:
+                return rows[user_id]
+        return None
+
+    def _in_memory(self, user_id):
+        """Whether the user's session is cached or waiting to be written"""
+        return (
+            user_id in self.user_sessions or user_id in self._dirty or user_id in self._unwritten
+            or self._written_row(user_id) is not None
+        )
+
+    def _from_row(self, data, now):
+        """Build a session from a stored row, ignoring expired ones"""
+        if not data or now - data.get("last_activity", 0) > self._timeout_seconds:
+            return None
+        return UserSession.from_dict(data)
+
+    async def load_user_session(self, user_id):
+        """
+        Read a user's session through from the store into memory
+
+        Called before the user's update is handled, so ``get_user_session``
+        finds the session in memory. The read runs on the load threads;
+        sessions with a write still pending are taken from memory instead.
+
+        Args:
+            user_id (int): Telegram user id
+        """
+        if not self.store or self._in_memory(user_id):
+            return
+        loop = asyncio.get_running_loop()
+        try:
+            data = await loop.run_in_executor(self._load_executor, self.store.load, user_id)
+        except Exception as e:
+            logger.error("Failed to load session for user %s: %s", user_id, e)
+            return
+        # The session may have been created while the store was read
+        if self._in_memory(user_id):
+            return
+        now = time.time()
+        session = self._from_row(data, now)
+        if session is not None:
+            # Joins the end of the activity order
+            session.last_activity = now
+            self.user_sessions[user_id] = session
+            self._enforce_capacity()
+
+    def _mark_dirty(self, user_id, session):
+        """Queue a session for the next write-behind flush"""
+        if not self.store:
+            return
+        self._dirty[user_id] = session
+        self._deleted.discard(user_id)
+        if len(self._dirty) >= self.flush_batch and self._flush_wakeup is not None:
+            self._flush_wakeup.set()
+
+    def start_write_behind(self):
+        """Start the background flush task; must be called from the event loop"""
+        if self.store and self._flush_task is None:
+            self._flush_wakeup = asyncio.Event()
+            self._flush_task = asyncio.get_running_loop().create_task(self._write_behind_loop())
+
+    async def _write_behind_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_wakeup.clear()
+            await self.flush()
+
+    async def flush(self):
+        """Write all pending session changes to the store in one batch"""
+        if not self.store or not (self._dirty or self._deleted or self._unwritten):
+            return
+        # Serialize on the loop so the store thread never sees a half-updated session
+        rows = self._unwritten
+        rows.update((user_id, session.to_dict()) for user_id, session in self._dirty.items())
+        deleted = self._deleted
+        self._dirty, self._deleted, self._unwritten = {}, set(), {}
+        for user_id in deleted:
+            rows.pop(user_id, None)
+
+        loop = asyncio.get_running_loop()
+        # Loads of these users read the rows from memory until they are written
+        self._writing.append(rows)
+        try:
+            await loop.run_in_executor(self._executor, self._write_batch, rows, deleted)
+        except Exception as e:
+            logger.error("Failed to flush %s sessions, will retry: %s", len(rows), e)
+            for user_id, row in rows.items():
+                if user_id not in self._dirty:
+                    self._unwritten[user_id] = row
+            self._deleted |= deleted - self._dirty.keys()
+        finally:
+            self._writing.remove(rows)
+
+    def _write_batch(self, rows, deleted):
+        if rows:
+            self.store.save_many(rows)
+        if deleted:
+            self.store.delete_many(list(deleted))
+
+    async def release(self, keep):
+        """
+        Drop cached sessions this process no longer owns and persist them
+
+        Used when webhook shards are rebalanced: another worker will load the
+        released sessions from the store on their next update.
+
+        Args:
+            keep (callable): Predicate returning True for user ids that stay here
+        """
+        released = [user_id for user_id in self.user_sessions if not keep(user_id)]
+        for user_id in released:
+            session = self.user_sessions.pop(user_id)
+            if self.store:
+                self._dirty[user_id] = session
+        if released:
+            logger.info("Released %s sessions to other workers", len(released))
+        await self.flush()
+
+    async def close(self):
+        """Stop the flush task, write out pending changes and close the store"""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            self._flush_task = None
+        if self.store:
+            await self.flush()
+            self._load_executor.shutdown(wait=True)
+            self.store.close()
+            self._executor.shutdown(wait=True)
+
+    def _remove_temp_image(self, session):
+        """Delete the session's temporary image file, if it has one"""
+        if session.image_path and os.path.exists(session.image_path):
+            try:
+                os.remove(session.image_path)
+                logger.info("Removed temporary file: %s", session.image_path)
+            except OSError as e:
+                logger.error("Failed to remove temporary file %s: %s", session.image_path, e)
+        session.image_path = None
 
 # Create a global instance
-state_manager = UserStateManager()
+state_manager = UserStateManager(
+    timedelta(minutes=SESSION_TIMEOUT_MINUTES),
+    MAX_USER_SESSIONS,
+    store=create_session_store(
+        SESSION_STORE,
+        path=SESSION_STORE_PATH,
+        url=SESSION_STORE_URL,
+        ttl=SESSION_TIMEOUT_MINUTES * 60
+    ),
+    flush_interval=SESSION_FLUSH_INTERVAL,
+    flush_batch=SESSION_FLUSH_BATCH,
+    load_workers=SESSION_LOAD_WORKERS
+)
@@ -0,0 +1,147 @@
+"""
+Startup checks, warm-up and keep-warm.
+
+The bot tokens are checked before anything connects, so a missing setting
+is reported as such instead of as an import error. Once the Application is
+initialized (which already opens the Telegram connection and rejects an
+invalid bot token), the fal.ai connection pool and the image worker
+processes are started before the bot reports ready, and the configured
+models get a one-step generation in the background. After a quiet period the
+same warm-up runs again, at a separate interval outside the peak hours. The
+duration of each step is logged and exported in the metrics, and the first
+generation after startup logs its latency (see fal_client_wrapper).
+"""
+import asyncio
+import logging
+import re
+import time
+from datetime import datetime
+from config import (
+    TELEGRAM_BOT_TOKEN, FAL_KEY, WARMUP_TIMEOUT, WARMUP_MODELS, KEEP_WARM_INTERVAL,
+    KEEP_WARM_OFFPEAK_INTERVAL, KEEP_WARM_PEAK_HOURS, PREVIEW_MODE
+)
+from fal_client_wrapper import quality_router, warm_fal_client, warm_model
+from image_preprocess import warm_image_pool
+from prompt_params import PREVIEW_MODES
+
+logger = logging.getLogger(__name__)
+
+# Seconds between checks whether a keep-warm round is due
+KEEP_WARM_CHECK_INTERVAL = 60
+
+_TOKEN = re.compile(r"^\d+:[\w-]+$")
+
+def check_settings():
+    """
+    Check the settings the bot cannot start without
+
+    Returns:
+        list: Descriptions of the problems, empty if there are none
+    """
+    problems = []
+    if not TELEGRAM_BOT_TOKEN:
+        problems.append("Please set the TELEGRAM_BOT_TOKEN environment variable")
+    elif not _TOKEN.match(TELEGRAM_BOT_TOKEN):
+        problems.append("TELEGRAM_BOT_TOKEN does not look like a bot token (<bot id>:<secret>)")
+    if not FAL_KEY:
+        problems.append("Please set the FAL_KEY environment variable")
+    if PREVIEW_MODE not in PREVIEW_MODES:
+        problems.append(f"PREVIEW_MODE must be one of {', '.join(PREVIEW_MODES)}, not {PREVIEW_MODE!r}")
+    return problems
+
+class Warmer:
+    """
+    Warms up the connections, the image workers and the models
+
+    Args:
+        models (list): Models to run a one-step generation on
+        interval (float): Seconds without generations after which the
+            warm-up is repeated during the peak hours, 0 to never repeat it
+        offpeak_interval (float): The same outside the peak hours
+        peak_hours (tuple): Start and end (exclusive) local hour of the peak
+    """
+
+    def __init__(self, models, interval, offpeak_interval, peak_hours, timeout=10.0):
+        self.models = models
+        self.interval = interval
+        self.offpeak_interval = offpeak_interval
+        self.peak_hours = peak_hours
+        self.timeout = timeout
+        # Seconds taken by each step of the last warm-up, for the metrics
+        self.stats = {}
+        self.started = time.monotonic()
+        self.last_warmed = None
+        self._tasks = set()
+        self._keep_warm_task = None
+
+    def interval_at(self, hour):
+        """The keep-warm interval that applies at a local hour"""
+        start, end = self.peak_hours
+        peak = start <= hour < end if start <= end else (hour >= start or hour < end)
+        return self.interval if peak else self.offpeak_interval
+
+    async def _step(self, name, call):
+        """Run one warm-up step within the timeout, logging how long it took"""
+        started = time.monotonic()
+        try:
+            result = await asyncio.wait_for(call(), self.timeout)
+        except Exception as e:
+            logger.warning("Warm-up step %s failed: %s %s", name, type(e).__name__, e)
+            return None
+        self.stats[name] = time.monotonic() - started
+        logger.info("Warm-up step %s took %.2fs", name, self.stats[name])
+        return result
+
+    async def warm(self):
+        """Open the fal.ai connections and start the image workers, then warm the models in the background"""
+        self.last_warmed = time.monotonic()
+        if await self._step("fal", warm_fal_client) is False:
+            logger.error("fal.ai rejected FAL_KEY, generations will fail until it is fixed")
+        await self._step("image_pool", warm_image_pool)
+        for model in self.models:
+            task = asyncio.create_task(self._warm_model(model))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _warm_model(self, model):
+        started = time.monotonic()
+        try:
+            await warm_model(model)
+        except Exception as e:
+            logger.warning("Warm-up generation on %s failed: %s", model, e)
+            return
+        self.stats[f"model:{model}"] = time.monotonic() - started
+        logger.info("Warm-up generation on %s took %.2fs", model, time.monotonic() - started)
+
+    async def start(self):
+        """Run the startup warm-up and start keep-warm; must be called from the event loop"""
+        await self.warm()
+        self.stats["startup"] = time.monotonic() - self.started
+        logger.info("Bot ready %.2fs after loading", self.stats['startup'])
+        if (self.interval or self.offpeak_interval) and self._keep_warm_task is None:
+            self._keep_warm_task = asyncio.get_running_loop().create_task(self._keep_warm_loop())
+
+    async def _keep_warm_loop(self):
+        while True:
+            await asyncio.sleep(KEEP_WARM_CHECK_INTERVAL)
+            interval = self.interval_at(datetime.now().hour)
+            last_active = max(self.last_warmed, quality_router.last_recorded or 0)
+            if interval and time.monotonic() - last_active >= interval:
+                logger.info("Keeping connections and models warm")
+                await self.warm()
+
+    async def close(self):
+        """Stop keep-warm and any warm-up still running"""
+        tasks = list(self._tasks)
+        if self._keep_warm_task is not None:
+            tasks.append(self._keep_warm_task)
+            self._keep_warm_task = None
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+# Create a global instance
+warmer = Warmer(
+    WARMUP_MODELS, KEEP_WARM_INTERVAL, KEEP_WARM_OFFPEAK_INTERVAL, KEEP_WARM_PEAK_HOURS,
+    timeout=WARMUP_TIMEOUT
+)
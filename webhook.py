@@ -0,0 +1,344 @@
+"""
+Webhook ingestion with horizontal sharding by user id.
+
+A front process receives Telegram's webhook calls on a small built-in HTTP
+server and hands every update to one of ``WEBHOOK_WORKERS`` worker processes.
+The worker is chosen by rendezvous hashing of the update's user id over the
+workers that are currently alive, so each user's updates (and session) stay
+on one worker, and when a worker leaves or joins only the users that hash to
+it move. Workers run the normal Application without an Updater.
+
+On every membership change the front process tells all workers the new set
+of live workers; each worker then finishes the updates of the users moving
+away from it, flushes and drops their cached sessions and reports back. Until
+every live worker has done so, the front process holds the updates of moved
+users, so the new worker never loads a session the old one is still
+changing. Use a shared SESSION_STORE so moved users keep their state.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import multiprocessing
+import queue
+import signal
+import time
+from telegram import Bot, Update
+from config import (
+    TELEGRAM_BOT_TOKEN, WEBHOOK_URL, WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH,
+    WEBHOOK_SECRET, WEBHOOK_WORKERS, JOB_JOURNAL_PATH, ADMISSION_STATE_PATH, TELEGRAM_GLOBAL_RATE,
+    METRICS_PORT
+)
+from http_server import HttpResponse, start_http_server
+
+logger = logging.getLogger(__name__)
+
+# Seconds between worker health checks, and the longest respawn backoff
+SUPERVISE_INTERVAL = 1.0
+MAX_RESPAWN_BACKOFF = 30.0
+
+# Seconds to wait for workers to hand over moved users before routing their
+# updates to the new workers anyway
+HANDOFF_TIMEOUT = 30.0
+
+def shard_for(key, workers):
+    """
+    Pick the worker for a shard key by rendezvous (highest random weight) hashing
+
+    Args:
+        key (int): The user id (or another stable key) of the update
+        workers (iterable): Ids of the live workers
+
+    Returns:
+        int: The owning worker id, or None if no worker is live
+    """
+    best, best_weight = None, -1
+    for worker_id in workers:
+        digest = hashlib.blake2b(f"{worker_id}:{key}".encode(), digest_size=8).digest()
+        weight = int.from_bytes(digest, "big")
+        if weight > best_weight:
+            best, best_weight = worker_id, weight
+    return best
+
+def shard_key(data):
+    """Extract the user id a raw update belongs to, falling back to its chat or update id"""
+    for value in data.values():
+        if not isinstance(value, dict):
+            continue
+        sender = value.get("from") or value.get("user")
+        if isinstance(sender, dict) and "id" in sender:
+            return sender["id"]
+        chat = value.get("chat")
+        if isinstance(chat, dict) and "id" in chat:
+            return chat["id"]
+    return data.get("update_id", 0)
+
+class WorkerHandle:
+    def __init__(self, worker_id):
+        self.worker_id = worker_id
+        self.process = None
+        self.inbox = None
+        self.ready = None
+        self.restarts = 0
+        self.next_start = 0.0
+
+class WebhookFrontend:
+    """HTTP receiver and supervisor of the sharded worker processes"""
+
+    def __init__(self, num_workers):
+        self._context = multiprocessing.get_context("spawn")
+        self.workers = {worker_id: WorkerHandle(worker_id) for worker_id in range(num_workers)}
+        self.live = set()
+        # Workers report (worker_id, epoch) once they have handed over the
+        # users that moved away from them in that membership change
+        self.acks = self._context.Queue()
+        self.epoch = 0
+        # The live workers when the last hand-over completed, the workers
+        # still handing over, and the updates held for moved users meanwhile
+        self._stable = set()
+        self._releasing = set()
+        self._handoff_deadline = 0.0
+        self._held = []
+
+    def _spawn(self, handle):
+        handle.inbox = self._context.Queue()
+        handle.ready = self._context.Event()
+        handle.process = self._context.Process(
+            target=worker_main,
+            args=(handle.worker_id, handle.inbox, handle.ready, self.acks),
+            name=f"bot-worker-{handle.worker_id}",
+            daemon=True,
+        )
+        handle.process.start()
+        logger.info("Started worker %s (pid %s)", handle.worker_id, handle.process.pid)
+
+    def _broadcast_membership(self):
+        live = sorted(self.live)
+        self.epoch += 1
+        for worker_id in live:
+            self.workers[worker_id].inbox.put({"_live_workers": live, "_epoch": self.epoch})
+        self._releasing = set(live)
+        self._handoff_deadline = time.monotonic() + HANDOFF_TIMEOUT
+        logger.info("Live workers: %s", live)
+
+    def route(self, data):
+        """Hand a raw update to the worker owning its user; False if none is live"""
+        key = shard_key(data)
+        worker_id = shard_for(key, self.live)
+        if worker_id is None:
+            return False
+        if self._releasing:
+            # A moved user's previous worker may still be handling their updates
+            previous = shard_for(key, self._stable)
+            if previous != worker_id and previous in self.live:
+                self._held.append(data)
+                return True
+        self.workers[worker_id].inbox.put(data)
+        return True
+
+    def _collect_acks(self):
+        """Note finished hand-overs and release the held updates once all are done"""
+        try:
+            while True:
+                worker_id, epoch = self.acks.get_nowait()
+                if epoch == self.epoch:
+                    self._releasing.discard(worker_id)
+        except (queue.Empty, OSError, EOFError):
+            pass
+        if not self._releasing and not self._held:
+            self._stable = set(self.live)
+            return
+        self._releasing &= self.live
+        if self._releasing and time.monotonic() < self._handoff_deadline:
+            return
+        if self._releasing:
+            logger.warning("Workers %s did not hand over their users in time", sorted(self._releasing))
+        self._stable = set(self.live)
+        self._releasing = set()
+        held, self._held = self._held, []
+        for data in held:
+            self.route(data)
+        if held:
+            logger.info("Routed %s updates held for moved users", len(held))
+
+    def _remove(self, handle):
+        """Take a dead worker out of the ring and re-route what it never read"""
+        self.live.discard(handle.worker_id)
+        self._broadcast_membership()
+        orphaned = []
+        try:
+            while True:
+                orphaned.append(handle.inbox.get_nowait())
+        except (queue.Empty, OSError, EOFError):
+            pass
+        rerouted = sum(1 for data in orphaned if "_live_workers" not in data and self.route(data))
+        if orphaned:
+            logger.warning("Re-routed %s updates from worker %s", rerouted, handle.worker_id)
+
+    async def supervise(self):
+        """Respawn dead workers and rebalance the ring as workers leave and join"""
+        while True:
+            now = time.monotonic()
+            changed = False
+            for handle in self.workers.values():
+                if handle.process is not None and not handle.process.is_alive():
+                    logger.error("Worker %s exited with code %s", handle.worker_id, handle.process.exitcode)
+                    if handle.worker_id in self.live:
+                        self._remove(handle)
+                    handle.process = None
+                    handle.ready = None
+                    handle.restarts += 1
+                    handle.next_start = now + min(MAX_RESPAWN_BACKOFF, 2 ** handle.restarts)
+                if handle.process is None and now >= handle.next_start:
+                    self._spawn(handle)
+                elif handle.worker_id not in self.live and handle.ready is not None and handle.ready.is_set():
+                    self.live.add(handle.worker_id)
+                    handle.restarts = 0
+                    changed = True
+            if changed:
+                self._broadcast_membership()
+            self._collect_acks()
+            await asyncio.sleep(SUPERVISE_INTERVAL)
+
+    async def handle_request(self, request):
+        if request.path == "/healthz":
+            return HttpResponse(200, "ok")
+        if request.path == "/readyz":
+            if not self.live:
+                return HttpResponse(503, "no worker ready")
+            return HttpResponse(200, f"ready, {len(self.live)}/{len(self.workers)} workers")
+        if request.path != WEBHOOK_PATH:
+            return HttpResponse(404, "Not found")
+        if request.method != "POST":
+            return HttpResponse(405, "Method not allowed")
+        if WEBHOOK_SECRET and request.headers.get("x-telegram-bot-api-secret-token") != WEBHOOK_SECRET:
+            return HttpResponse(403, "Forbidden")
+        try:
+            data = json.loads(request.body)
+        except ValueError:
+            return HttpResponse(400, "Invalid JSON")
+        if not isinstance(data, dict):
+            return HttpResponse(400, "Invalid update")
+        # Without a live worker let Telegram keep the update and retry later
+        if not self.route(data):
+            return HttpResponse(503, "No worker available")
+        return HttpResponse(200, "")
+
+    def stop_workers(self):
+        # Deliver the held updates; the workers stop after handling them
+        self._releasing = set()
+        held, self._held = self._held, []
+        for data in held:
+            self.route(data)
+        for handle in self.workers.values():
+            if handle.process is not None and handle.process.is_alive():
+                handle.inbox.put(None)
+        for handle in self.workers.values():
+            if handle.process is not None:
+                handle.process.join(timeout=30)
+                if handle.process.is_alive():
+                    handle.process.terminate()
+
+async def _run_frontend():
+    if not WEBHOOK_URL:
+        raise ValueError("Please set the WEBHOOK_URL environment variable for webhook mode")
+
+    frontend = WebhookFrontend(WEBHOOK_WORKERS)
+    supervisor = asyncio.create_task(frontend.supervise())
+    server = await start_http_server(frontend.handle_request, WEBHOOK_LISTEN, WEBHOOK_PORT)
+
+    async with Bot(TELEGRAM_BOT_TOKEN) as bot:
+        await bot.set_webhook(
+            url=WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET or None,
+            allowed_updates=Update.ALL_TYPES,
+        )
+    logger.info("Webhook set to %s with %s workers", WEBHOOK_URL, WEBHOOK_WORKERS)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    await stop.wait()
+
+    logger.info("Stopping webhook front end...")
+    server.close()
+    await server.wait_closed()
+    supervisor.cancel()
+    await loop.run_in_executor(None, frontend.stop_workers)
+
+def run_webhook():
+    """Run the webhook front end until SIGINT/SIGTERM"""
+    asyncio.run(_run_frontend())
+
+def worker_main(worker_id, inbox, ready, acks):
+    """Entry point of a worker process"""
+    # The front process handles signals and stops workers through their inbox
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(_run_worker(worker_id, inbox, ready, acks))
+
+async def _run_worker(worker_id, inbox, ready, acks):
+    # Imported in the worker so the front process stays light
+    from main import build_application, post_init, post_shutdown
+    from user_state import state_manager
+    from job_journal import job_journal
+    from admission import admission
+    from warmup import warmer
+    from log_pipeline import bind_log_context
+    from telegram_sender import outbound
+    from metrics_server import metrics_server
+
+    bind_log_context(worker_id=worker_id)
+    # Each worker journals and resumes its own queued jobs
+    job_journal.set_path(f"{JOB_JOURNAL_PATH}.{worker_id}")
+    # Users are sharded, so each worker keeps the quotas of its own users
+    admission.set_path(f"{ADMISSION_STATE_PATH}.{worker_id}")
+    # One worker is enough to keep the models warm
+    if worker_id:
+        warmer.models = []
+    # All workers share the bot's global flood limit
+    outbound.set_global_rate(TELEGRAM_GLOBAL_RATE / WEBHOOK_WORKERS)
+    if METRICS_PORT:
+        metrics_server.port = METRICS_PORT + worker_id
+    application = build_application(with_updater=False)
+    loop = asyncio.get_running_loop()
+
+    async def hand_off(live, epoch, accepted, previous):
+        """Finish and save the sessions of the users moving to other workers, then report to the front"""
+        if previous is not None:
+            # Hand-overs complete in order, so an ack covers the earlier ones
+            await previous
+        moving = lambda user_id: shard_for(user_id, live) != worker_id
+        try:
+            await asyncio.wait_for(application.update_processor.drain(accepted, moving), HANDOFF_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning("Handing over moved users before their updates finished")
+        await state_manager.release(lambda user_id: not moving(user_id))
+        acks.put((worker_id, epoch))
+
+    handoff = None
+    forwarded = 0
+    async with application:
+        await post_init(application)
+        await application.start()
+        ready.set()
+        logger.info("Worker %s ready", worker_id)
+        try:
+            while True:
+                data = await loop.run_in_executor(None, inbox.get)
+                if data is None:
+                    break
+                if "_live_workers" in data:
+                    # Runs alongside new updates, which only come from users staying here
+                    handoff = asyncio.create_task(
+                        hand_off(data["_live_workers"], data["_epoch"], forwarded, handoff)
+                    )
+                    continue
+                forwarded += 1
+                await application.update_queue.put(Update.de_json(data, application.bot))
+        finally:
+            if handoff is not None:
+                handoff.cancel()
+            await application.stop()
+            await post_shutdown(application)
+    logger.info("Worker %s stopped", worker_id)